@@ -0,0 +1,164 @@
+import time
+import logging
+import threading
+from datetime import datetime
+
+from templates import escape_markdown
+
+logger = logging.getLogger(__name__)
+
+# Типы событий, которые копируются администратору
+BUYER_MESSAGE = 'buyer_message'
+SELLER_MESSAGE = 'seller_message'
+NEW_ORDER = 'new_order'
+COMPLETED = 'completed'
+CANCELLED = 'cancelled'
+
+# Длиннее этого текст события в сводке обрезается: переписка целиком есть в карточке заказа
+EVENT_TEXT_LIMIT = 300
+
+
+class _Event:
+    __slots__ = ('order_number', 'text', 'at')
+
+    def __init__(self, order_number, text, at):
+        self.order_number = order_number
+        self.text = text
+        self.at = at
+
+
+class AdminDigest:
+    """Сводка копий для администратора.
+
+    Вместо отдельного сообщения на каждую копию события копятся и уходят
+    одним сообщением раз в interval секунд или как только их набралось
+    max_events. В сводке события сгруппированы по заказам, а то, что не
+    влезло в limit символов, отбрасывается с пометкой. События из urgent
+    и все события при interval <= 0 отправляются сразу, как раньше.
+
+    send(text, **kwargs) ставит сообщение администратору в очередь отправки
+    и не должен блокироваться надолго.
+    """
+
+    def __init__(self, send, interval=0.0, max_events=30, urgent=(CANCELLED,), limit=4096):
+        self.send = send
+        self.interval = interval
+        self.max_events = max_events
+        self.urgent = set(urgent)
+        self.limit = limit
+
+        self._events = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        self.flushed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._events)
+
+    def buffers(self, kind) -> bool:
+        """Попадёт ли событие этого типа в сводку, а не уйдёт сразу"""
+        return self.enabled and kind not in self.urgent
+
+    def add(self, kind, order_number, text, summary=None, **kwargs):
+        """Копия события по заказу.
+
+        text и kwargs (parse_mode и т.п.) — сообщение на случай отправки сразу;
+        summary — простой текст строки сводки, по умолчанию text.
+        """
+        if not self.buffers(kind):
+            self.send(text, **kwargs)
+            return
+        line = summary if summary is not None else text
+        if len(line) > EVENT_TEXT_LIMIT:
+            line = line[:EVENT_TEXT_LIMIT - 1] + '…'
+        with self._cond:
+            self._events.append(_Event(str(order_number), line, time.time()))
+            full = len(self._events) >= self.max_events
+            self._start()
+            if full:
+                self._cond.notify()
+
+    def _start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="admin-digest", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Останавливает поток и отправляет то, что успело накопиться"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stop:
+                    if len(self._events) >= self.max_events:
+                        break
+                    if self._events:
+                        wait = self._events[0].at + self.interval - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                if self._stop:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Отправляет накопленные события одной сводкой"""
+        with self._cond:
+            events, self._events = self._events, []
+        if not events:
+            return
+        try:
+            self.send(self.render(events), parse_mode='Markdown')
+            self.flushed += 1
+            logger.info(f"Сводка из {len(events)} событий поставлена в очередь администратору")
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки администратору: {e}")
+
+    def render(self, events) -> str:
+        """Текст сводки: заказы в порядке первого события, внутри — по времени"""
+        by_order = {}
+        for event in events:
+            by_order.setdefault(event.order_number, []).append(event)
+
+        header = f"🗂 *Сводка событий* ({len(events)})"
+        lines = [header]
+        # Запас под строку о пропущенных событиях
+        budget = self.limit - len(header) - 100
+        shown = 0
+        for order_number, order_events in by_order.items():
+            title = f"\n*Заказ {escape_markdown(order_number)}*"
+            if len(title) + 1 > budget:
+                break
+            lines.append(title)
+            budget -= len(title) + 1
+            for event in order_events:
+                stamp = datetime.fromtimestamp(event.at).strftime('%H:%M')
+                line = f"{stamp} {escape_markdown(event.text)}"
+                if len(line) + 1 > budget:
+                    break
+                lines.append(line)
+                budget -= len(line) + 1
+                shown += 1
+            else:
+                continue
+            break
+
+        if shown < len(events):
+            lines.append(f"\n…и ещё {len(events) - shown} событий — полностью в карточках заказов")
+        return '\n'.join(lines)
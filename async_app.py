@@ -0,0 +1,1065 @@
+"""Асинхронный режим бота: ASGI-приложение на AsyncTeleBot и пуле psycopg 3.
+
+Хэндлеры и эндпоинты /webhook, /api/new-order, /api/new-orders, /api/order-cancelled
+и /api/orders/search повторяют синхронные из bot.py и берут из core те же проверки, запросы,
+шаблоны, отрисовку и кэши — своё здесь только ожидание ввода-вывода.
+Пока апдейт ждёт Postgres или Telegram, цикл событий обслуживает остальные,
+поэтому один процесс держит сотни апдейтов одновременно.
+
+    BOT_RUNTIME=async python bot.py
+    # или любым ASGI-сервером: uvicorn async_app:app --port 10000
+
+Зависимости — в requirements-async.txt.
+"""
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qsl
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import aiohttp
+from psycopg import AsyncCursor
+from psycopg.errors import UniqueViolation
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+from telebot import types, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware
+
+import core
+import schema
+import admin_digest as digest_events
+from admin_digest import AdminDigest
+from cache import MISSING
+from order_numbers import OrderNumberAllocator, RESERVE_SQL
+from outbox import INSERT_SQL as OUTBOX_INSERT_SQL
+from schema import OrderStatus
+from send_queue import AsyncSendQueue
+from update_executor import AsyncOrderedExecutor, update_chat_id
+
+logger = logging.getLogger(__name__)
+
+abot = AsyncTeleBot(core.BOT_TOKEN)
+core.metrics.instrument_telegram(asyncio_helper, '_process_request')
+send_queue = AsyncSendQueue(
+    abot,
+    global_rate=core.TELEGRAM_GLOBAL_RATE,
+    chat_rate=core.TELEGRAM_CHAT_RATE,
+    chat_burst=core.TELEGRAM_CHAT_BURST,
+    group_rate=core.TELEGRAM_GROUP_RATE,
+    network_errors=(asyncio_helper.RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+)
+core.metrics.instrument_send_queue(send_queue)
+
+# Сводку отправляет поток AdminDigest — он ждёт постановки в очередь на цикле событий
+_loop = None
+
+def _send_digest(text, **kwargs):
+    asyncio.run_coroutine_threadsafe(send_queue.send_message(core.ADMIN_ID, text, **kwargs), _loop).result()
+
+admin_digest = AdminDigest(
+    _send_digest,
+    interval=core.ADMIN_DIGEST_INTERVAL,
+    max_events=core.ADMIN_DIGEST_MAX_EVENTS,
+    urgent=core.ADMIN_DIGEST_URGENT,
+    limit=core.TELEGRAM_MESSAGE_LIMIT
+)
+
+async def copy_to_admin(kind: str, order_number: str, text: str, summary=None, **kwargs):
+    """Копия события администратору: в сводку или, если тип срочный, сразу"""
+    if admin_digest.buffers(kind):
+        admin_digest.add(kind, order_number, text, summary=summary, **kwargs)
+    else:
+        await send_queue.send_message(core.ADMIN_ID, text, **kwargs)
+
+# ========== БД ==========
+_db_pool = None
+
+async def open_db_pool() -> AsyncConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = AsyncConnectionPool(
+            core.DATABASE_URL,
+            min_size=core.DB_POOL_MIN,
+            max_size=core.DB_POOL_MAX,
+            timeout=core.DB_POOL_TIMEOUT,
+            max_idle=core.DB_POOL_MAX_IDLE,
+            max_lifetime=core.DB_POOL_MAX_LIFETIME,
+            kwargs={'row_factory': dict_row, 'cursor_factory': core.metrics.cursor_factory(AsyncCursor)},
+            open=False
+        )
+        await _db_pool.open()
+        logger.info(f"Асинхронный пул соединений с БД создан: min={core.DB_POOL_MIN}, max={core.DB_POOL_MAX}")
+    return _db_pool
+
+@asynccontextmanager
+async def db_cursor():
+    """Курсор соединения из пула: при выходе без исключения транзакция фиксируется"""
+    core.metrics.observe_db_connection()
+    async with _db_pool.connection() as conn:
+        async with conn.cursor() as cur:
+            yield cur
+
+async def fetchone(query, params=None):
+    async with db_cursor() as cur:
+        await cur.execute(query, params)
+        return await cur.fetchone()
+
+async def fetchall(query, params=None):
+    async with db_cursor() as cur:
+        await cur.execute(query, params)
+        return await cur.fetchall()
+
+async def execute(query, params=None):
+    async with db_cursor() as cur:
+        await cur.execute(query, params)
+
+# ========== Справочники (кэши из core) ==========
+async def directory_lookup(cache, key, loader):
+    if core.DIRECTORY_CACHE_LISTEN:
+        core.directory_listener.start()
+    return await cache.get_or_load_async(key, loader)
+
+async def _load_pickup_location_info(address: str):
+    return await fetchone(core.PICKUP_LOCATION_SQL, (address,))
+
+async def _load_seller_by_telegram_id(telegram_id: int):
+    return await fetchone("SELECT * FROM sellers WHERE telegram_id = %s", (telegram_id,))
+
+async def _load_seller_by_id(seller_id: int):
+    return await fetchone("SELECT * FROM sellers WHERE id = %s", (seller_id,))
+
+async def get_pickup_location_info(address: str):
+    return await directory_lookup(core.pickup_location_cache, address, _load_pickup_location_info)
+
+async def get_seller_by_telegram_id(telegram_id: int):
+    return await directory_lookup(core.seller_by_telegram_cache, telegram_id, _load_seller_by_telegram_id)
+
+async def get_seller_by_id(seller_id: int):
+    return await directory_lookup(core.seller_by_id_cache, seller_id, _load_seller_by_id)
+
+# ========== Заказы и сообщения ==========
+def _parse_order(order):
+    if order:
+        order['contact'] = core.parse_contact(order['contact'])
+        order['items'] = core.parse_items(order['items'])
+    return order
+
+async def get_order_by_number(order_number: str):
+    return _parse_order(await fetchone("SELECT * FROM orders WHERE order_number = %s", (order_number,)))
+
+async def get_order_by_request_id(request_id: str):
+    return await fetchone("SELECT id, order_number, notified_bool, contact FROM orders WHERE request_id = %s", (request_id,))
+
+async def get_orders_by_request_ids(request_ids) -> dict:
+    if not request_ids:
+        return {}
+    rows = await fetchall("SELECT id, order_number, notified_bool, request_id FROM orders WHERE request_id = ANY(%s)",
+                          (list(request_ids),))
+    return {row['request_id']: row for row in rows}
+
+async def allocate_order_number(cur, prefix: str) -> str:
+    """Номер заказа в транзакции cur; для префиксов с пачками — из памяти синхронного аллокатора"""
+    prefix = OrderNumberAllocator.normalize_prefix(prefix)
+    allocator = core.get_order_number_allocator()
+    if prefix in allocator.block_sizes:
+        # В БД аллокатор ходит только за новой пачкой — и тогда не держит цикл событий
+        return await asyncio.to_thread(allocator.allocate, prefix)
+    await cur.execute(RESERVE_SQL, (prefix, 1))
+    return f"{prefix}{(await cur.fetchone())['last_value']}"
+
+async def place_order(order_data: dict, prefix: str, contact: dict, request_id: str = None):
+    """Выделяет номер и сохраняет заказ в одной транзакции; возвращает (id, номер) или None, как core.place_order"""
+    try:
+        async with db_cursor() as cur:
+            order_number = await allocate_order_number(cur, prefix)
+            await cur.execute(core.ORDER_INSERT_SQL, core._order_row(
+                dict(order_data, order_number=order_number), contact, request_id, json_adapter=Jsonb))
+            order_id = (await cur.fetchone())['id']
+    except UniqueViolation as e:
+        if not core.is_request_id_conflict(e):
+            raise
+        return None
+    return order_id, order_number
+
+async def place_orders(entries):
+    """Пачка заказов одной транзакцией; возвращает то же, что core.place_orders"""
+    positions = core.batch_prefix_positions(entries)
+    numbers = [None] * len(entries)
+    async with db_cursor() as cur:
+        # Счётчики — в том же порядке префиксов, что и в синхронном режиме
+        for prefix in sorted(positions):
+            count = len(positions[prefix])
+            normalized = OrderNumberAllocator.normalize_prefix(prefix)
+            await cur.execute(RESERVE_SQL, (normalized, count))
+            last = (await cur.fetchone())['last_value']
+            for index, number in zip(positions[prefix], range(last - count + 1, last + 1)):
+                numbers[index] = f"{normalized}{number}"
+        params = []
+        for (order_data, prefix, contact, request_id), number in zip(entries, numbers):
+            params.extend(core._order_row(dict(order_data, order_number=number), contact, request_id, json_adapter=Jsonb))
+        values = ', '.join([core.ORDER_INSERT_VALUES] * len(entries))
+        await cur.execute(core.ORDER_BATCH_INSERT_SQL % values, params)
+        inserted = await cur.fetchall()
+    return core.placed_orders(inserted, numbers)
+
+async def assign_order_number(order_id: int, prefix: str) -> str:
+    async with db_cursor() as cur:
+        order_number = await allocate_order_number(cur, prefix)
+        await cur.execute("UPDATE orders SET order_number = %s WHERE id = %s", (order_number, order_id))
+    return order_number
+
+async def mark_orders_notified(order_ids):
+    if order_ids:
+        await execute("UPDATE orders SET notified_bool = TRUE WHERE id = ANY(%s)", (list(order_ids),))
+
+async def update_order_status(order_id: int, status: OrderStatus):
+    await execute("UPDATE orders SET status = %s WHERE id = %s", (OrderStatus(status).value, order_id))
+    core.order_cards.bump(order_id)
+
+async def complete_order(order_id: int, order_number: str = None):
+    """Завершает заказ и в той же транзакции ставит уведомление складскому боту в outbox"""
+    event = None
+    if order_number:
+        event = core.outbox.event_params('order_completed', {"order_number": order_number}, f"order-completed:{order_id}")
+    async with db_cursor() as cur:
+        await cur.execute("UPDATE orders SET status = %s, completed_at = %s WHERE id = %s",
+                          (OrderStatus.COMPLETED.value, datetime.utcnow(), order_id))
+        if event:
+            await cur.execute(OUTBOX_INSERT_SQL, event)
+    core.order_cards.bump(order_id)
+    core.outbox.wakeup()
+
+async def get_messages_for_order(order_id: int, before: tuple = None, limit: int = None):
+    limit = limit or core.ORDER_HISTORY_PAGE_SIZE
+    return core.messages_page(await fetchall(*core.messages_page_query(order_id, before, limit)), limit)
+
+async def save_message(order_id: int, sender_id: int, sender_role: str, text: str):
+    await execute("""
+        INSERT INTO messages (order_id, sender_id, sender_role, text)
+        VALUES (%s, %s, %s, %s)
+    """, (order_id, sender_id, sender_role, text))
+    core.order_cards.bump(order_id)
+
+async def get_active_orders_page(seller_id: int = None, delivery_type: str = None, cursor: int = None,
+                                 direction: str = 'next', limit: int = None):
+    limit = limit or core.ORDERS_PAGE_SIZE
+    rows = await fetchall(*core.active_orders_page_query(seller_id, delivery_type, cursor, direction, limit))
+    return core.active_orders_page(rows, limit, cursor, direction)
+
+async def active_orders_view(sender, direction: str = 'next', cursor: int = None,
+                             seller_filter: int = None, delivery_filter: str = None):
+    seller_id, delivery_filter = core.active_orders_scope(sender, seller_filter, delivery_filter)
+    page = await get_active_orders_page(seller_id, delivery_filter, cursor, direction)
+    if not page[0] and cursor is not None:
+        page = await get_active_orders_page(seller_id, delivery_filter)
+    return core.render_active_orders(sender, page, seller_id, seller_filter, delivery_filter)
+
+async def search_orders(query: str, seller_id: int = None, offset: int = 0, limit: int = None):
+    limit = limit or core.SEARCH_PAGE_SIZE
+    rows = await fetchall(*core.search_orders_query(query, seller_id, offset, limit))
+    return core.search_orders_page(rows, limit)
+
+async def search_orders_view(sender, query: str, offset: int = 0):
+    page = await search_orders(query, core.search_scope(sender), offset)
+    return core.render_search_results(sender, query, page, offset)
+
+# ========== Диспетчеризация ==========
+async def resolve_sender(user_id: int, with_buyer_order: bool = True):
+    seller = await get_seller_by_telegram_id(user_id)
+    order = None
+    if with_buyer_order:
+        order = await fetchone(core.BUYER_ACTIVE_ORDER_SQL, (user_id,))
+        if order:
+            order['contact'] = core.parse_contact(order['contact'])
+    return core.SenderContext(user_id, seller, order)
+
+class SenderContextMiddleware(BaseMiddleware):
+    """Определяет роль отправителя до фильтров; фильтры читают её через core.get_sender"""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process(self, update, data):
+        update.sender_context = await resolve_sender(update.from_user.id, isinstance(update, types.Message))
+        data['sender'] = update.sender_context
+
+    async def post_process(self, update, data, exception):
+        pass
+
+get_sender = core.get_sender
+
+# ========== Хэндлеры ==========
+abot.setup_middleware(SenderContextMiddleware())
+
+@abot.message_handler(commands=['start'])
+async def handle_start(message):
+    user_id = message.from_user.id
+    parts = message.text.split()
+    param = parts[1] if len(parts) > 1 else ''
+
+    if param.startswith('order_'):
+        order_num = param[6:]
+        await abot.send_message(
+            user_id,
+            f"✅ Здравствуйте! Ваш заказ №{order_num} оформлен. Здесь вы можете общаться с продавцом и получать уведомления о статусе заказа.\n\nЕсли у вас есть вопросы, просто напишите их в этот чат."
+        )
+        return
+
+    sender = get_sender(message)
+    if sender.seller:
+        await abot.send_message(user_id, "👋 Добро пожаловать! Здесь будут ваши заказы и общение с покупателями.",
+                                reply_markup=core.seller_keyboard())
+    elif sender.is_admin:
+        await abot.send_message(user_id, "👋 Добро пожаловать в панель администратора!",
+                                reply_markup=core.admin_keyboard())
+    else:
+        await abot.send_message(user_id, "👋 Добро пожаловать! Если вы оформили заказ, то здесь будет общение с продавцом.")
+
+@abot.message_handler(func=lambda m: m.text == "📋 Мои активные заказы")
+async def handle_my_orders(message):
+    sender = get_sender(message)
+    if not sender.is_staff:
+        await abot.reply_to(message, "❌ У вас нет доступа к этой функции.")
+        return
+
+    text, markup = await active_orders_view(sender)
+    if markup is None:
+        await abot.reply_to(message, text)
+        return
+    await abot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('orders:'))
+async def orders_page(call):
+    sender = get_sender(call)
+    if not sender.is_staff:
+        await abot.answer_callback_query(call.id, "❌ Ошибка доступа")
+        return
+
+    text, markup = await active_orders_view(sender, *core.parse_orders_callback(call.data))
+    try:
+        await abot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                                     parse_mode='Markdown' if markup else None, reply_markup=markup)
+    except Exception as e:
+        logger.error(f"Не удалось показать страницу заказов: {e}")
+    await abot.answer_callback_query(call.id)
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('orders_sellers:'))
+async def orders_seller_filter(call):
+    if not get_sender(call).is_admin:
+        await abot.answer_callback_query(call.id, "❌ Ошибка доступа")
+        return
+
+    delivery_filter = call.data.split(':', 1)[1] or None
+    sellers = await fetchall("SELECT id, name FROM sellers ORDER BY name")
+    await abot.edit_message_text("👤 Выберите продавца:", call.message.chat.id, call.message.message_id,
+                                 reply_markup=core.sellers_filter_markup(sellers, delivery_filter))
+    await abot.answer_callback_query(call.id)
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('view_order_'))
+async def view_order(call):
+    # view_order_<номер>[_<курсор истории>]
+    parts = call.data.split('_')
+    order_num = parts[2]
+    history_key = parts[3] if len(parts) > 3 else None
+
+    # Кэш карточек общий с синхронным режимом, правила те же: версия берётся до чтения данных
+    order_id = core.order_id_by_number.get(order_num)
+    version = core.order_cards.version(order_id) if order_id is not MISSING else None
+    card = core.order_cards.get(order_id, history_key) if version is not None else MISSING
+    if card is not MISSING:
+        seller_id, info, markup = card
+    else:
+        order = await get_order_by_number(order_num)
+        if not order:
+            logger.error(f"Заказ {order_num} не найден")
+            await abot.answer_callback_query(call.id, "❌ Заказ не найден")
+            return
+        core.order_id_by_number.set(order_num, order['id'])
+        seller_id = order['seller_id']
+
+    sender = get_sender(call)
+    if not sender.is_admin:
+        seller = sender.seller
+        if not seller or seller_id != seller['id']:
+            await abot.answer_callback_query(call.id, "❌ У вас нет прав для просмотра этого заказа")
+            return
+
+    if card is MISSING:
+        history_before = core.parse_history_cursor(history_key)
+        try:
+            messages, has_older = await get_messages_for_order(order['id'], before=history_before)
+        except Exception as e:
+            logger.exception(f"Ошибка при получении сообщений: {e}")
+            await abot.answer_callback_query(call.id, "❌ Ошибка получения истории")
+            return
+
+        try:
+            info, markup = core.render_order_card(order, messages, has_older, history_before)
+        except Exception as e:
+            logger.exception(f"Ошибка при формировании текста: {e}")
+            await abot.answer_callback_query(call.id, "❌ Ошибка формирования данных")
+            return
+
+        if version is not None:
+            core.order_cards.set(order['id'], (seller_id, info, markup), version, history_key)
+
+    try:
+        await abot.edit_message_text(info, call.message.chat.id, call.message.message_id,
+                                     parse_mode='Markdown', reply_markup=markup)
+    except Exception as e:
+        logger.exception(f"Ошибка при редактировании сообщения: {e}")
+        await abot.answer_callback_query(call.id, "❌ Ошибка отправки")
+        return
+
+    await abot.answer_callback_query(call.id)
+
+@abot.callback_query_handler(func=lambda call: call.data == "back_to_orders")
+async def back_to_orders(call):
+    sender = get_sender(call)
+    if not sender.is_staff:
+        await abot.answer_callback_query(call.id, "❌ Ошибка доступа")
+        return
+
+    text, markup = await active_orders_view(sender)
+    if markup is None:
+        await abot.edit_message_text(text, call.message.chat.id, call.message.message_id)
+        return
+    await abot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                                 parse_mode='Markdown', reply_markup=markup)
+    await abot.answer_callback_query(call.id)
+
+@abot.message_handler(commands=['find'])
+async def handle_find(message):
+    sender = get_sender(message)
+    if not sender.is_staff:
+        await abot.reply_to(message, "❌ У вас нет доступа к этой функции.")
+        return
+    if not core.search_ready:
+        await abot.reply_to(message, core.SEARCH_UNAVAILABLE)
+        return
+
+    query = core.search_query_from_command(message.text)
+    if query is None:
+        await abot.reply_to(message, core.FIND_USAGE)
+        return
+
+    text, markup = await search_orders_view(sender, query)
+    await abot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('find:'))
+async def find_page(call):
+    sender = get_sender(call)
+    if not sender.is_staff:
+        await abot.answer_callback_query(call.id, "❌ Ошибка доступа")
+        return
+    if not core.search_ready:
+        await abot.answer_callback_query(call.id, core.SEARCH_UNAVAILABLE)
+        return
+
+    text, markup = await search_orders_view(sender, *core.parse_search_callback(call.data))
+    try:
+        await abot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                                     parse_mode='Markdown', reply_markup=markup)
+    except Exception as e:
+        logger.error(f"Не удалось показать страницу поиска: {e}")
+    await abot.answer_callback_query(call.id)
+
+@abot.message_handler(func=lambda m: get_sender(m).active_order is not None and not m.text.startswith('#'))
+async def handle_buyer_message(message):
+    user_id = message.from_user.id
+    order = get_sender(message).active_order
+    if not order:
+        return
+
+    await save_message(order['id'], user_id, 'buyer', message.text)
+
+    if order['seller_telegram_id'] is not None:
+        await send_queue.send_message(
+            order['seller_telegram_id'],
+            f"💬 Сообщение от покупателя (заказ {order['order_number']}):\n\n{message.text}"
+        )
+    else:
+        logger.error(f"Продавец с id {order['seller_id']} не найден в таблице sellers")
+
+    if core.ADMIN_ID and order['seller_id'] != core.ADMIN_ID:
+        await copy_to_admin(
+            digest_events.BUYER_MESSAGE,
+            order['order_number'],
+            f"📩 [Копия] Покупатель {order['contact']['name']} (заказ {order['order_number']}):\n{message.text}",
+            summary=f"📩 Покупатель {order['contact']['name']}: {message.text}"
+        )
+
+    await abot.reply_to(message, "✅ Сообщение отправлено.")
+
+@abot.message_handler(func=lambda m: get_sender(m).is_staff and m.text.startswith('#'))
+async def handle_seller_message(message):
+    user_id = message.from_user.id
+    sender = get_sender(message)
+    seller = sender.seller
+    text = message.text.strip()
+
+    try:
+        parts = text[1:].split(' ', 1)
+        order_num = parts[0]
+        reply_text = parts[1] if len(parts) > 1 else ""
+        if not reply_text:
+            await abot.reply_to(message, "❌ Вы не написали текст сообщения.")
+            return
+
+        order = await get_order_by_number(order_num)
+        if not order:
+            await abot.reply_to(message, f"❌ Заказ {order_num} не найден.")
+            return
+
+        if not sender.is_admin:
+            if not seller or order['seller_id'] != seller['id']:
+                await abot.reply_to(message, "❌ Этот заказ не ваш.")
+                return
+
+        await save_message(order['id'], user_id, sender.role, reply_text)
+
+        await send_queue.send_message(
+            order['user_id'],
+            f"💬 Сообщение от {'администратора' if sender.is_admin else 'продавца'} (заказ {order_num}):\n\n{reply_text}"
+        )
+        if core.ADMIN_ID and not sender.is_admin:
+            seller_name = seller['name'] if seller else "Неизвестный продавец"
+            await copy_to_admin(
+                digest_events.SELLER_MESSAGE,
+                order_num,
+                f"📩 [Копия] Продавец {seller_name} (заказ {order_num}):\n{reply_text}",
+                summary=f"📩 Продавец {seller_name}: {reply_text}"
+            )
+
+        await abot.reply_to(message, f"✅ Сообщение отправлено покупателю (заказ {order_num}).",
+                            reply_markup=core.admin_keyboard() if sender.is_admin else core.seller_keyboard())
+
+    except Exception as e:
+        logger.error(f"Ошибка обработки сообщения: {e}", exc_info=True)
+        await abot.reply_to(message, "❌ Ошибка. Используйте формат: #А1 текст сообщения")
+
+async def _order_for_action(call, order_num: str):
+    """Заказ для кнопок «Завершить»/«Отменить» или None, если действие недоступно (ответ уже дан)"""
+    order = await get_order_by_number(order_num)
+    if not order:
+        logger.error(f"Заказ {order_num} не найден")
+        await abot.answer_callback_query(call.id, "❌ Заказ не найден")
+        return None
+
+    sender = get_sender(call)
+    if not sender.is_admin:
+        if not sender.seller or order['seller_id'] != sender.seller['id']:
+            logger.error(f"Заказ {order_num} не принадлежит пользователю {call.from_user.id}")
+            await abot.answer_callback_query(call.id, "❌ Этот заказ не ваш")
+            return None
+
+    if order['status'] != OrderStatus.ACTIVE:
+        logger.error(f"Заказ {order_num} уже не активен (статус: {order['status']})")
+        await abot.answer_callback_query(call.id, "❌ Заказ уже не активен")
+        try:
+            await abot.edit_message_reply_markup(call.from_user.id, call.message.message_id, reply_markup=None)
+        except Exception:
+            pass
+        return None
+    return order
+
+def _actor_name(sender) -> str:
+    if sender.is_admin:
+        return "Администратор"
+    return sender.seller['name'] if sender.seller else "Неизвестный продавец"
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('complete_'))
+async def handle_seller_complete(call):
+    order_num = call.data.split('_')[1]
+    order = await _order_for_action(call, order_num)
+    if order is None:
+        return
+
+    await complete_order(order['id'], order_num)
+    logger.info(f"Заказ {order_num} завершён в БД")
+
+    await send_queue.send_message(order['user_id'], f"✅ Ваш заказ {order_num} выполнен. Спасибо за покупку!")
+    if core.ADMIN_ID:
+        actor = _actor_name(get_sender(call))
+        await copy_to_admin(digest_events.COMPLETED, order_num, f"✅ {actor} завершил заказ {order_num}.",
+                            summary=f"✅ {actor} завершил заказ")
+
+    try:
+        await abot.edit_message_text(f"✅ Заказ {order_num} завершён.", call.message.chat.id,
+                                     call.message.message_id, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Не удалось отредактировать сообщение: {e}")
+
+    await abot.answer_callback_query(call.id, "✅ Заказ завершён")
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('cancel_'))
+async def handle_cancel_order(call):
+    order_num = call.data.split('_')[1]
+    order = await _order_for_action(call, order_num)
+    if order is None:
+        return
+
+    await update_order_status(order['id'], OrderStatus.CANCELLED)
+    logger.info(f"Заказ {order_num} отменён")
+
+    try:
+        await abot.edit_message_text(f"❌ *Заказ {order_num} отменён.*", call.message.chat.id,
+                                     call.message.message_id, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Не удалось отредактировать сообщение: {e}")
+
+    await send_queue.send_message(order['user_id'], f"❌ *Ваш заказ {order_num} отменён продавцом.*",
+                                  parse_mode='Markdown')
+    if core.ADMIN_ID:
+        actor = _actor_name(get_sender(call))
+        await copy_to_admin(digest_events.CANCELLED, order_num, f"❌ {actor} отменил заказ {order_num}.",
+                            summary=f"❌ {actor} отменил заказ")
+
+    await abot.answer_callback_query(call.id, "✅ Заказ отменён")
+
+@abot.message_handler(func=lambda m: True)
+async def fallback_handler(message):
+    sender = get_sender(message)
+    if sender.seller:
+        await abot.send_message(message.chat.id, "Используйте кнопки или начните новый заказ в нашем мини-аппе.",
+                                reply_markup=core.seller_keyboard())
+    elif sender.is_admin:
+        await abot.send_message(message.chat.id, "Используйте кнопки администратора.", reply_markup=core.admin_keyboard())
+    else:
+        await abot.send_message(message.chat.id, "Если у вас есть вопросы, напишите продавцу.")
+
+@core.metrics.track_update
+async def process_update(update):
+    await abot.process_new_updates([update])
+
+core.metrics.instrument_handlers(abot)
+
+# Апдейты разных чатов ждут I/O одновременно, одного чата — по порядку
+update_executor = AsyncOrderedExecutor(process_update, max_pending=core.ASYNC_MAX_UPDATES)
+
+# Те же имена, что у синхронного режима, — панели мониторинга не меняются
+core.metrics.add_gauge('bot_send_queue_pending', 'Messages waiting in the send queue', lambda: send_queue.pending)
+core.metrics.add_gauge('bot_update_queue_pending', 'Updates in progress or waiting for their chat', lambda: update_executor.pending)
+core.metrics.add_gauge('bot_db_pool_connections', 'Open connections in the DB pool',
+                       lambda: _db_pool.get_stats()['pool_size'] if _db_pool else 0)
+core.metrics.add_gauge('bot_admin_digest_pending', 'Admin copy events waiting for the next digest',
+                       lambda: admin_digest.pending)
+
+# ========== Новые заказы ==========
+async def queue_order_notification(order_ids, chat_id, text: str, **kwargs):
+    await send_queue.send_message(chat_id, text, on_sent=lambda: mark_orders_notified(order_ids), **kwargs)
+
+async def notify_new_order(order_id: int, order_number: str, seller: dict, data: dict, contact: dict):
+    """Ставит в очередь уведомления о новом заказе продавцу, админу и покупателю; как bot.notify_new_order"""
+    messages = core.new_order_messages(order_number, seller, data, contact)
+    await queue_order_notification([order_id], seller['telegram_id'], messages['seller'], parse_mode='Markdown',
+                                   reply_markup=core.order_actions_markup([order_number]))
+    if core.ADMIN_ID and seller['telegram_id'] != core.ADMIN_ID:
+        await copy_to_admin(digest_events.NEW_ORDER, order_number, messages['admin'],
+                            summary=messages['admin_summary'], parse_mode='Markdown')
+    await send_queue.send_message(data.get('userId'), messages['buyer'], parse_mode='Markdown')
+
+async def notify_new_orders(placed):
+    """Уведомления о пачке заказов: сводка продавцу и админу, подтверждения покупателям; как bot.notify_new_orders"""
+    for seller_chat, entries in core.orders_by_seller(placed).items():
+        if len(entries) == 1:
+            await notify_new_order(*entries[0])
+            continue
+        messages = [core.new_order_messages(*entry[1:]) for entry in entries]
+        for group in core._group_messages([m['seller'] for m in messages]):
+            await queue_order_notification(
+                [entries[i][0] for i in group],
+                seller_chat,
+                core.ORDER_SEPARATOR.join(messages[i]['seller'] for i in group),
+                parse_mode='Markdown',
+                reply_markup=core.order_actions_markup([entries[i][1] for i in group])
+            )
+
+        if core.ADMIN_ID and seller_chat != core.ADMIN_ID and admin_digest.buffers(digest_events.NEW_ORDER):
+            for entry, message in zip(entries, messages):
+                admin_digest.add(digest_events.NEW_ORDER, entry[1], message['admin'],
+                                 summary=message['admin_summary'], parse_mode='Markdown')
+        elif core.ADMIN_ID and seller_chat != core.ADMIN_ID:
+            for group in core._group_messages([m['admin'] for m in messages]):
+                await send_queue.send_message(core.ADMIN_ID, core.ORDER_SEPARATOR.join(messages[i]['admin'] for i in group),
+                                              parse_mode='Markdown')
+
+        for entry, message in zip(entries, messages):
+            await send_queue.send_message(entry[3].get('userId'), message['buyer'], parse_mode='Markdown')
+
+async def resolve_order_route(delivery: str, address: str) -> tuple:
+    if delivery == 'courier':
+        return core.order_route(delivery, address, admin_seller=await get_seller_by_telegram_id(core.ADMIN_ID))
+    return core.order_route(delivery, address, pickup_info=await get_pickup_location_info(address))
+
+async def create_order(data: dict):
+    """Создаёт заказ из данных мини-аппа; возвращает (тело ответа, HTTP-код). Логика — как у bot.create_order"""
+    request_id = data.get('requestId')
+
+    error = core.validate_order(data)
+    if error:
+        return error
+
+    existing = await get_order_by_request_id(request_id) if request_id else None
+    if existing and existing['order_number'] and existing['notified_bool']:
+        logger.info(f"Повтор запроса {request_id}: заказ {existing['order_number']} уже оформлен")
+        return {'status': 'ok', 'orderNumber': existing['order_number']}, 200
+
+    route, error = await resolve_order_route(data.get('deliveryType'), data.get('address'))
+    if error:
+        return error
+    seller, prefix, address_id = route
+
+    if existing:
+        # Заказ уже создан, но уведомления не успели уйти (или это старая запись без номера)
+        order_id = existing['id']
+        order_number = existing['order_number']
+        if not order_number:
+            order_number = await assign_order_number(order_id, prefix)
+            logger.info(f"Обновлён заказ {order_id} с новым номером {order_number}")
+        if not existing['notified_bool']:
+            await notify_new_order(order_id, order_number, seller, data, existing['contact'] or data.get('contact') or {})
+        return {'status': 'ok', 'orderNumber': order_number}, 200
+
+    order_data, contact = core.new_order_record(data, seller, address_id)
+    placed = await place_order(order_data, prefix, contact, request_id)
+    if placed is None:
+        # Параллельный запрос с тем же requestId успел раньше
+        existing = await get_order_by_request_id(request_id)
+        if not existing:
+            return {'error': 'Order conflict'}, 409
+        logger.info(f"Заказ с request_id {request_id} уже создан параллельным запросом: {existing['order_number']}")
+        return {'status': 'ok', 'orderNumber': existing['order_number']}, 200
+    order_id, order_number = placed
+    logger.info(f"Заказ {order_number} сохранён с ID {order_id} (seller_id={seller['id']})")
+
+    await notify_new_order(order_id, order_number, seller, data, contact)
+    return {'status': 'ok', 'orderNumber': order_number}, 200
+
+async def create_orders(orders: list) -> dict:
+    """Создаёт пачку заказов; возвращает тело ответа. Логика — как у bot.create_orders"""
+    batch = core.OrderBatch(orders)
+    ok, failed = batch.ok, batch.failed
+
+    existing = await get_orders_by_request_ids(list(batch.first_by_request))
+    to_place = []
+    for index in batch.fresh:
+        data = orders[index]
+        found = existing.get(data.get('requestId'))
+        if found and found['order_number'] and found['notified_bool']:
+            ok(index, found['order_number'])
+            continue
+        if found:
+            # Недоотправленный старый заказ — обычный путь досылает номер и уведомления
+            body, code = await create_order(data)
+            if code == 200:
+                ok(index, body['orderNumber'])
+            else:
+                failed(index, (body, code))
+            continue
+        route, error = await resolve_order_route(data.get('deliveryType'), data.get('address'))
+        if error:
+            failed(index, error)
+            continue
+        seller, prefix, address_id = route
+        order_data, contact = core.new_order_record(data, seller, address_id)
+        to_place.append((index, seller, order_data, prefix, contact))
+
+    if to_place:
+        try:
+            placed = await place_orders([
+                (order_data, prefix, contact, orders[index].get('requestId'))
+                for index, seller, order_data, prefix, contact in to_place
+            ])
+        except Exception as e:
+            logger.exception(f"❌ Ошибка сохранения пачки из {len(to_place)} заказов")
+            for index, *_ in to_place:
+                failed(index, ({'error': str(e)}, 500))
+        else:
+            created = []
+            for (index, seller, order_data, prefix, contact), result in zip(to_place, placed):
+                if result is None:
+                    # requestId успел занять параллельный запрос
+                    found = await get_order_by_request_id(orders[index].get('requestId'))
+                    if found:
+                        ok(index, found['order_number'])
+                    else:
+                        failed(index, ({'error': 'Order conflict'}, 409))
+                    continue
+                order_id, order_number = result
+                ok(index, order_number)
+                created.append((order_id, order_number, seller, orders[index], contact))
+            logger.info(f"Пачка заказов: создано {len(created)} из {len(orders)}")
+            # Уведомления уходят только после коммита всей пачки
+            await notify_new_orders(created)
+
+    return batch.finish()
+
+# ========== HTTP ==========
+class Request:
+    __slots__ = ('scope', 'body', 'headers')
+
+    def __init__(self, scope, body: bytes):
+        self.scope = scope
+        self.body = body
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+    @property
+    def args(self) -> dict:
+        """Параметры строки запроса, как request.args во Flask (для повторов — последнее значение)"""
+        return dict(parse_qsl(self.scope.get('query_string', b'').decode('latin-1')))
+
+    def json(self) -> tuple:
+        """Тело как JSON: (данные, None) или (None, (тело ошибки, 415 или 400)), как bot.request_json"""
+        return core.json_body(self.headers.get('content-type'), self.body)
+
+async def index(request):
+    return '🤖 Бот работает'
+
+async def metrics_endpoint(request):
+    if not core.METRICS_ENABLED:
+        return 'Not Found', 404
+    return core.metrics.expose(), 200, 'text/plain; version=0.0.4; charset=utf-8'
+
+async def is_new_update(update_id) -> bool:
+    if core.UPDATE_DEDUP_DB:
+        # Отметка в БД идёт через синхронный пул дедупликатора в отдельном потоке
+        return await asyncio.to_thread(core.update_dedup.is_new, update_id)
+    return core.update_dedup.is_new(update_id)
+
+async def webhook(request):
+    data, error = request.json()
+    if error or not isinstance(data, dict):
+        return 'Bad Request', 400
+    update_id = data.get('update_id')
+    if update_id is not None and not await is_new_update(update_id):
+        logger.info(f"Повторная доставка апдейта {update_id} пропущена")
+        return ''
+    update = types.Update.de_json(data)
+    if not update_executor.submit(update_chat_id(update), update):
+        if core.UPDATE_DEDUP_DB:
+            await asyncio.to_thread(core.update_dedup.forget, update_id)
+        else:
+            core.update_dedup.forget(update_id)
+        # Telegram повторит доставку позже
+        return 'Busy', 503
+    return ''
+
+async def new_order(request):
+    data, error = request.json()
+    if error:
+        return error
+    try:
+        if not data:
+            return {'error': 'No data'}, 400
+
+        request_id = data.get('requestId')
+        if request_id:
+            # Память повторов общая с синхронным режимом: тот же IdempotentRequests
+            return await core.order_requests.run_async(
+                request_id,
+                lambda: create_order(data),
+                cacheable=lambda result: result[1] == 200
+            )
+        return await create_order(data)
+
+    except Exception as e:
+        logger.exception("❌ Ошибка в /api/new-order")
+        return {'error': str(e)}, 500
+
+async def new_orders(request):
+    data, error = request.json()
+    if error:
+        return error
+    try:
+        orders, error = core.parse_order_batch(data)
+        if error:
+            return error
+        return await create_orders(orders)
+
+    except Exception as e:
+        logger.exception("❌ Ошибка в /api/new-orders")
+        return {'error': str(e)}, 500
+
+async def order_cancelled(request):
+    data, error = request.json()
+    if error:
+        return error
+    try:
+        if not data:
+            return {'error': 'No data'}, 400
+
+        order_id = data.get('orderId')
+        order_number = data.get('orderNumber')
+        seller_id = data.get('sellerId')
+
+        if not all([order_id, seller_id, order_number]):
+            logger.error(f"Missing fields: orderId={order_id}, sellerId={seller_id}, orderNumber={order_number}")
+            return {'error': 'Missing fields'}, 400
+
+        core.order_cards.bump(order_id)
+
+        seller = await get_seller_by_id(seller_id)
+        if not seller:
+            return {'error': 'Seller not found'}, 404
+
+        await send_queue.send_message(seller['telegram_id'], f"❌ *Заказ {order_number} отменён покупателем.*",
+                                      parse_mode='Markdown')
+        if core.ADMIN_ID and seller['telegram_id'] != core.ADMIN_ID:
+            await copy_to_admin(
+                digest_events.CANCELLED,
+                order_number,
+                f"❌ *Заказ {order_number} отменён покупателем.*\nПродавец: {seller['name']}",
+                summary=f"❌ Отменён покупателем, продавец {seller['name']}",
+                parse_mode='Markdown'
+            )
+        return {'status': 'ok'}
+
+    except Exception as e:
+        logger.exception("Ошибка в /api/order-cancelled")
+        return {'error': str(e)}, 500
+
+async def orders_search(request):
+    user_id = core.webapp_user_id(request.headers.get('x-telegram-init-data'))
+    if user_id is None:
+        return {'error': 'Unauthorized'}, 401
+    if not core.search_ready:
+        return {'error': 'Search is not available'}, 503
+    args, error = core.parse_search_args(request.args)
+    if error:
+        return error
+    query, offset, limit = args
+
+    sender = await resolve_sender(user_id, with_buyer_order=False)
+    if not sender.is_staff:
+        return {'error': 'Forbidden'}, 403
+
+    orders, has_next = await search_orders(query, core.search_scope(sender), offset, limit)
+    return core.search_response(orders, has_next, offset, limit)
+
+ROUTES = {
+    ('GET', '/'): index,
+    ('GET', '/metrics'): metrics_endpoint,
+    ('POST', '/webhook'): webhook,
+    ('POST', '/api/new-order'): new_order,
+    ('POST', '/api/new-orders'): new_orders,
+    ('POST', '/api/order-cancelled'): order_cancelled,
+    ('GET', '/api/orders/search'): orders_search,
+}
+UNTRACKED_ROUTES = {'/metrics'}
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def _respond(send, body, status=200, content_type=None):
+    if isinstance(body, (dict, list)):
+        payload = json.dumps(body).encode()
+        content_type = content_type or 'application/json'
+    else:
+        payload = str(body).encode()
+        content_type = content_type or 'text/html; charset=utf-8'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(payload)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+async def app(scope, receive, send):
+    """ASGI-приложение: маршруты и ответы — как у Flask-приложения из bot.py"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    route = ROUTES.get((scope['method'], path))
+    if route is None:
+        allowed = any(route_path == path for _, route_path in ROUTES)
+        await _respond(send, 'Method Not Allowed' if allowed else 'Not Found', 405 if allowed else 404)
+        return
+
+    request = Request(scope, await _read_body(receive))
+    tracked = core.metrics.enabled and path not in UNTRACKED_ROUTES
+    if tracked:
+        core.metrics.begin('route', path)
+    status = 500
+    try:
+        # Как во Flask: тело, (тело, код) или (тело, код, Content-Type)
+        result = await route(request)
+        if not isinstance(result, tuple):
+            result = (result, 200)
+        body, status = result[:2]
+        content_type = result[2] if len(result) > 2 else None
+    except Exception as e:
+        logger.exception(f"Ошибка обработки {path}: {e}")
+        body, content_type = 'Internal Server Error', None
+    finally:
+        if tracked:
+            core.metrics.end(f"{status // 100}xx")
+    await _respond(send, body, status, content_type)
+
+# ========== Запуск ==========
+async def startup():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    if core.SCHEMA_BOOTSTRAP:
+        try:
+            await asyncio.to_thread(schema.bootstrap, core.DATABASE_URL)
+        except Exception as e:
+            logger.exception(f"Ошибка проверки схемы БД: {e}")
+    await asyncio.to_thread(core.check_schema)
+    await open_db_pool()
+    core.outbox.start()
+
+async def shutdown():
+    await update_executor.join()
+    # Остаток сводки — в очередь до её остановки
+    await asyncio.to_thread(admin_digest.stop)
+    await send_queue.stop()
+    if _db_pool is not None:
+        await _db_pool.close()
+    await abot.close_session()
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as e:
+                logger.exception("Не удалось запустить асинхронный режим")
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def set_webhook():
+    try:
+        await abot.remove_webhook()
+        await abot.set_webhook(url=core.WEBHOOK_URL)
+        logger.info(f"Webhook set to {core.WEBHOOK_URL}")
+    finally:
+        # Сессия aiohttp привязана к этому циклу событий; сервер откроет свою
+        await abot.close_session()
+
+def main():
+    import uvicorn
+    asyncio.run(set_webhook())
+    uvicorn.run(app, host='0.0.0.0', port=core.PORT, log_level='info')
+
+if __name__ == '__main__':
+    main()
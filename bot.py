@@ -1,230 +1,95 @@
-import os
-import json
+import sys
 import logging
-import requests
-from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import telebot
-from telebot import types
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
-
-# Настраиваем логирование для telebot
-telebot.logger.setLevel(logging.INFO)
-
-load_dotenv()
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-DATABASE_URL = os.getenv('DATABASE_URL')
-ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
-PORT = int(os.getenv('PORT', 10000))
-STOCK_BOT_URL = os.getenv('STOCK_BOT_URL')
-
-if not BOT_TOKEN or not DATABASE_URL:
-    raise ValueError("Не заданы обязательные переменные окружения")
-
-bot = telebot.TeleBot(BOT_TOKEN)
+from telebot import apihelper
+from telebot.handler_backends import BaseMiddleware
+
+import core
+from core import (
+    ADMIN_ID, BOT_TOKEN, DATABASE_URL, PORT, BOT_RUNTIME, SCHEMA_BOOTSTRAP, METRICS_ENABLED, WEBHOOK_URL,
+    SEND_QUEUE_WORKERS, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_RATE,
+    UPDATE_WORKERS, UPDATE_QUEUE_SIZE, TELEGRAM_MESSAGE_LIMIT,
+    TELEGRAM_HTTP_POOL_SIZE, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT, TELEGRAM_HTTP_RETRIES,
+    ADMIN_DIGEST_INTERVAL, ADMIN_DIGEST_MAX_EVENTS, ADMIN_DIGEST_URGENT,
+    FIND_USAGE, SEARCH_UNAVAILABLE, ORDER_SEPARATOR,
+    metrics, outbox, order_cards, order_id_by_number, order_requests, update_dedup,
+    get_seller_by_id, get_sellers_directory, place_order, assign_order_number, place_orders,
+    mark_orders_notified, update_order_status, get_order_by_number, get_order_by_request_id,
+    get_orders_by_request_ids, complete_order, get_messages_for_order, parse_history_cursor, save_message,
+    resolve_sender, get_sender, search_orders, search_scope, seller_keyboard, admin_keyboard,
+    parse_orders_callback, active_orders_view, parse_search_callback, search_orders_view,
+    search_query_from_command, parse_search_args, webapp_user_id, search_response,
+    sellers_filter_markup, render_order_card, json_body, new_order_messages, order_actions_markup,
+    _group_messages, orders_by_seller, parse_order_batch, OrderBatch, validate_order, resolve_order_route, new_order_record, check_schema
+)
+
+if __name__ == '__main__' and BOT_RUNTIME == 'async':
+    # Асинхронный режим целиком живёт в async_app: синхронный стек ниже ему не нужен
+    import async_app
+    async_app.main()
+    sys.exit()
+
+from send_queue import SendQueue
+from admin_digest import AdminDigest
+import admin_digest as digest_events
+from telegram_transport import TelegramTransport
+from update_executor import OrderedExecutor, update_chat_id
+from cache import MISSING
+import schema
+from schema import OrderStatus
+
+# Хэндлеры выполняются в потоке update_executor, а не во внутреннем пуле telebot,
+# иначе апдейты одного чата могли бы обрабатываться не по порядку
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False, use_class_middlewares=True)
+metrics.instrument_telegram(apihelper)
+# Потоки обработчиков, очередь отправки и Flask ходят в Telegram через один пул соединений
+telegram_transport = TelegramTransport(
+    pool_size=TELEGRAM_HTTP_POOL_SIZE,
+    connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+    read_timeout=TELEGRAM_READ_TIMEOUT,
+    retries=TELEGRAM_HTTP_RETRIES
+)
+telegram_transport.install(apihelper)
+# Уведомления другим участникам заказа уходят через очередь, не блокируя обработчики
+send_queue = SendQueue(
+    bot,
+    workers=SEND_QUEUE_WORKERS,
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    group_rate=TELEGRAM_GROUP_RATE
+)
+metrics.instrument_send_queue(send_queue)
+# Копии переписки и событий по заказам для администратора, по одной или сводкой
+admin_digest = AdminDigest(
+    lambda text, **kwargs: send_queue.send_message(ADMIN_ID, text, **kwargs),
+    interval=ADMIN_DIGEST_INTERVAL,
+    max_events=ADMIN_DIGEST_MAX_EVENTS,
+    urgent=ADMIN_DIGEST_URGENT,
+    limit=TELEGRAM_MESSAGE_LIMIT
+)
 app = Flask(__name__)
+metrics.instrument_flask(app)
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-BASE_URL = os.getenv('RENDER_EXTERNAL_URL', 'https://dp-sbor-miniapp-bot.onrender.com')
-WEBHOOK_URL = f"{BASE_URL}/webhook"
-
-def escape_markdown(text):
-    """Экранирует специальные символы Markdown"""
-    if not text:
-        return text
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in special_chars:
-        text = text.replace(char, '\\' + char)
-    return text
-
-def parse_contact(contact_json):
-    if isinstance(contact_json, dict):
-        return contact_json
-    try:
-        return json.loads(contact_json)
-    except:
-        return {}
+class SenderContextMiddleware(BaseMiddleware):
+    """Определяет роль отправителя до фильтров, чтобы фильтры не ходили в БД"""
 
-def parse_items(items_json):
-    if isinstance(items_json, list):
-        return items_json
-    try:
-        return json.loads(items_json)
-    except:
-        return []
-
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-
-def get_pickup_location_info(address: str):
-    """Возвращает информацию о точке самовывоза по адресу"""
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT pl.seller_id, pl.prefix, s.telegram_id, s.name
-                FROM pickup_locations pl
-                JOIN sellers s ON pl.seller_id = s.id
-                WHERE pl.address = %s
-            """, (address,))
-            return cur.fetchone()
-
-def get_seller_by_telegram_id(telegram_id: int):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM sellers WHERE telegram_id = %s", (telegram_id,))
-            return cur.fetchone()
-
-def get_seller_by_id(seller_id: int):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM sellers WHERE id = %s", (seller_id,))
-            return cur.fetchone()
-
-def get_admin_seller():
-    """Возвращает запись продавца-администратора по ADMIN_ID"""
-    seller = get_seller_by_telegram_id(ADMIN_ID)
-    logger.info(f"get_admin_seller() вызван, ADMIN_ID={ADMIN_ID}, результат: {seller}")
-    return seller
-
-def generate_order_number(prefix: str) -> str:
-    """Генерирует номер заказа для указанного префикса"""
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            # Обрезаем до 3 символов, если нужно
-            if len(prefix) > 3:
-                prefix = prefix[:3]
-            
-            # Получаем последний номер для этого префикса
-            cur.execute("""
-                SELECT order_number FROM orders 
-                WHERE order_number LIKE %s 
-                ORDER BY id DESC LIMIT 1
-            """, (prefix + '%',))
-            
-            last = cur.fetchone()
-            if last:
-                num_str = last['order_number'][len(prefix):]
-                if num_str.isdigit():
-                    new_num = int(num_str) + 1
-                else:
-                    new_num = 1
-            else:
-                new_num = 1
-            
-            return f"{prefix}{new_num}"
-
-def save_order(order_data: dict, contact: dict, request_id: str = None):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            items_json = json.dumps(order_data['items'])
-            contact_json = json.dumps(contact)
-            cur.execute("""
-                INSERT INTO orders (order_number, user_id, seller_id, address_id, items, total, contact, status, request_id, notified_bool, delivery_type)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                order_data['order_number'],
-                order_data['user_id'],
-                order_data['seller_id'],
-                order_data.get('address_id'),
-                items_json,
-                order_data['total'],
-                contact_json,
-                order_data['status'],
-                request_id,
-                False,
-                order_data.get('delivery_type')
-            ))
-            order_id = cur.fetchone()['id']
-            conn.commit()
-            return order_id
-
-def update_order_status(order_id: int, status: str):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE orders SET status = %s WHERE id = %s",
-                (status, order_id)
-            )
-            conn.commit()
-
-def get_active_order_by_buyer(buyer_id: int):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM orders WHERE user_id = %s AND status IN ('active', 'Активный')", (buyer_id,))
-            order = cur.fetchone()
-            if order:
-                order['contact'] = parse_contact(order['contact'])
-                order['items'] = parse_items(order['items'])
-            return order
-
-def get_active_orders_by_seller(seller_id: int):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM orders WHERE seller_id = %s AND status IN ('active', 'Активный')", (seller_id,))
-            orders = cur.fetchall()
-            for o in orders:
-                o['contact'] = parse_contact(o['contact'])
-                o['items'] = parse_items(o['items'])
-            return orders
-
-def get_order_by_number(order_number: str):
-    logger.info(f"🔍 get_order_by_number: ищем заказ с номером '{order_number}'")
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM orders WHERE order_number = %s", (order_number,))
-            order = cur.fetchone()
-            if order:
-                order['contact'] = parse_contact(order['contact'])
-                order['items'] = parse_items(order['items'])
-            return order
-
-def complete_order(order_id: int):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("UPDATE orders SET status = 'completed', completed_at = %s WHERE id = %s",
-                        (datetime.utcnow().isoformat(), order_id))
-            conn.commit()
-
-def get_messages_for_order(order_id: int):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT sender_role, text, created_at 
-                FROM messages 
-                WHERE order_id = %s 
-                ORDER BY created_at ASC
-            """, (order_id,))
-            return cur.fetchall()
-
-def save_message(order_id: int, sender_id: int, sender_role: str, text: str):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO messages (order_id, sender_id, sender_role, text)
-                VALUES (%s, %s, %s, %s)
-            """, (order_id, sender_id, sender_role, text))
-            conn.commit()
-
-def is_admin(telegram_id: int) -> bool:
-    return telegram_id == ADMIN_ID
-
-# ========== Клавиатуры ==========
-def seller_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton("📋 Мои активные заказы"))
-    return keyboard
-
-def admin_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton("📋 Мои активные заказы"))
-    return keyboard
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, update, data):
+        data['sender'] = get_sender(update)
+
+    def post_process(self, update, data, exception):
+        pass
 
 # ========== Хэндлеры ==========
+bot.setup_middleware(SenderContextMiddleware())
+
 @bot.message_handler(commands=['start'])
 def handle_start(message):
     user_id = message.from_user.id
@@ -239,14 +104,14 @@ def handle_start(message):
         )
         return
 
-    seller = get_seller_by_telegram_id(user_id)
-    if seller:
+    sender = get_sender(message)
+    if sender.seller:
         bot.send_message(
             user_id,
             "👋 Добро пожаловать! Здесь будут ваши заказы и общение с покупателями.",
             reply_markup=seller_keyboard()
         )
-    elif is_admin(user_id):
+    elif sender.is_admin:
         bot.send_message(
             user_id,
             "👋 Добро пожаловать в панель администратора!",
@@ -261,158 +126,113 @@ def handle_start(message):
 @bot.message_handler(func=lambda m: m.text == "📋 Мои активные заказы")
 def handle_my_orders(message):
     logger.info("handle_my_orders вызван")
-    user_id = message.from_user.id
-    seller = get_seller_by_telegram_id(user_id)
+    sender = get_sender(message)
     
-    if not seller and not is_admin(user_id):
+    if not sender.is_staff:
         bot.reply_to(message, "❌ У вас нет доступа к этой функции.")
         return
 
-    if is_admin(user_id):
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT * FROM orders 
-                    WHERE status IN ('active', 'Активный') 
-                    ORDER BY id DESC
-                """)
-                orders = cur.fetchall()
-                for o in orders:
-                    o['contact'] = parse_contact(o['contact'])
-                    o['items'] = parse_items(o['items'])
-        
-        if not orders:
-            bot.reply_to(message, "Нет активных заказов.")
-            return
-            
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        for order in orders:
-            seller_name = "Неизвестный"
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT name FROM sellers WHERE id = %s", (order['seller_id'],))
-                    s = cur.fetchone()
-                    if s:
-                        seller_name = s['name']
-            
-            callback_data = f"view_order_{order['order_number']}"
-            markup.add(types.InlineKeyboardButton(
-                f"Заказ {order['order_number']} ({seller_name})",
-                callback_data=callback_data
-            ))
-        
-        bot.send_message(
-            message.chat.id,
-            "📋 *Все активные заказы:*\nВыберите заказ для просмотра деталей и истории сообщений.",
-            parse_mode='Markdown',
-            reply_markup=markup
-        )
+    text, markup = active_orders_view(sender)
+    if markup is None:
+        bot.reply_to(message, text)
         return
 
-    orders = get_active_orders_by_seller(seller['id'])
-    if not orders:
-        bot.reply_to(message, "У вас нет активных заказов.")
-        return
-
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for order in orders:
-        callback_data = f"view_order_{order['order_number']}"
-        logger.info(f"Создаём кнопку с callback_data: {callback_data}")
-        markup.add(types.InlineKeyboardButton(
-            f"Заказ {order['order_number']}",
-            callback_data=callback_data
-        ))
     bot.send_message(
         message.chat.id,
-        "📋 *Ваши активные заказы:*\nВыберите заказ для просмотра деталей и истории сообщений.",
+        text,
         parse_mode='Markdown',
         reply_markup=markup
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('view_order_'))
-def view_order(call):
-    user_id = call.from_user.id
-    order_num = call.data.split('_')[2]
-    logger.info(f"view_order вызван для заказа {order_num} пользователем {user_id}")
-    
-    order = get_order_by_number(order_num)
-    if not order:
-        logger.error(f"Заказ {order_num} не найден")
-        bot.answer_callback_query(call.id, "❌ Заказ не найден")
+@bot.callback_query_handler(func=lambda call: call.data.startswith('orders:'))
+def orders_page(call):
+    sender = get_sender(call)
+    if not sender.is_staff:
+        bot.answer_callback_query(call.id, "❌ Ошибка доступа")
         return
-    
-    if not is_admin(user_id):
-        seller = get_seller_by_telegram_id(user_id)
-        if not seller or order['seller_id'] != seller['id']:
-            bot.answer_callback_query(call.id, "❌ У вас нет прав для просмотра этого заказа")
-            return
-    
-    logger.info("Заказ получен, приступаем к формированию данных")
-    
-    try:
-        messages = get_messages_for_order(order['id'])
-        logger.info(f"Получено сообщений: {len(messages)}")
-    except Exception as e:
-        logger.exception(f"Ошибка при получении сообщений: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка получения истории")
-        return
-    
-    contact = order['contact']
-    logger.info("Формируем текст заказа")
+
+    text, markup = active_orders_view(sender, *parse_orders_callback(call.data))
     try:
-        items_text = "\n".join([
-            f"• {item['name']} ({item.get('variantName', '')}) x{item['quantity']} = {item['price']*item['quantity']} руб."
-            for item in order['items']
-        ])
-        delivery_text = "Самовывоз" if order.get('delivery_type') == 'pickup' else "Доставка"
-        
-        username_raw = contact.get('username', 'не указан')
-        username_escaped = escape_markdown(username_raw)
-        username_display = f"@{username_escaped}" if username_raw != 'не указан' else "@не указан"
-        
-        name_escaped = escape_markdown(contact.get('name', 'Неизвестно'))
-        address_escaped = escape_markdown(contact.get('address', 'Не указан'))
-        phone_escaped = escape_markdown(contact.get('phone', 'Не указан'))
-        
-        info = (
-            f"📦 *Заказ {order_num}*\n\n"
-            f"👤 Покупатель: {name_escaped}\n"
-            f"📍 Адрес: {address_escaped}\n"
-            f"📞 Телефон: {phone_escaped}\n"
-            f"📱 Username: {username_display}\n"
-            f"💳 Оплата: {'Наличные' if contact.get('paymentMethod') == 'cash' else 'Перевод'}\n"
-            f"🚚 Доставка: {delivery_text}\n\n"
-            f"📝 *Состав заказа:*\n{items_text}\n\n"
-            f"💰 *Итого: {order['total']} руб.*\n"
+        bot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode='Markdown' if markup else None,
+            reply_markup=markup
         )
-        logger.info("Текст заказа сформирован")
-        
-        if messages:
-            history_lines = []
-            for msg in messages:
-                sender = '👤 Покупатель' if msg['sender_role'] == 'buyer' else '🛒 Продавец'
-                msg_text_escaped = escape_markdown(msg['text'])
-                created_str = msg['created_at'].strftime('%Y-%m-%d %H:%M') if msg['created_at'] else ''
-                history_lines.append(f"{sender} ({created_str}): {msg_text_escaped}")
-            history = "\n".join(history_lines)
-            info += f"\n💬 *История переписки:*\n{history}"
-        else:
-            info += "\n💬 *История переписки:*\nПока нет сообщений."
-        logger.info("История переписки добавлена")
     except Exception as e:
-        logger.exception(f"Ошибка при формировании текста: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка формирования данных")
+        logger.error(f"Не удалось показать страницу заказов: {e}")
+    bot.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('orders_sellers:'))
+def orders_seller_filter(call):
+    if not get_sender(call).is_admin:
+        bot.answer_callback_query(call.id, "❌ Ошибка доступа")
         return
 
-    markup = types.InlineKeyboardMarkup()
-    if order['status'] in ('active', 'Активный'):
-        markup.row(
-            types.InlineKeyboardButton("✅ Завершить", callback_data=f"complete_{order_num}"),
-            types.InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_{order_num}")
-        )
+    delivery_filter = call.data.split(':', 1)[1] or None
+    markup = sellers_filter_markup(get_sellers_directory(), delivery_filter)
+    bot.edit_message_text(
+        "👤 Выберите продавца:",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=markup
+    )
+    bot.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('view_order_'))
+def view_order(call):
+    user_id = call.from_user.id
+    # view_order_<номер>[_<курсор истории>]
+    parts = call.data.split('_')
+    order_num = parts[2]
+    history_key = parts[3] if len(parts) > 3 else None
+    logger.info(f"view_order вызван для заказа {order_num} пользователем {user_id}")
+
+    # Неизменившаяся карточка отдаётся из кэша без запросов к БД. Версия берётся
+    # до чтения данных, поэтому карточка, собранная во время изменения, не попадёт в кэш
+    order_id = order_id_by_number.get(order_num)
+    version = order_cards.version(order_id) if order_id is not MISSING else None
+    card = order_cards.get(order_id, history_key) if version is not None else MISSING
+    if card is not MISSING:
+        logger.info(f"Карточка заказа {order_num} взята из кэша")
+        seller_id, info, markup = card
     else:
-        markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_orders"))
-    logger.info("Клавиатура сформирована")
+        order = get_order_by_number(order_num)
+        if not order:
+            logger.error(f"Заказ {order_num} не найден")
+            bot.answer_callback_query(call.id, "❌ Заказ не найден")
+            return
+        order_id_by_number.set(order_num, order['id'])
+        seller_id = order['seller_id']
+
+    sender = get_sender(call)
+    if not sender.is_admin:
+        seller = sender.seller
+        if not seller or seller_id != seller['id']:
+            bot.answer_callback_query(call.id, "❌ У вас нет прав для просмотра этого заказа")
+            return
+
+    if card is MISSING:
+        logger.info("Заказ получен, приступаем к формированию данных")
+        history_before = parse_history_cursor(history_key)
+        try:
+            messages, has_older = get_messages_for_order(order['id'], before=history_before)
+            logger.info(f"Получено сообщений: {len(messages)}")
+        except Exception as e:
+            logger.exception(f"Ошибка при получении сообщений: {e}")
+            bot.answer_callback_query(call.id, "❌ Ошибка получения истории")
+            return
+
+        try:
+            info, markup = render_order_card(order, messages, has_older, history_before)
+        except Exception as e:
+            logger.exception(f"Ошибка при формировании текста: {e}")
+            bot.answer_callback_query(call.id, "❌ Ошибка формирования данных")
+            return
+
+        if version is not None:
+            order_cards.set(order['id'], (seller_id, info, markup), version, history_key)
 
     try:
         bot.edit_message_text(
@@ -433,99 +253,84 @@ def view_order(call):
 @bot.callback_query_handler(func=lambda call: call.data == "back_to_orders")
 def back_to_orders(call):
     logger.info("back_to_orders вызван")
-    user_id = call.from_user.id
+    sender = get_sender(call)
     
-    if is_admin(user_id):
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT * FROM orders 
-                    WHERE status IN ('active', 'Активный') 
-                    ORDER BY id DESC
-                """)
-                orders = cur.fetchall()
-                for o in orders:
-                    o['contact'] = parse_contact(o['contact'])
-                    o['items'] = parse_items(o['items'])
-        
-        if not orders:
-            bot.edit_message_text("Нет активных заказов.", call.message.chat.id, call.message.message_id)
-            return
-            
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        for order in orders:
-            seller_name = "Неизвестный"
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT name FROM sellers WHERE id = %s", (order['seller_id'],))
-                    s = cur.fetchone()
-                    if s:
-                        seller_name = s['name']
-            
-            markup.add(types.InlineKeyboardButton(
-                f"Заказ {order['order_number']} ({seller_name})",
-                callback_data=f"view_order_{order['order_number']}"
-            ))
-        
-        bot.edit_message_text(
-            "📋 *Все активные заказы:*\nВыберите заказ для просмотра деталей и истории сообщений.",
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='Markdown',
-            reply_markup=markup
-        )
-    else:
-        seller = get_seller_by_telegram_id(user_id)
-        if not seller:
-            bot.answer_callback_query(call.id, "❌ Ошибка доступа")
-            return
-            
-        orders = get_active_orders_by_seller(seller['id'])
-        if not orders:
-            bot.edit_message_text("У вас нет активных заказов.", call.message.chat.id, call.message.message_id)
-            return
-            
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        for order in orders:
-            markup.add(types.InlineKeyboardButton(
-                f"Заказ {order['order_number']}",
-                callback_data=f"view_order_{order['order_number']}"
-            ))
-        
-        bot.edit_message_text(
-            "📋 *Ваши активные заказы:*\nВыберите заказ для просмотра деталей и истории сообщений.",
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='Markdown',
-            reply_markup=markup
-        )
+    if not sender.is_staff:
+        bot.answer_callback_query(call.id, "❌ Ошибка доступа")
+        return
+
+    text, markup = active_orders_view(sender)
+    if markup is None:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id)
+        return
+
+    bot.edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='Markdown',
+        reply_markup=markup
+    )
     
     bot.answer_callback_query(call.id)
 
-@bot.message_handler(func=lambda m: get_active_order_by_buyer(m.from_user.id) is not None and not m.text.startswith('#'))
+@bot.message_handler(commands=['find'])
+def handle_find(message):
+    sender = get_sender(message)
+    if not sender.is_staff:
+        bot.reply_to(message, "❌ У вас нет доступа к этой функции.")
+        return
+    if not core.search_ready:
+        bot.reply_to(message, SEARCH_UNAVAILABLE)
+        return
+
+    query = search_query_from_command(message.text)
+    if query is None:
+        bot.reply_to(message, FIND_USAGE)
+        return
+
+    text, markup = search_orders_view(sender, query)
+    bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('find:'))
+def find_page(call):
+    sender = get_sender(call)
+    if not sender.is_staff:
+        bot.answer_callback_query(call.id, "❌ Ошибка доступа")
+        return
+    if not core.search_ready:
+        bot.answer_callback_query(call.id, SEARCH_UNAVAILABLE)
+        return
+
+    text, markup = search_orders_view(sender, *parse_search_callback(call.data))
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                              parse_mode='Markdown', reply_markup=markup)
+    except Exception as e:
+        logger.error(f"Не удалось показать страницу поиска: {e}")
+    bot.answer_callback_query(call.id)
+
+@bot.message_handler(func=lambda m: get_sender(m).active_order is not None and not m.text.startswith('#'))
 def handle_buyer_message(message):
     user_id = message.from_user.id
-    order = get_active_order_by_buyer(user_id)
+    order = get_sender(message).active_order
     if not order:
         return
 
     save_message(order['id'], user_id, 'buyer', message.text)
     logger.info(f"Сообщение от покупателя сохранено для заказа {order['order_number']}")
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT telegram_id, name FROM sellers WHERE id = %s", (order['seller_id'],))
-            seller = cur.fetchone()
-    if seller:
-        seller_tg = seller['telegram_id']
-        seller_name = seller['name']
+    # Данные продавца уже получены вместе с заказом при разборе апдейта
+    if order['seller_telegram_id'] is not None:
+        seller_tg = order['seller_telegram_id']
+        seller_name = order['seller_name']
         logger.info(f"Пересылка сообщения продавцу {seller_name} (id={order['seller_id']}, tg={seller_tg})")
         try:
-            bot.send_message(
+            send_queue.send_message(
                 seller_tg,
                 f"💬 Сообщение от покупателя (заказ {order['order_number']}):\n\n{message.text}"
             )
-            logger.info(f"Сообщение успешно отправлено продавцу {seller_tg}")
+            logger.info(f"Сообщение поставлено в очередь продавцу {seller_tg}")
         except Exception as e:
             logger.error(f"Ошибка отправки продавцу {seller_tg}: {e}")
     else:
@@ -533,18 +338,22 @@ def handle_buyer_message(message):
 
     if ADMIN_ID and order['seller_id'] != ADMIN_ID:
         try:
-            bot.send_message(
-                ADMIN_ID,
-                f"📩 [Копия] Покупатель {order['contact']['name']} (заказ {order['order_number']}):\n{message.text}"
+            admin_digest.add(
+                digest_events.BUYER_MESSAGE,
+                order['order_number'],
+                f"📩 [Копия] Покупатель {order['contact']['name']} (заказ {order['order_number']}):\n{message.text}",
+                summary=f"📩 Покупатель {order['contact']['name']}: {message.text}"
             )
         except Exception as e:
             logger.error(f"Ошибка отправки копии админу: {e}")
 
     bot.reply_to(message, "✅ Сообщение отправлено.")
 
-@bot.message_handler(func=lambda m: (get_seller_by_telegram_id(m.from_user.id) is not None or is_admin(m.from_user.id)) and m.text.startswith('#'))
+@bot.message_handler(func=lambda m: get_sender(m).is_staff and m.text.startswith('#'))
 def handle_seller_message(message):
     user_id = message.from_user.id
+    sender = get_sender(message)
+    seller = sender.seller
     text = message.text.strip()
     logger.info(f"Сообщение от пользователя {user_id}: {text}")
 
@@ -561,13 +370,12 @@ def handle_seller_message(message):
             bot.reply_to(message, f"❌ Заказ {order_num} не найден.")
             return
 
-        if not is_admin(user_id):
-            seller = get_seller_by_telegram_id(user_id)
+        if not sender.is_admin:
             if not seller or order['seller_id'] != seller['id']:
                 bot.reply_to(message, "❌ Этот заказ не ваш.")
                 return
 
-        sender_role = 'admin' if is_admin(user_id) else 'seller'
+        sender_role = sender.role
         
         save_message(order['id'], user_id, sender_role, reply_text)
         logger.info(f"Сообщение от {sender_role} сохранено для заказа {order_num}")
@@ -575,26 +383,28 @@ def handle_seller_message(message):
         try:
             buyer_id = order['user_id']
             logger.info(f"Отправка ответа покупателю {buyer_id} по заказу {order_num}")
-            bot.send_message(
+            send_queue.send_message(
                 buyer_id,
-                f"💬 Сообщение от {'администратора' if is_admin(user_id) else 'продавца'} (заказ {order_num}):\n\n{reply_text}"
+                f"💬 Сообщение от {'администратора' if sender.is_admin else 'продавца'} (заказ {order_num}):\n\n{reply_text}"
             )
-            logger.info(f"Сообщение отправлено покупателю {buyer_id}")
+            logger.info(f"Сообщение поставлено в очередь покупателю {buyer_id}")
         except Exception as e:
             logger.error(f"Ошибка отправки покупателю {buyer_id}: {e}")
 
-        if ADMIN_ID and not is_admin(user_id):
-            seller_name = seller['name'] if 'seller' in locals() and seller else "Неизвестный продавец"
+        if ADMIN_ID and not sender.is_admin:
+            seller_name = seller['name'] if seller else "Неизвестный продавец"
             try:
-                bot.send_message(
-                    ADMIN_ID,
-                    f"📩 [Копия] Продавец {seller_name} (заказ {order_num}):\n{reply_text}"
+                admin_digest.add(
+                    digest_events.SELLER_MESSAGE,
+                    order_num,
+                    f"📩 [Копия] Продавец {seller_name} (заказ {order_num}):\n{reply_text}",
+                    summary=f"📩 Продавец {seller_name}: {reply_text}"
                 )
             except Exception as e:
                 logger.error(f"Ошибка отправки админу: {e}")
 
         bot.reply_to(message, f"✅ Сообщение отправлено покупателю (заказ {order_num}).", 
-                    reply_markup=admin_keyboard() if is_admin(user_id) else seller_keyboard())
+                    reply_markup=admin_keyboard() if sender.is_admin else seller_keyboard())
 
     except Exception as e:
         logger.error(f"Ошибка обработки сообщения: {e}", exc_info=True)
@@ -612,14 +422,15 @@ def handle_seller_complete(call):
         bot.answer_callback_query(call.id, "❌ Заказ не найден")
         return
 
-    if not is_admin(user_id):
-        seller = get_seller_by_telegram_id(user_id)
+    sender = get_sender(call)
+    seller = sender.seller
+    if not sender.is_admin:
         if not seller or order['seller_id'] != seller['id']:
             logger.error(f"Заказ {order_num} не принадлежит пользователю {user_id}")
             bot.answer_callback_query(call.id, "❌ Этот заказ не ваш")
             return
 
-    if order['status'] not in ('active', 'Активный'):
+    if order['status'] != OrderStatus.ACTIVE:
         logger.error(f"Заказ {order_num} уже не активен (статус: {order['status']})")
         bot.answer_callback_query(call.id, f"❌ Заказ уже не активен")
         try:
@@ -632,37 +443,25 @@ def handle_seller_complete(call):
             pass
         return
 
-    complete_order(order['id'])
+    complete_order(order['id'], order_num)
     logger.info(f"Заказ {order_num} завершён в БД")
 
-    if STOCK_BOT_URL:
-        try:
-            response = requests.post(
-                f"{STOCK_BOT_URL}/api/order-completed",
-                json={"order_number": order_num},
-                timeout=3
-            )
-            if response.ok:
-                logger.info(f"Уведомление о завершении заказа {order_num} отправлено складскому боту")
-            else:
-                logger.error(f"Складской бот вернул ошибку: {response.status_code} - {response.text}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки в складской бот: {e}")
-
     try:
-        bot.send_message(
+        send_queue.send_message(
             order['user_id'],
             f"✅ Ваш заказ {order_num} выполнен. Спасибо за покупку!"
         )
-        logger.info(f"Уведомление отправлено покупателю {order['user_id']}")
+        logger.info(f"Уведомление поставлено в очередь покупателю {order['user_id']}")
     except Exception as e:
         logger.error(f"Ошибка уведомления покупателя: {e}")
 
     if ADMIN_ID:
-        completer = "Администратор" if is_admin(user_id) else (seller['name'] if 'seller' in locals() and seller else "Неизвестный продавец")
-        bot.send_message(
-            ADMIN_ID,
-            f"✅ {completer} завершил заказ {order_num}."
+        completer = "Администратор" if sender.is_admin else (seller['name'] if seller else "Неизвестный продавец")
+        admin_digest.add(
+            digest_events.COMPLETED,
+            order_num,
+            f"✅ {completer} завершил заказ {order_num}.",
+            summary=f"✅ {completer} завершил заказ"
         )
 
     try:
@@ -689,14 +488,15 @@ def handle_cancel_order(call):
         bot.answer_callback_query(call.id, "❌ Заказ не найден")
         return
 
-    if not is_admin(user_id):
-        seller = get_seller_by_telegram_id(user_id)
+    sender = get_sender(call)
+    seller = sender.seller
+    if not sender.is_admin:
         if not seller or order['seller_id'] != seller['id']:
             logger.error(f"Заказ {order_num} не принадлежит пользователю {user_id}")
             bot.answer_callback_query(call.id, "❌ Этот заказ не ваш")
             return
 
-    if order['status'] not in ('active', 'Активный'):
+    if order['status'] != OrderStatus.ACTIVE:
         logger.error(f"Заказ {order_num} уже не активен (статус: {order['status']})")
         bot.answer_callback_query(call.id, f"❌ Заказ уже не активен")
         try:
@@ -709,7 +509,7 @@ def handle_cancel_order(call):
             pass
         return
 
-    update_order_status(order['id'], 'Отменен')
+    update_order_status(order['id'], OrderStatus.CANCELLED)
     logger.info(f"Заказ {order_num} отменён")
 
     try:
@@ -723,30 +523,32 @@ def handle_cancel_order(call):
         logger.error(f"Не удалось отредактировать сообщение: {e}")
 
     try:
-        bot.send_message(
+        send_queue.send_message(
             order['user_id'],
             f"❌ *Ваш заказ {order_num} отменён продавцом.*",
             parse_mode='Markdown'
         )
-        logger.info(f"Уведомление об отмене отправлено покупателю {order['user_id']}")
+        logger.info(f"Уведомление об отмене поставлено в очередь покупателю {order['user_id']}")
     except Exception as e:
         logger.error(f"Ошибка уведомления покупателя: {e}")
 
     if ADMIN_ID:
-        completer = "Администратор" if is_admin(user_id) else (seller['name'] if 'seller' in locals() and seller else "Неизвестный продавец")
-        bot.send_message(
-            ADMIN_ID,
-            f"❌ {completer} отменил заказ {order_num}."
+        completer = "Администратор" if sender.is_admin else (seller['name'] if seller else "Неизвестный продавец")
+        admin_digest.add(
+            digest_events.CANCELLED,
+            order_num,
+            f"❌ {completer} отменил заказ {order_num}.",
+            summary=f"❌ {completer} отменил заказ"
         )
 
     bot.answer_callback_query(call.id, "✅ Заказ отменён")
 
 @bot.message_handler(func=lambda m: True)
 def fallback_handler(message):
-    user_id = message.from_user.id
-    if get_seller_by_telegram_id(user_id):
+    sender = get_sender(message)
+    if sender.seller:
         bot.send_message(message.chat.id, "Используйте кнопки или начните новый заказ в нашем мини-аппе.", reply_markup=seller_keyboard())
-    elif is_admin(user_id):
+    elif sender.is_admin:
         bot.send_message(message.chat.id, "Используйте кнопки администратора.", reply_markup=admin_keyboard())
     else:
         bot.send_message(message.chat.id, "Если у вас есть вопросы, напишите продавцу.")
@@ -756,298 +558,351 @@ def fallback_handler(message):
 def index():
     return '🤖 Бот работает'
 
+@metrics.track_update
+def process_update(update):
+    bot.process_new_updates([update])
+
+# Все хэндлеры уже зарегистрированы выше
+metrics.instrument_handlers(bot)
+metrics.add_gauge('bot_send_queue_pending', 'Messages waiting in the send queue', lambda: send_queue.pending)
+metrics.add_gauge('bot_update_queue_pending', 'Updates waiting for a handler thread', lambda: update_executor.pending)
+metrics.add_gauge('bot_db_pool_connections', 'Open connections in the DB pool', core.db_pool_size)
+metrics.add_counter('bot_update_duplicates_total', 'Redelivered updates dropped', lambda: update_dedup.duplicates)
+metrics.add_gauge('bot_admin_digest_pending', 'Admin copy events waiting for the next digest',
+                  lambda: admin_digest.pending)
+metrics.add_counter('bot_telegram_http_requests_total', 'HTTP requests to the Bot API',
+                    lambda: telegram_transport.stats()['requests'])
+metrics.add_counter('bot_telegram_http_connections_total', 'Connections (TLS handshakes) opened to the Bot API',
+                    lambda: telegram_transport.stats()['connections'])
+metrics.add_counter('bot_telegram_http_retries_total', 'Bot API requests retried because they never reached Telegram',
+                    lambda: telegram_transport.stats()['retries'])
+metrics.add_gauge('bot_telegram_http_reuse_ratio', 'Share of Bot API requests sent over an already open connection',
+                  lambda: telegram_transport.stats()['reuse_ratio'])
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        return 'Not Found', 404
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# Апдейты разных чатов обрабатываются параллельно, одного чата — по порядку
+update_executor = OrderedExecutor(process_update, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE)
+
+def request_json() -> tuple:
+    return json_body(request.headers.get('content-type'), request.get_data())
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+    data, error = request_json()
+    if error or not isinstance(data, dict):
+        return 'Bad Request', 400
+    update_id = data.get('update_id')
+    # Повторную доставку отбрасываем до разбора апдейта и любых обращений к хэндлерам
+    if update_id is not None and not update_dedup.is_new(update_id):
+        logger.info(f"Повторная доставка апдейта {update_id} пропущена")
         return ''
-    return 'Bad Request', 400
-
-@app.route('/api/new-order', methods=['POST'])
-def new_order():
+    update = telebot.types.Update.de_json(data)
+    if not update_executor.submit(update_chat_id(update), update):
+        update_dedup.forget(update_id)
+        # Telegram повторит доставку позже
+        return 'Busy', 503
+    return ''
+
+def queue_order_notification(order_ids, chat_id, text: str, **kwargs):
+    """Уведомление продавцу о новых заказах; заказы отмечаются уведомлёнными после его доставки"""
+    send_queue.send_message(chat_id, text, on_sent=lambda: mark_orders_notified(order_ids), **kwargs)
+
+def notify_buyer_new_order(user_id: int, text: str):
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No data'}), 400
+        send_queue.send_message(user_id, text, parse_mode='Markdown')
+        logger.info(f"✅ Подтверждение поставлено в очередь покупателю {user_id}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка отправки подтверждения покупателю {user_id}: {e}")
 
-        user_id = data.get('userId')
-        buyer_name = data.get('name', 'Покупатель')
-        items = data.get('items')
-        total = data.get('total')
-        address = data.get('address')
-        payment = data.get('paymentMethod')
-        delivery = data.get('deliveryType')
-        contact = data.get('contact')
-        request_id = data.get('requestId')
+def notify_new_order(order_id: int, order_number: str, seller: dict, data: dict, contact: dict):
+    """Ставит в очередь уведомления о новом заказе продавцу, админу и покупателю.
 
-        if not all([user_id, items, total, address]):
-            return jsonify({'error': 'Missing required fields'}), 400
-
-        logger.info(f"Получен запрос на новый заказ: delivery={delivery}, address={address}")
-
-        # Определяем продавца и префикс для номера заказа
-        if delivery == 'courier':
-            # Для доставки используем администратора
-            seller = get_admin_seller()
-            if not seller:
-                logger.error("Администратор не найден в таблице sellers")
-                return jsonify({'error': 'Admin seller not found'}), 500
-            
-            prefix = 'D'
-            logger.info(f"Заказ с доставкой, назначен админ: id={seller['id']}, name={seller['name']}, prefix={prefix}")
-        else:
-            # Для самовывоза получаем информацию о точке
-            pickup_info = get_pickup_location_info(address)
-            if not pickup_info:
-                logger.error(f"Не найден адрес самовывоза: {address}")
-                return jsonify({'error': 'Invalid pickup address'}), 404
-            
-            seller_id = pickup_info['seller_id']
-            prefix = pickup_info['prefix']
-            seller = get_seller_by_id(seller_id)
-            
-            # Если префикс не задан в точке, используем первую букву имени продавца
-            if not prefix:
-                prefix = seller['name'][0].upper()
-            
-            logger.info(f"Найден адрес самовывоза: продавец {seller['name']} (id {seller_id}), префикс {prefix}")
+    Заказ отмечается уведомлённым, когда доставлено сообщение продавцу, — до этого
+    повтор запроса с тем же requestId отправит уведомления снова.
+    """
+    messages = new_order_messages(order_number, seller, data, contact)
 
-        if request_id:
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT id, order_number, notified_bool FROM orders WHERE request_id = %s", (request_id,))
-                    existing = cur.fetchone()
-                    if existing:
-                        logger.info(f"Найден существующий заказ с request_id {request_id}")
-                        order_number = existing['order_number']
-                        if not order_number:
-                            # Генерируем номер с нужным префиксом
-                            order_number = generate_order_number(prefix)
-                            cur.execute("UPDATE orders SET order_number = %s WHERE id = %s", (order_number, existing['id']))
-                            conn.commit()
-                            logger.info(f"Обновлён заказ {existing['id']} с новым номером {order_number}")
-                        if not existing['notified_bool']:
-                            items_lines = []
-                            for item in items:
-                                item_name = f"{item['name']} ({item['variantName']})" if item.get('variantName') else item['name']
-                                items_lines.append(f"• {item_name} x{item['quantity']} = {item['price']*item['quantity']} руб.")
-                            items_text = "\n".join(items_lines)
-                            delivery_text = "Самовывоз" if delivery == 'pickup' else "Доставка"
-                            order_text = f"{items_text}\n\nСумма: {total} руб.\nОплата: {'Наличные' if payment=='cash' else 'Перевод'}\nДоставка: {delivery_text}"
-                            markup = types.InlineKeyboardMarkup(row_width=2)
-                            markup.add(
-                                types.InlineKeyboardButton("✅ Завершить", callback_data=f"complete_{order_number}"),
-                                types.InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_{order_number}")
-                            )
-                            phone = contact.get('phone', 'не указан')
-                            username = contact.get('username', 'не указан')
-                            
-                            username_escaped = escape_markdown(username) if username else ''
-                            username_display = f"@{username_escaped}" if username else "@не указан"
-                            buyer_name_escaped = escape_markdown(buyer_name)
-                            
-                            try:
-                                bot.send_message(
-                                    seller['telegram_id'],
-                                    f"📦 *НОВЫЙ ЗАКАЗ {order_number}*\n\n"
-                                    f"👤 Покупатель: {buyer_name_escaped}\n"
-                                    f"📞 Телефон: {phone}\n"
-                                    f"📱 Username: {username_display}\n"
-                                    f"📍 {address}\n"
-                                    f"📝 {order_text}\n\n"
-                                    f"💬 Чтобы ответить покупателю, используйте `#{order_number} текст`",
-                                    parse_mode='Markdown',
-                                    reply_markup=markup
-                                )
-                                logger.info(f"✅ Уведомление успешно отправлено продавцу {seller['telegram_id']}")
-                            except Exception as e:
-                                logger.error(f"❌ Ошибка уведомления продавца {seller['telegram_id']}: {e}")
-                            
-                            if ADMIN_ID and seller['telegram_id'] != ADMIN_ID:
-                                try:
-                                    bot.send_message(
-                                        ADMIN_ID,
-                                        f"🆕 *Новый заказ {order_number}*\n"
-                                        f"Продавец: {seller['name']}\n"
-                                        f"Покупатель: {buyer_name_escaped}\n"
-                                        f"📞 Телефон: {phone}\n"
-                                        f"📱 Username: {username_display}\n"
-                                        f"📍 Адрес: {address}\n\n"
-                                        f"📦 *Состав заказа:*\n{items_text}\n\n"
-                                        f"💰 *Сумма: {total} руб.*",
-                                        parse_mode='Markdown'
-                                    )
-                                    logger.info(f"✅ Уведомление админу отправлено с составом заказа")
-                                except Exception as e:
-                                    logger.error(f"❌ Ошибка уведомления админа: {e}")
-                            
-                            cur.execute("UPDATE orders SET notified_bool = TRUE WHERE id = %s", (existing['id'],))
-                            conn.commit()
-                        return jsonify({'status': 'ok', 'orderNumber': order_number}), 200
-
-        # Генерация номера для нового заказа
-        order_number = generate_order_number(prefix)
-
-        # Получаем address_id только для самовывоза
-        address_id = None
-        if delivery == 'pickup':
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT id FROM pickup_locations WHERE address = %s", (address,))
-                    addr = cur.fetchone()
-                    address_id = addr['id'] if addr else None
-                    logger.info(f"address_id для {address}: {address_id}")
-
-        if not contact:
-            contact = {
-                'name': buyer_name,
-                'phone': '0000000000',
-                'address': address,
-                'paymentMethod': payment,
-                'deliveryType': delivery
-            }
-
-        order_data = {
-            'order_number': order_number,
-            'user_id': user_id,
-            'seller_id': seller['id'],
-            'address_id': address_id,
-            'items': items,
-            'total': total,
-            'status': 'active',
-            'delivery_type': delivery
-        }
-
-        order_id = save_order(order_data, contact, request_id)
-        logger.info(f"Заказ {order_number} сохранён с ID {order_id} (seller_id={seller['id']})")
-
-        items_lines = []
-        for item in items:
-            item_name = f"{item['name']} ({item['variantName']})" if item.get('variantName') else item['name']
-            items_lines.append(f"• {item_name} x{item['quantity']} = {item['price']*item['quantity']} руб.")
-        items_text = "\n".join(items_lines)
-
-        delivery_text = "Самовывоз" if delivery == 'pickup' else "Доставка"
-        order_text = f"{items_text}\n\nСумма: {total} руб.\nОплата: {'Наличные' if payment=='cash' else 'Перевод'}\nДоставка: {delivery_text}"
-
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("✅ Завершить", callback_data=f"complete_{order_number}"),
-            types.InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_{order_number}")
+    try:
+        queue_order_notification(
+            [order_id],
+            seller['telegram_id'],
+            messages['seller'],
+            parse_mode='Markdown',
+            reply_markup=order_actions_markup([order_number])
         )
+        logger.info(f"✅ Уведомление поставлено в очередь продавцу {seller['telegram_id']}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка уведомления продавца {seller['telegram_id']}: {e}")
 
-        phone = contact.get('phone', 'не указан')
-        username = contact.get('username', 'не указан')
-        
-        username_escaped = escape_markdown(username) if username else ''
-        username_display = f"@{username_escaped}" if username else "@не указан"
-        buyer_name_escaped = escape_markdown(buyer_name)
-
+    if ADMIN_ID and seller['telegram_id'] != ADMIN_ID:
         try:
-            bot.send_message(
-                seller['telegram_id'],
-                f"📦 *НОВЫЙ ЗАКАЗ {order_number}*\n\n"
-                f"👤 Покупатель: {buyer_name_escaped}\n"
-                f"📞 Телефон: {phone}\n"
-                f"📱 Username: {username_display}\n"
-                f"📍 {address}\n"
-                f"📝 {order_text}\n\n"
-                f"💬 Чтобы ответить покупателю, используйте `#{order_number} текст`",
-                parse_mode='Markdown',
-                reply_markup=markup
+            admin_digest.add(
+                digest_events.NEW_ORDER,
+                order_number,
+                messages['admin'],
+                summary=messages['admin_summary'],
+                parse_mode='Markdown'
             )
-            logger.info(f"✅ Уведомление успешно отправлено продавцу {seller['telegram_id']}")
+            logger.info(f"✅ Уведомление админу поставлено в очередь с составом заказа")
         except Exception as e:
-            logger.error(f"❌ Ошибка уведомления продавца {seller['telegram_id']}: {e}")
-
-        if ADMIN_ID and seller['telegram_id'] != ADMIN_ID:
+            logger.error(f"❌ Ошибка уведомления админа: {e}")
+
+    notify_buyer_new_order(data.get('userId'), messages['buyer'])
+
+def notify_new_orders(placed):
+    """Уведомления о пачке заказов: одно сводное сообщение на продавца вместо сообщения на заказ.
+
+    placed — список (id заказа, номер, продавец, данные заказа, контакт).
+    Покупатели получают подтверждения по отдельности, как при одиночном заказе.
+    """
+    for seller_chat, entries in orders_by_seller(placed).items():
+        seller = entries[0][2]
+        if len(entries) == 1:
+            notify_new_order(*entries[0])
+            continue
+        messages = [new_order_messages(*entry[1:]) for entry in entries]
+        for group in _group_messages([m['seller'] for m in messages]):
+            numbers = [entries[i][1] for i in group]
             try:
-                bot.send_message(
-                    ADMIN_ID,
-                    f"🆕 *Новый заказ {order_number}*\n"
-                    f"Продавец: {seller['name']}\n"
-                    f"Покупатель: {buyer_name_escaped}\n"
-                    f"📞 Телефон: {phone}\n"
-                    f"📱 Username: {username_display}\n"
-                    f"📍 Адрес: {address}\n\n"
-                    f"📦 *Состав заказа:*\n{items_text}\n\n"
-                    f"💰 *Сумма: {total} руб.*",
-                    parse_mode='Markdown'
+                queue_order_notification(
+                    [entries[i][0] for i in group],
+                    seller_chat,
+                    ORDER_SEPARATOR.join(messages[i]['seller'] for i in group),
+                    parse_mode='Markdown',
+                    reply_markup=order_actions_markup(numbers)
                 )
-                logger.info(f"✅ Уведомление админу отправлено с составом заказа")
+                logger.info(f"✅ Сводка из {len(group)} заказов поставлена в очередь продавцу {seller_chat}")
             except Exception as e:
-                logger.error(f"❌ Ошибка уведомления админа: {e}")
+                logger.error(f"❌ Ошибка уведомления продавца {seller_chat}: {e}")
+
+        if ADMIN_ID and seller_chat != ADMIN_ID and admin_digest.buffers(digest_events.NEW_ORDER):
+            for entry, message in zip(entries, messages):
+                admin_digest.add(digest_events.NEW_ORDER, entry[1], message['admin'],
+                                 summary=message['admin_summary'], parse_mode='Markdown')
+        elif ADMIN_ID and seller_chat != ADMIN_ID:
+            for group in _group_messages([m['admin'] for m in messages]):
+                try:
+                    send_queue.send_message(
+                        ADMIN_ID,
+                        ORDER_SEPARATOR.join(messages[i]['admin'] for i in group),
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.error(f"❌ Ошибка уведомления админа о заказах продавца {seller['name']}: {e}")
+
+        for entry, message in zip(entries, messages):
+            notify_buyer_new_order(entry[3].get('userId'), message['buyer'])
+
+def create_order(data: dict):
+    """Создаёт заказ из данных мини-аппа; возвращает (тело ответа, HTTP-код)"""
+    address = data.get('address')
+    delivery = data.get('deliveryType')
+    contact = data.get('contact')
+    request_id = data.get('requestId')
+
+    error = validate_order(data)
+    if error:
+        return error
+
+    existing = get_order_by_request_id(request_id) if request_id else None
+    if existing and existing['order_number'] and existing['notified_bool']:
+        # Повтор уже оформленного заказа: продавцы и Telegram не нужны
+        logger.info(f"Повтор запроса {request_id}: заказ {existing['order_number']} уже оформлен")
+        return {'status': 'ok', 'orderNumber': existing['order_number']}, 200
+
+    logger.info(f"Получен запрос на новый заказ: delivery={delivery}, address={address}")
+
+    route, error = resolve_order_route(delivery, address)
+    if error:
+        return error
+    seller, prefix, address_id = route
+
+    if existing:
+        # Заказ уже создан, но уведомления не успели уйти (или это старая запись без номера)
+        logger.info(f"Найден существующий заказ с request_id {request_id}")
+        order_id = existing['id']
+        order_number = existing['order_number']
+        if not order_number:
+            order_number = assign_order_number(order_id, prefix)
+            logger.info(f"Обновлён заказ {order_id} с новым номером {order_number}")
+        if not existing['notified_bool']:
+            notify_new_order(order_id, order_number, seller, data, existing['contact'] or contact or {})
+        return {'status': 'ok', 'orderNumber': order_number}, 200
+
+    order_data, contact = new_order_record(data, seller, address_id)
+
+    placed = place_order(order_data, prefix, contact, request_id)
+    if placed is None:
+        # Параллельный запрос с тем же requestId (например, на другом инстансе) успел раньше
+        existing = get_order_by_request_id(request_id)
+        if not existing:
+            return {'error': 'Order conflict'}, 409
+        logger.info(f"Заказ с request_id {request_id} уже создан параллельным запросом: {existing['order_number']}")
+        return {'status': 'ok', 'orderNumber': existing['order_number']}, 200
+    order_id, order_number = placed
+    logger.info(f"Заказ {order_number} сохранён с ID {order_id} (seller_id={seller['id']})")
+
+    # Уведомления уходят только после коммита: заказ без номера или без записи не анонсируется
+    notify_new_order(order_id, order_number, seller, data, contact)
+
+    return {'status': 'ok', 'orderNumber': order_number}, 200
 
-        try:
-            bot.send_message(
-                user_id,
-                f"✅ *Ваш заказ {order_number} принят!*\n\n"
-                f"📝 *Состав заказа:*\n{items_text}\n\n"
-                f"💳 Оплата: {'Наличные' if payment=='cash' else 'Перевод'}\n"
-                f"🚚 Доставка: {delivery_text}\n"
-                f"📍 Адрес: {address}\n\n"
-                f"📅 Дата: {datetime.now().strftime('%d %B')}\n"
-                f"👤 Username: {username_display}\n\n"
-                f"💬 Вы можете общаться с продавцом в этом чате.",
-                parse_mode='Markdown'
+@app.route('/api/new-order', methods=['POST'])
+def new_order():
+    data, error = request_json()
+    if error:
+        body, status = error
+        return jsonify(body), status
+    try:
+        if not data:
+            return jsonify({'error': 'No data'}), 400
+
+        request_id = data.get('requestId')
+        if request_id:
+            # Повторы с тем же requestId отдаются из памяти или ждут уже идущий запрос
+            body, status = order_requests.run(
+                request_id,
+                lambda: create_order(data),
+                cacheable=lambda result: result[1] == 200
             )
-            logger.info(f"✅ Подтверждение отправлено покупателю {user_id}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки подтверждения покупателю {user_id}: {e}")
+        else:
+            body, status = create_order(data)
+        return jsonify(body), status
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("UPDATE orders SET notified_bool = TRUE WHERE id = %s", (order_id,))
-                conn.commit()
+    except Exception as e:
+        logger.exception("❌ Ошибка в /api/new-order")
+        return jsonify({'error': str(e)}), 500
 
-        return jsonify({'status': 'ok', 'orderNumber': order_number})
+def create_orders(orders: list) -> dict:
+    """Создаёт пачку заказов; возвращает тело ответа с результатом по каждому заказу в исходном порядке.
+
+    Ошибка одного заказа не мешает остальным. Повторы requestId (в памяти,
+    в БД и внутри самой пачки) получают номер уже созданного заказа.
+    """
+    batch = OrderBatch(orders)
+    ok, failed = batch.ok, batch.failed
+
+    existing = get_orders_by_request_ids(list(batch.first_by_request))
+    to_place = []
+    for index in batch.fresh:
+        data = orders[index]
+        found = existing.get(data.get('requestId'))
+        if found and found['order_number'] and found['notified_bool']:
+            ok(index, found['order_number'])
+            continue
+        if found:
+            # Недоотправленный старый заказ — обычный путь досылает номер и уведомления
+            body, code = create_order(data)
+            if code == 200:
+                ok(index, body['orderNumber'])
+            else:
+                failed(index, (body, code))
+            continue
+        route, error = resolve_order_route(data.get('deliveryType'), data.get('address'))
+        if error:
+            failed(index, error)
+            continue
+        seller, prefix, address_id = route
+        order_data, contact = new_order_record(data, seller, address_id)
+        to_place.append((index, seller, order_data, prefix, contact))
+
+    if to_place:
+        try:
+            placed = place_orders([
+                (order_data, prefix, contact, orders[index].get('requestId'))
+                for index, seller, order_data, prefix, contact in to_place
+            ])
+        except Exception as e:
+            logger.exception(f"❌ Ошибка сохранения пачки из {len(to_place)} заказов")
+            for index, *_ in to_place:
+                failed(index, ({'error': str(e)}, 500))
+        else:
+            created = []
+            for (index, seller, order_data, prefix, contact), result in zip(to_place, placed):
+                request_id = orders[index].get('requestId')
+                if result is None:
+                    # requestId успел занять параллельный запрос
+                    found = get_order_by_request_id(request_id)
+                    if found:
+                        ok(index, found['order_number'])
+                    else:
+                        failed(index, ({'error': 'Order conflict'}, 409))
+                    continue
+                order_id, order_number = result
+                ok(index, order_number)
+                created.append((order_id, order_number, seller, orders[index], contact))
+            logger.info(f"Пачка заказов: создано {len(created)} из {len(orders)}")
+            # Уведомления уходят только после коммита всей пачки
+            notify_new_orders(created)
+
+    return batch.finish()
+
+@app.route('/api/new-orders', methods=['POST'])
+def new_orders():
+    data, error = request_json()
+    if error:
+        body, status = error
+        return jsonify(body), status
+    try:
+        orders, error = parse_order_batch(data)
+        if error:
+            body, status = error
+            return jsonify(body), status
+        return jsonify(create_orders(orders))
 
     except Exception as e:
-        logger.exception("❌ Ошибка в /api/new-order")
+        logger.exception("❌ Ошибка в /api/new-orders")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/order-cancelled', methods=['POST'])
 def order_cancelled():
+    data, error = request_json()
+    if error:
+        body, status = error
+        return jsonify(body), status
     try:
-        data = request.get_json()
         if not data:
             return jsonify({'error': 'No data'}), 400
 
         order_id = data.get('orderId')
         order_number = data.get('orderNumber')
-        user_id = data.get('userId')
         seller_id = data.get('sellerId')
 
         if not all([order_id, seller_id, order_number]):
             logger.error(f"Missing fields: orderId={order_id}, sellerId={seller_id}, orderNumber={order_number}")
             return jsonify({'error': 'Missing fields'}), 400
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT telegram_id, name FROM sellers WHERE id = %s", (seller_id,))
-                seller = cur.fetchone()
-                if not seller:
-                    return jsonify({'error': 'Seller not found'}), 404
-                seller_tg = seller['telegram_id']
-                seller_name = seller['name']
+        # Статус заказа поменялся вне бота — карточку нужно перерисовать
+        order_cards.bump(order_id)
 
-        bot.send_message(
+        seller = get_seller_by_id(seller_id)
+        if not seller:
+            return jsonify({'error': 'Seller not found'}), 404
+        seller_tg = seller['telegram_id']
+        seller_name = seller['name']
+
+        send_queue.send_message(
             seller_tg,
             f"❌ *Заказ {order_number} отменён покупателем.*",
             parse_mode='Markdown'
         )
-        logger.info(f"Уведомление об отмене заказа {order_number} отправлено продавцу {seller_tg}")
+        logger.info(f"Уведомление об отмене заказа {order_number} поставлено в очередь продавцу {seller_tg}")
 
         if ADMIN_ID and seller_tg != ADMIN_ID:
             try:
-                bot.send_message(
-                    ADMIN_ID,
+                admin_digest.add(
+                    digest_events.CANCELLED,
+                    order_number,
                     f"❌ *Заказ {order_number} отменён покупателем.*\nПродавец: {seller_name}",
+                    summary=f"❌ Отменён покупателем, продавец {seller_name}",
                     parse_mode='Markdown'
                 )
-                logger.info(f"Уведомление об отмене заказа {order_number} отправлено администратору")
+                logger.info(f"Уведомление об отмене заказа {order_number} поставлено в очередь администратору")
             except Exception as e:
                 logger.error(f"Ошибка отправки уведомления администратору: {e}")
 
@@ -1057,7 +912,38 @@ def order_cancelled():
         logger.exception("Ошибка в /api/order-cancelled")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/orders/search', methods=['GET'])
+def orders_search():
+    """Поиск заказов от имени пользователя мини-аппа: администратор ищет по всем заказам, продавец — по своим.
+
+    Кто ищет, берётся только из подписанного Telegram initData (заголовок X-Telegram-Init-Data).
+    """
+    user_id = webapp_user_id(request.headers.get('X-Telegram-Init-Data'))
+    if user_id is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not core.search_ready:
+        return jsonify({'error': 'Search is not available'}), 503
+    args, error = parse_search_args(request.args)
+    if error:
+        body, status = error
+        return jsonify(body), status
+    query, offset, limit = args
+
+    sender = resolve_sender(user_id, with_buyer_order=False)
+    if not sender.is_staff:
+        return jsonify({'error': 'Forbidden'}), 403
+
+    orders, has_next = search_orders(query, search_scope(sender), offset, limit)
+    return jsonify(search_response(orders, has_next, offset, limit))
+
 if __name__ == '__main__':
+    if SCHEMA_BOOTSTRAP:
+        try:
+            schema.bootstrap(DATABASE_URL)
+        except Exception as e:
+            logger.exception(f"Ошибка проверки схемы БД: {e}")
+    check_schema()
+    outbox.start()
     bot.remove_webhook()
     bot.set_webhook(url=WEBHOOK_URL)
     logger.info(f"Webhook set to {WEBHOOK_URL}")
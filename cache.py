@@ -0,0 +1,210 @@
+import time
+import select
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей.
+
+    Отрицательные результаты (None — «такой записи нет») тоже кэшируются,
+    но на отдельный, обычно более короткий срок negative_ttl.
+    """
+
+    def __init__(self, name, maxsize=1000, ttl=300.0, negative_ttl=60.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()   # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.invalidations = 0
+        # Растёт при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._generation = 0
+
+    def get(self, key):
+        """Значение из кэша или MISSING"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            if item[0] is None:
+                self.negative_hits += 1
+            return item[0]
+
+    def set(self, key, value, generation=None):
+        ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is MISSING:
+            generation = self._generation
+            value = loader(key)
+            self.set(key, value, generation)
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """То же для асинхронного загрузчика (асинхронный режим бота)"""
+        value = self.get(key)
+        if value is MISSING:
+            generation = self._generation
+            value = await loader(key)
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, key=MISSING):
+        with self._lock:
+            if key is MISSING:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'invalidations': self.invalidations,
+        }
+
+
+class VersionedCache:
+    """Кэш значений, привязанных к версии объекта (например, отрисованных карточек заказа).
+
+    Значение хранится под ключом (id объекта, версия, key). bump(id) выдаёт
+    объекту новую версию, и все его старые значения перестают находиться —
+    их потом вытесняет LRU. Версии берутся из общего счётчика, поэтому версия,
+    вытесненная из таблицы версий, никогда не совпадёт со старой.
+    """
+
+    def __init__(self, name, maxsize=1000, ttl=300.0):
+        self.name = name
+        self.maxsize = maxsize
+        self._values = TTLCache(name, maxsize, ttl, negative_ttl=0)
+        self._versions = OrderedDict()
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self.bumps = 0
+
+    def _set_version(self, obj_id, version):
+        self._versions[obj_id] = version
+        self._versions.move_to_end(obj_id)
+        while len(self._versions) > self.maxsize:
+            self._versions.popitem(last=False)
+
+    def version(self, obj_id, create=True):
+        """Текущая версия объекта; None, если она неизвестна и create=False"""
+        with self._lock:
+            version = self._versions.get(obj_id)
+            if version is not None:
+                self._versions.move_to_end(obj_id)
+            elif create:
+                version = next(self._counter)
+                self._set_version(obj_id, version)
+            return version
+
+    def bump(self, obj_id):
+        with self._lock:
+            self._set_version(obj_id, next(self._counter))
+            self.bumps += 1
+
+    def get(self, obj_id, key=None):
+        """Значение для текущей версии объекта или MISSING"""
+        version = self.version(obj_id, create=False)
+        if version is None:
+            return MISSING
+        return self._values.get((obj_id, version, key))
+
+    def set(self, obj_id, value, version, key=None):
+        """Сохраняет значение, построенное для version (взятой до чтения данных)"""
+        self._values.set((obj_id, version, key), value)
+
+    def stats(self) -> dict:
+        return dict(self._values.stats(), versions=len(self._versions), bumps=self.bumps)
+
+
+class InvalidationListener:
+    """Слушает LISTEN <channel> на отдельном соединении и вызывает on_change(таблица).
+
+    NOTIFY шлют триггеры на таблицах справочников (их создаёт миграция
+    schema.migrate_directory_notify_triggers), так что все инстансы
+    сбрасывают кэш без опроса БД; сам слушатель схему не меняет. После
+    каждой (пере)подписки вызывается on_change(None): уведомления за время
+    обрыва могли потеряться.
+    """
+
+    def __init__(self, dsn, on_change, channel='directory_changed', reconnect_delay=5.0):
+        self.dsn = dsn
+        self.on_change = on_change
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread:
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                # Всё, что было закэшировано до подписки, могло устареть
+                self.on_change(None)
+                logger.info(f"Подписка на инвалидацию кэша ({self.channel}) активна")
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.on_change(notify.payload)
+            except Exception as e:
+                logger.warning(f"Слушатель инвалидации кэша отключился: {e}")
+                self._stop.wait(self.reconnect_delay)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
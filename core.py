@@ -0,0 +1,1195 @@
+"""Общая часть синхронного (bot.py) и асинхронного (async_app.py) режимов.
+
+Настройки, пул соединений psycopg2, кэши, запросы к БД, разбор и отрисовка —
+без TeleBot, Flask-приложения и очередей отправки: их строит каждый режим сам,
+так что импорт этого модуля не поднимает синхронный стек.
+"""
+import os
+import re
+import hmac
+import json
+import time
+import hashlib
+import logging
+import threading
+import psycopg2.errors
+from datetime import datetime
+from decimal import Decimal
+from urllib.parse import parse_qsl
+import telebot
+from telebot import types
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from dotenv import load_dotenv
+
+from db import ConnectionPool
+from order_numbers import OrderNumberAllocator, parse_block_sizes
+from outbox import Outbox
+from cache import TTLCache, VersionedCache, InvalidationListener
+from dedup import UpdateDeduplicator
+from idempotency import IdempotentRequests
+import templates
+from metrics import Metrics
+from templates import escape_markdown, render_items, payment_label, delivery_label, username_label
+import schema
+from schema import OrderStatus
+
+# Настраиваем логирование для telebot
+telebot.logger.setLevel(logging.INFO)
+
+load_dotenv()
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+DATABASE_URL = os.getenv('DATABASE_URL')
+ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
+PORT = int(os.getenv('PORT', 10000))
+STOCK_BOT_URL = os.getenv('STOCK_BOT_URL')
+STOCK_BOT_TIMEOUT = float(os.getenv('STOCK_BOT_TIMEOUT', 3))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+
+# Настройки пула соединений с БД
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600))
+DB_POOL_CHECK_AFTER = float(os.getenv('DB_POOL_CHECK_AFTER', 30))
+
+# Размеры пачек номеров, резервируемых в памяти процесса, например "D:50"
+ORDER_NUMBER_BLOCKS = parse_block_sizes(os.getenv('ORDER_NUMBER_BLOCKS', ''))
+
+# Очередь исходящих сообщений: число потоков и лимиты Telegram (сообщений в секунду)
+SEND_QUEUE_WORKERS = int(os.getenv('SEND_QUEUE_WORKERS', 4))
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', 20 / 60))
+
+# Кэш справочников (продавцы, точки самовывоза): размер и время жизни записей, секунд
+DIRECTORY_CACHE_SIZE = int(os.getenv('DIRECTORY_CACHE_SIZE', 1000))
+DIRECTORY_CACHE_TTL = float(os.getenv('DIRECTORY_CACHE_TTL', 300))
+DIRECTORY_CACHE_NEGATIVE_TTL = float(os.getenv('DIRECTORY_CACHE_NEGATIVE_TTL', 60))
+DIRECTORY_CACHE_LISTEN = os.getenv('DIRECTORY_CACHE_LISTEN', '1') == '1'
+
+# Применять лёгкие миграции, создавать недостающие индексы и проверять планы запросов при старте.
+# Миграции, перезаписывающие таблицы, выполняет только python schema.py migrate
+SCHEMA_BOOTSTRAP = os.getenv('SCHEMA_BOOTSTRAP', '0') == '1'
+
+# Параллельная обработка апдейтов: потоки и размер очереди каждого потока
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 100))
+
+# Отсев повторных доставок апдейтов: окно в памяти и (опционально) отметки в БД
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', 10000))
+UPDATE_DEDUP_DB = os.getenv('UPDATE_DEDUP_DB', '0') == '1'
+
+# Сколько последних requestId помнить для быстрых ответов на повторы /api/new-order
+ORDER_REQUEST_CACHE_SIZE = int(os.getenv('ORDER_REQUEST_CACHE_SIZE', 10000))
+
+# Максимум заказов в одном запросе /api/new-orders
+BATCH_ORDERS_MAX = int(os.getenv('BATCH_ORDERS_MAX', 500))
+
+# Сколько заказов показывать на одной странице списка
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', 10))
+
+# Сколько последних сообщений переписки загружать в карточку заказа
+ORDER_HISTORY_PAGE_SIZE = int(os.getenv('ORDER_HISTORY_PAGE_SIZE', 20))
+
+# Ограничение Telegram на длину текста сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Поиск заказов (/find и /api/orders/search): результатов на странице и минимальная длина запроса
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 10))
+SEARCH_MIN_QUERY = int(os.getenv('SEARCH_MIN_QUERY', 2))
+# /api/orders/search принимает initData мини-аппа не старше стольких секунд
+WEBAPP_AUTH_MAX_AGE = int(os.getenv('WEBAPP_AUTH_MAX_AGE', 86400))
+
+# Кэш отрисованных карточек заказа. Изменения на этом инстансе сбрасывают его
+# сразу; TTL ограничивает устаревание, если заказ поменяли в другом процессе
+ORDER_CARD_CACHE_SIZE = int(os.getenv('ORDER_CARD_CACHE_SIZE', 1000))
+ORDER_CARD_CACHE_TTL = float(os.getenv('ORDER_CARD_CACHE_TTL', 60))
+
+# Метрики обработчиков и маршрутов на /metrics; при 0 ничего не оборачивается
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+
+# Режим запуска: sync — Flask + TeleBot + psycopg2, async — ASGI-приложение из async_app
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'sync')
+# Асинхронный режим: сколько апдейтов может ждать I/O одновременно, сверх этого вебхук отвечает 503
+ASYNC_MAX_UPDATES = int(os.getenv('ASYNC_MAX_UPDATES', 1000))
+
+# HTTP-соединения с Bot API: общий keep-alive пул на все потоки, таймауты (секунд)
+# и число повторов запросов, не дошедших до Telegram (сбой подключения, протухшее соединение)
+TELEGRAM_HTTP_POOL_SIZE = int(os.getenv('TELEGRAM_HTTP_POOL_SIZE', UPDATE_WORKERS + SEND_QUEUE_WORKERS + 4))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', 5))
+TELEGRAM_READ_TIMEOUT = float(os.getenv('TELEGRAM_READ_TIMEOUT', 15))
+TELEGRAM_HTTP_RETRIES = int(os.getenv('TELEGRAM_HTTP_RETRIES', 2))
+
+# Сводка копий для администратора: одно сообщение раз в ADMIN_DIGEST_INTERVAL секунд
+# или по ADMIN_DIGEST_MAX_EVENTS событий; 0 — каждая копия отдельным сообщением
+ADMIN_DIGEST_INTERVAL = float(os.getenv('ADMIN_DIGEST_INTERVAL', 0))
+ADMIN_DIGEST_MAX_EVENTS = int(os.getenv('ADMIN_DIGEST_MAX_EVENTS', 30))
+# Типы событий, которые уходят администратору сразу, минуя сводку
+ADMIN_DIGEST_URGENT = [kind.strip() for kind in os.getenv('ADMIN_DIGEST_URGENT', 'cancelled').split(',') if kind.strip()]
+
+if not BOT_TOKEN or not DATABASE_URL:
+    raise ValueError("Не заданы обязательные переменные окружения")
+
+metrics = Metrics(enabled=METRICS_ENABLED)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BASE_URL = os.getenv('RENDER_EXTERNAL_URL', 'https://dp-sbor-miniapp-bot.onrender.com')
+WEBHOOK_URL = f"{BASE_URL}/webhook"
+
+# items и contact хранятся в JSONB и приходят из драйвера уже разобранными;
+# parse_* нужны для строк, где в колонке лежит JSON-текст (до миграции схемы)
+def parse_contact(contact_json):
+    if isinstance(contact_json, dict):
+        return contact_json
+    try:
+        return json.loads(contact_json)
+    except:
+        return {}
+
+def parse_items(items_json):
+    if isinstance(items_json, list):
+        return items_json
+    try:
+        return json.loads(items_json)
+    except:
+        return []
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> ConnectionPool:
+    """Возвращает общий для процесса пул соединений, создавая его при первом обращении"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    DATABASE_URL,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    check_after=DB_POOL_CHECK_AFTER,
+                    cursor_factory=metrics.cursor_factory(RealDictCursor)
+                )
+                logger.info(f"Пул соединений с БД создан: min={DB_POOL_MIN}, max={DB_POOL_MAX}")
+    return _db_pool
+
+def get_db_connection():
+    """Соединение из пула: `with get_db_connection() as conn` фиксирует транзакцию и возвращает соединение в пул"""
+    metrics.observe_db_connection()
+    return get_db_pool().connection()
+
+# События для складского бота пишутся в outbox вместе с изменением заказа
+outbox = Outbox(
+    get_db_connection,
+    routes={'order_completed': f"{STOCK_BOT_URL}/api/order-completed"} if STOCK_BOT_URL else {},
+    batch_size=OUTBOX_BATCH_SIZE,
+    poll_interval=OUTBOX_POLL_INTERVAL,
+    timeout=STOCK_BOT_TIMEOUT
+)
+
+# ========== Кэш справочников ==========
+# sellers и pickup_locations меняются редко: держим их в памяти процесса,
+# а при изменении таблиц все инстансы получают NOTIFY и сбрасывают кэш
+seller_by_telegram_cache = TTLCache('seller_by_telegram_id', DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL, DIRECTORY_CACHE_NEGATIVE_TTL)
+seller_by_id_cache = TTLCache('seller_by_id', DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL, DIRECTORY_CACHE_NEGATIVE_TTL)
+pickup_location_cache = TTLCache('pickup_location', DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL, DIRECTORY_CACHE_NEGATIVE_TTL)
+DIRECTORY_CACHES = (seller_by_telegram_cache, seller_by_id_cache, pickup_location_cache)
+
+def invalidate_directory_caches(table: str = None):
+    for cache in DIRECTORY_CACHES:
+        cache.invalidate()
+    logger.info(f"Кэш справочников сброшен (изменена таблица: {table or 'неизвестно'})")
+
+directory_listener = InvalidationListener(DATABASE_URL, invalidate_directory_caches, channel=schema.DIRECTORY_CHANNEL)
+
+# ========== Кэш карточек заказов ==========
+# Карточка хранится под версией заказа; save_message, complete_order и
+# update_order_status выдают заказу новую версию
+order_cards = VersionedCache('order_cards', ORDER_CARD_CACHE_SIZE, ORDER_CARD_CACHE_TTL)
+# Номер заказа после присвоения не меняется
+order_id_by_number = TTLCache('order_id_by_number', ORDER_CARD_CACHE_SIZE, ttl=24 * 3600, negative_ttl=0)
+
+def directory_lookup(cache: TTLCache, key, loader):
+    if DIRECTORY_CACHE_LISTEN:
+        directory_listener.start()
+    return cache.get_or_load(key, loader)
+
+# Запросы, общие для синхронного и асинхронного (async_app) режимов
+PICKUP_LOCATION_SQL = """
+    SELECT pl.id AS address_id, pl.seller_id, pl.prefix, s.telegram_id, s.name
+    FROM pickup_locations pl
+    JOIN sellers s ON pl.seller_id = s.id
+    WHERE pl.address = %s
+"""
+
+def _load_pickup_location_info(address: str):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(PICKUP_LOCATION_SQL, (address,))
+            return cur.fetchone()
+
+def _load_seller_by_telegram_id(telegram_id: int):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM sellers WHERE telegram_id = %s", (telegram_id,))
+            return cur.fetchone()
+
+def _load_seller_by_id(seller_id: int):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM sellers WHERE id = %s", (seller_id,))
+            return cur.fetchone()
+
+def get_pickup_location_info(address: str):
+    """Возвращает информацию о точке самовывоза по адресу"""
+    return directory_lookup(pickup_location_cache, address, _load_pickup_location_info)
+
+def get_seller_by_telegram_id(telegram_id: int):
+    return directory_lookup(seller_by_telegram_cache, telegram_id, _load_seller_by_telegram_id)
+
+def get_seller_by_id(seller_id: int):
+    return directory_lookup(seller_by_id_cache, seller_id, _load_seller_by_id)
+
+def get_admin_seller():
+    """Возвращает запись продавца-администратора по ADMIN_ID"""
+    seller = get_seller_by_telegram_id(ADMIN_ID)
+    logger.info(f"get_admin_seller() вызван, ADMIN_ID={ADMIN_ID}, результат: {seller}")
+    return seller
+
+_order_number_allocator = None
+
+def get_order_number_allocator() -> OrderNumberAllocator:
+    global _order_number_allocator
+    if _order_number_allocator is None:
+        _order_number_allocator = OrderNumberAllocator(get_db_connection, ORDER_NUMBER_BLOCKS)
+    return _order_number_allocator
+
+def generate_order_number(prefix: str) -> str:
+    """Генерирует номер заказа для указанного префикса"""
+    # Префикс обрезается до 3 символов внутри аллокатора
+    return get_order_number_allocator().allocate(prefix)
+
+ORDER_INSERT_COLUMNS = "order_number, user_id, seller_id, address_id, items, total, contact, status, request_id, notified_bool, delivery_type"
+ORDER_INSERT_VALUES = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+ORDER_INSERT_SQL = f"""
+    INSERT INTO orders ({ORDER_INSERT_COLUMNS})
+    VALUES {ORDER_INSERT_VALUES}
+    RETURNING id
+"""
+# Вставка пачки: VALUES %s — строки заказов; заказы с уже занятым requestId пропускаются,
+# остальные нарушения уникальности (например, order_number) откатывают пачку
+ORDER_BATCH_INSERT_SQL = f"""
+    INSERT INTO orders ({ORDER_INSERT_COLUMNS})
+    VALUES %s
+    ON CONFLICT (request_id) WHERE request_id IS NOT NULL DO NOTHING
+    RETURNING id, order_number
+"""
+
+def _order_row(order_data: dict, contact: dict, request_id: str = None, json_adapter=Json) -> tuple:
+    return (
+        order_data['order_number'],
+        order_data['user_id'],
+        order_data['seller_id'],
+        order_data.get('address_id'),
+        json_adapter(order_data['items']),
+        order_data['total'],
+        json_adapter(contact),
+        OrderStatus(order_data['status']).value,
+        request_id,
+        False,
+        order_data.get('delivery_type')
+    )
+
+def _insert_order(cur, order_data: dict, contact: dict, request_id: str = None) -> int:
+    cur.execute(ORDER_INSERT_SQL, _order_row(order_data, contact, request_id))
+    return cur.fetchone()['id']
+
+def save_order(order_data: dict, contact: dict, request_id: str = None, cur=None):
+    """Сохраняет заказ; cur — курсор текущей транзакции, если он есть"""
+    if cur is not None:
+        return _insert_order(cur, order_data, contact, request_id)
+    with get_db_connection() as conn:
+        with conn.cursor() as own_cur:
+            return _insert_order(own_cur, order_data, contact, request_id)
+
+def place_order(order_data: dict, prefix: str, contact: dict, request_id: str = None):
+    """Выделяет номер и сохраняет заказ в одной транзакции; возвращает (id, номер).
+
+    Заказ записывается с notified_bool = FALSE — это отметка о том, что
+    уведомление продавцу ещё не доставлено. Его рассылают после коммита, а повтор
+    запроса с тем же requestId досылает его, если доставка не удалась или процесс упал раньше.
+    None — заказ с таким requestId уже создан другим запросом.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                order_number = get_order_number_allocator().allocate(prefix, cur=cur)
+                order_id = save_order(dict(order_data, order_number=order_number), contact, request_id, cur=cur)
+    except psycopg2.errors.UniqueViolation as e:
+        if not is_request_id_conflict(e):
+            raise
+        return None
+    return order_id, order_number
+
+def is_request_id_conflict(error) -> bool:
+    """Уникальность нарушена именно по requestId, а не по номеру заказа или другому ключу"""
+    return error.diag.constraint_name == schema.REQUEST_ID_INDEX
+
+def assign_order_number(order_id: int, prefix: str) -> str:
+    """Номер для старой записи заказа, сохранённой без номера"""
+    order_number = generate_order_number(prefix)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE orders SET order_number = %s WHERE id = %s", (order_number, order_id))
+    return order_number
+
+def place_orders(entries):
+    """Пачка заказов одной транзакцией: номера — одним запросом на префикс, вставка — одним INSERT.
+
+    entries — список (данные заказа, префикс, контакт, request_id). Для каждой
+    записи возвращает (id, номер) или None, если заказ с таким requestId уже
+    создан другим запросом (такие строки пропускаются через ON CONFLICT по request_id).
+    """
+    positions = batch_prefix_positions(entries)
+    numbers = [None] * len(entries)
+    allocator = get_order_number_allocator()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Строки счётчиков блокируются в одном порядке, чтобы параллельные пачки не взаимоблокировались
+            for prefix in sorted(positions):
+                for index, number in zip(positions[prefix], allocator.allocate_many(prefix, len(positions[prefix]), cur=cur)):
+                    numbers[index] = number
+            rows = [
+                _order_row(dict(order_data, order_number=number), contact, request_id)
+                for (order_data, prefix, contact, request_id), number in zip(entries, numbers)
+            ]
+            inserted = execute_values(cur, ORDER_BATCH_INSERT_SQL, rows, page_size=len(rows), fetch=True)
+    return placed_orders(inserted, numbers)
+
+def batch_prefix_positions(entries) -> dict:
+    """Индексы записей пачки по префиксам номеров"""
+    positions = {}
+    for index, (order_data, prefix, contact, request_id) in enumerate(entries):
+        positions.setdefault(prefix, []).append(index)
+    return positions
+
+def placed_orders(inserted, numbers) -> list:
+    """(id, номер) для каждого номера пачки или None, если строка не вставилась"""
+    ids = {row['order_number']: row['id'] for row in inserted}
+    return [(ids[number], number) if number in ids else None for number in numbers]
+
+def mark_orders_notified(order_ids):
+    """Ставит notified_bool, когда Telegram принял уведомление продавцу (обработчик доставки очереди)"""
+    if not order_ids:
+        return
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE orders SET notified_bool = TRUE WHERE id = ANY(%s)", (list(order_ids),))
+
+def update_order_status(order_id: int, status: OrderStatus):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE orders SET status = %s WHERE id = %s",
+                (OrderStatus(status).value, order_id)
+            )
+            conn.commit()
+    order_cards.bump(order_id)
+
+def get_order_by_number(order_number: str):
+    logger.info(f"🔍 get_order_by_number: ищем заказ с номером '{order_number}'")
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM orders WHERE order_number = %s", (order_number,))
+            order = cur.fetchone()
+            if order:
+                order['contact'] = parse_contact(order['contact'])
+                order['items'] = parse_items(order['items'])
+            return order
+
+def get_order_by_request_id(request_id: str):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, order_number, notified_bool, contact FROM orders WHERE request_id = %s", (request_id,))
+            return cur.fetchone()
+
+def get_orders_by_request_ids(request_ids) -> dict:
+    if not request_ids:
+        return {}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, order_number, notified_bool, request_id FROM orders WHERE request_id = ANY(%s)",
+                (list(request_ids),)
+            )
+            return {row['request_id']: row for row in cur.fetchall()}
+
+def complete_order(order_id: int, order_number: str = None):
+    """Завершает заказ и в той же транзакции ставит уведомление складскому боту в outbox"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE orders SET status = %s, completed_at = %s WHERE id = %s",
+                        (OrderStatus.COMPLETED.value, datetime.utcnow().isoformat(), order_id))
+            if order_number:
+                outbox.add(cur, 'order_completed', {"order_number": order_number}, f"order-completed:{order_id}")
+            conn.commit()
+    order_cards.bump(order_id)
+    outbox.wakeup()
+
+def get_messages_for_order(order_id: int, before: tuple = None, limit: int = None):
+    """Последние limit сообщений заказа (раньше before, если задан) по возрастанию времени.
+
+    before — (created_at, id) самого раннего уже показанного сообщения.
+    Возвращает (сообщения, есть_более_ранние). Keyset по индексу (order_id, created_at).
+    """
+    limit = limit or ORDER_HISTORY_PAGE_SIZE
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(*messages_page_query(order_id, before, limit))
+            return messages_page(cur.fetchall(), limit)
+
+def messages_page_query(order_id: int, before: tuple, limit: int) -> tuple:
+    """(SQL, параметры) страницы истории; строк выбирается на одну больше limit.
+
+    id в ключе различает сообщения с одинаковым created_at — иначе на границе страниц они терялись бы.
+    """
+    return f"""
+        SELECT id, sender_role, text, created_at
+        FROM messages
+        WHERE order_id = %s {'AND (created_at, id) < (%s, %s)' if before else ''}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, (order_id, *before, limit + 1) if before else (order_id, limit + 1)
+
+def messages_page(messages: list, limit: int):
+    has_older = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, has_older
+
+HISTORY_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def format_history_cursor(message: dict) -> str:
+    """Курсор истории для callback_data: время и id сообщения, без '_' (по нему делится view_order_)"""
+    return f"{message['created_at'].strftime(HISTORY_CURSOR_FORMAT)}-{message['id']}"
+
+def parse_history_cursor(value: str):
+    """(created_at, id) из курсора истории или None"""
+    if not value:
+        return None
+    created_at, _, message_id = value.partition('-')
+    # В кнопках, отправленных до появления id в курсоре, только время: id 0 даёт прежнее created_at < t
+    return datetime.strptime(created_at, HISTORY_CURSOR_FORMAT), int(message_id or 0)
+
+def render_history(messages, budget: int):
+    """Строки переписки от новых к старым, пока помещаются в budget символов.
+
+    Сообщения, которые уже не влезут, не экранируются и не форматируются.
+    Возвращает (текст, число показанных сообщений).
+    """
+    lines = []
+    used = 0
+    for msg in reversed(messages):
+        sender = '👤 Покупатель' if msg['sender_role'] == 'buyer' else '🛒 Продавец'
+        created_str = msg['created_at'].strftime('%Y-%m-%d %H:%M') if msg['created_at'] else ''
+        prefix = f"{sender} ({created_str}): "
+        remaining = budget - used - len(prefix) - 1
+        text = msg['text'] or ''
+        # Экранирование только удлиняет текст: не влезает сырой — не влезет и экранированный
+        if len(text) > remaining:
+            if lines:
+                break
+            # Самое новое сообщение обрезаем; экранирование удлиняет текст не больше чем вдвое
+            text = text[:max(remaining // 2 - 1, 0)] + '…'
+        line = prefix + escape_markdown(text)
+        if used + len(line) + 1 > budget:
+            break
+        lines.append(line)
+        used += len(line) + 1
+    lines.reverse()
+    return "\n".join(lines), len(lines)
+
+def save_message(order_id: int, sender_id: int, sender_role: str, text: str):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO messages (order_id, sender_id, sender_role, text)
+                VALUES (%s, %s, %s, %s)
+            """, (order_id, sender_id, sender_role, text))
+            conn.commit()
+    order_cards.bump(order_id)
+
+def is_admin(telegram_id: int) -> bool:
+    return telegram_id == ADMIN_ID
+
+# ========== Диспетчеризация ==========
+class SenderContext:
+    """Роль и контекст отправителя, определяемые один раз на апдейт"""
+    __slots__ = ('user_id', 'seller', 'is_admin', 'active_order')
+
+    def __init__(self, user_id, seller=None, active_order=None):
+        self.user_id = user_id
+        self.seller = seller
+        self.is_admin = is_admin(user_id)
+        self.active_order = active_order
+
+    @property
+    def role(self) -> str:
+        if self.is_admin:
+            return 'admin'
+        if self.seller:
+            return 'seller'
+        if self.active_order:
+            return 'buyer'
+        return 'unknown'
+
+    @property
+    def is_staff(self) -> bool:
+        return self.is_admin or self.seller is not None
+
+BUYER_ACTIVE_ORDER_SQL = """
+    SELECT o.id, o.order_number, o.user_id, o.seller_id, o.contact, o.status,
+           s.telegram_id AS seller_telegram_id, s.name AS seller_name
+    FROM orders o
+    LEFT JOIN sellers s ON s.id = o.seller_id
+    WHERE o.user_id = %s AND o.status = 'active'
+    LIMIT 1
+"""
+
+def resolve_sender(user_id: int, with_buyer_order: bool = True) -> SenderContext:
+    """Получает запись продавца (из кэша справочников) и активный заказ покупателя с данными его продавца"""
+    seller = get_seller_by_telegram_id(user_id)
+    order = None
+    if with_buyer_order:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(BUYER_ACTIVE_ORDER_SQL, (user_id,))
+                order = cur.fetchone()
+        if order:
+            order['contact'] = parse_contact(order['contact'])
+    return SenderContext(user_id, seller, order)
+
+def get_sender(update) -> SenderContext:
+    """Контекст отправителя, сохранённый на апдейте диспетчером (или вычисленный на месте)"""
+    ctx = getattr(update, 'sender_context', None)
+    if ctx is None:
+        ctx = resolve_sender(update.from_user.id, with_buyer_order=isinstance(update, types.Message))
+        update.sender_context = ctx
+    return ctx
+
+def get_active_orders_page(seller_id: int = None, delivery_type: str = None, cursor: int = None,
+                           direction: str = 'next', limit: int = None):
+    """Страница активных заказов по убыванию id с keyset-пагинацией по orders.id.
+
+    direction='next' — заказы с id меньше cursor, 'prev' — с id больше cursor.
+    Возвращает (заказы, есть_предыдущая_страница, есть_следующая_страница).
+    """
+    limit = limit or ORDERS_PAGE_SIZE
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(*active_orders_page_query(seller_id, delivery_type, cursor, direction, limit))
+            return active_orders_page(cur.fetchall(), limit, cursor, direction)
+
+def active_orders_page_query(seller_id: int, delivery_type: str, cursor: int, direction: str, limit: int) -> tuple:
+    """(SQL, параметры) страницы активных заказов; строк выбирается на одну больше limit"""
+    conditions = ["o.status = 'active'"]
+    params = []
+    if seller_id is not None:
+        conditions.append("o.seller_id = %s")
+        params.append(seller_id)
+    if delivery_type:
+        conditions.append("o.delivery_type = %s")
+        params.append(delivery_type)
+    if cursor is not None:
+        conditions.append("o.id < %s" if direction == 'next' else "o.id > %s")
+        params.append(cursor)
+    params.append(limit + 1)
+    return f"""
+        SELECT o.id, o.order_number, s.name AS seller_name
+        FROM orders o
+        LEFT JOIN sellers s ON s.id = o.seller_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY o.id {'DESC' if direction == 'next' else 'ASC'}
+        LIMIT %s
+    """, params
+
+def active_orders_page(orders: list, limit: int, cursor: int, direction: str):
+    has_more = len(orders) > limit
+    orders = orders[:limit]
+    if direction == 'prev':
+        orders.reverse()
+        return orders, has_more, True
+    return orders, cursor is not None, has_more
+
+# Запрос /find хранится в callback_data кнопок листания, а она не длиннее 64 байт.
+# Листать дальше SEARCH_MAX_OFFSET нельзя — так смещение не отнимает место у запроса
+SEARCH_MAX_OFFSET = 9999
+SEARCH_CALLBACK_QUERY_BYTES = 64 - len(f'find:{SEARCH_MAX_OFFSET}:')
+# Ограничения запроса и страницы для /api/orders/search
+SEARCH_API_QUERY_BYTES = 200
+SEARCH_API_MAX_LIMIT = 50
+# Меньше цифр в запросе — это не телефон: по паре цифр совпадёт половина заказов
+SEARCH_MIN_PHONE_DIGITS = 4
+# Поисковые колонки готовит только python schema.py migrate; без них поиск выключен (check_schema)
+search_ready = True
+
+def normalize_search_query(text: str, max_bytes: int = SEARCH_CALLBACK_QUERY_BYTES) -> str:
+    """Запрос без лишних пробелов, обрезанный до max_bytes в UTF-8"""
+    query = ' '.join(text.split())
+    return query.encode()[:max_bytes].decode(errors='ignore').strip()
+
+def _like_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_orders_query(query: str, seller_id: int, offset: int, limit: int) -> tuple:
+    """(SQL, параметры) страницы поиска заказов; строк выбирается на одну больше limit.
+
+    Совпадения ищутся по поисковым колонкам orders (schema.migrate_order_search):
+    префикс номера заказа, цифры телефона, username и имя покупателя (pg_trgm).
+    Заказ получает вес самого сильного совпадения, при равенстве новые выше.
+    """
+    number = query.lstrip('#').upper()
+    text = query.lower().lstrip('@#')
+    digits = re.sub(r'\D', '', query)
+    # (условие, вес, параметр)
+    matches = [
+        ("o.order_number = %s", 1.0, number),
+        ("o.search_username = %s", 0.95, text),
+        ("o.order_number LIKE %s", 0.8, _like_escape(number) + '%'),
+    ]
+    if len(digits) >= SEARCH_MIN_PHONE_DIGITS:
+        matches.append(("o.search_phone LIKE %s", 0.9, '%' + digits + '%'))
+    matches.append(("o.search_name LIKE %s", 0.7, '%' + _like_escape(text) + '%'))
+
+    rank = ", ".join(f"CASE WHEN {condition} THEN {weight} ELSE 0 END" for condition, weight, _ in matches)
+    where = " OR ".join([condition for condition, _, _ in matches] + ["%s <%% o.search_name"])
+    params = [param for _, _, param in matches] + [text]
+    params += [param for _, _, param in matches] + [text]
+    scope = ""
+    if seller_id is not None:
+        scope = "AND o.seller_id = %s"
+        params.append(seller_id)
+    params += [limit + 1, offset]
+    return f"""
+        SELECT o.id, o.order_number, o.status, o.seller_id, o.total,
+               o.contact->>'name' AS buyer_name, o.contact->>'phone' AS phone,
+               o.contact->>'username' AS username, s.name AS seller_name,
+               GREATEST({rank}, word_similarity(%s, o.search_name)) AS rank
+        FROM orders o
+        LEFT JOIN sellers s ON s.id = o.seller_id
+        WHERE ({where}) {scope}
+        ORDER BY rank DESC, o.id DESC
+        LIMIT %s OFFSET %s
+    """, params
+
+def search_orders_page(orders: list, limit: int):
+    """(заказы, есть_следующая_страница)"""
+    return orders[:limit], len(orders) > limit
+
+def search_orders(query: str, seller_id: int = None, offset: int = 0, limit: int = None):
+    """Страница результатов поиска; seller_id ограничивает поиск заказами продавца"""
+    limit = limit or SEARCH_PAGE_SIZE
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(*search_orders_query(query, seller_id, offset, limit))
+            return search_orders_page(cur.fetchall(), limit)
+
+def search_scope(sender: SenderContext):
+    """seller_id для поиска: администратор ищет по всем заказам, продавец — только по своим"""
+    return None if sender.is_admin else sender.seller['id']
+
+def get_sellers_directory():
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, name FROM sellers ORDER BY name")
+            return cur.fetchall()
+
+# ========== Клавиатуры ==========
+def seller_keyboard():
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    keyboard.add(types.KeyboardButton("📋 Мои активные заказы"))
+    return keyboard
+
+def admin_keyboard():
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    keyboard.add(types.KeyboardButton("📋 Мои активные заказы"))
+    return keyboard
+
+def orders_callback(direction: str = 'next', cursor: int = None, seller_id: int = None, delivery_type: str = None) -> str:
+    """callback_data страницы списка заказов: orders:<n|p>:<cursor>:<seller_id>:<delivery_type>"""
+    return f"orders:{direction[0]}:{cursor or ''}:{seller_id or ''}:{delivery_type or ''}"
+
+def parse_orders_callback(data: str):
+    _, direction, cursor, seller_id, delivery_type = data.split(':')
+    return (
+        'prev' if direction == 'p' else 'next',
+        int(cursor) if cursor else None,
+        int(seller_id) if seller_id else None,
+        delivery_type or None
+    )
+
+DELIVERY_FILTERS = (('pickup', "🏪 Самовывоз"), ('courier', "🚚 Доставка"))
+
+def active_orders_scope(sender: SenderContext, seller_filter: int = None, delivery_filter: str = None) -> tuple:
+    """(seller_id, delivery_filter), по которым выбирать заказы для отправителя"""
+    if sender.is_admin:
+        return seller_filter, delivery_filter
+    # Продавец видит только свои заказы, фильтры из callback_data игнорируются
+    return sender.seller['id'], None
+
+def active_orders_view(sender: SenderContext, direction: str = 'next', cursor: int = None,
+                       seller_filter: int = None, delivery_filter: str = None):
+    """Текст и клавиатура страницы активных заказов; markup=None, если показывать нечего"""
+    seller_id, delivery_filter = active_orders_scope(sender, seller_filter, delivery_filter)
+    orders, has_prev, has_next = get_active_orders_page(seller_id, delivery_filter, cursor, direction)
+    if not orders and cursor is not None:
+        # Заказы на странице успели закрыть — возвращаемся к началу списка
+        orders, has_prev, has_next = get_active_orders_page(seller_id, delivery_filter)
+    return render_active_orders(sender, (orders, has_prev, has_next), seller_id, seller_filter, delivery_filter)
+
+def render_active_orders(sender: SenderContext, page: tuple, seller_id: int = None,
+                         seller_filter: int = None, delivery_filter: str = None):
+    orders, has_prev, has_next = page
+    filtered = sender.is_admin and (seller_filter or delivery_filter)
+    if not orders and not filtered:
+        return ("Нет активных заказов." if sender.is_admin else "У вас нет активных заказов."), None
+
+    if sender.is_admin:
+        title = "📋 *Все активные заказы:*"
+        if filtered:
+            parts = []
+            if seller_filter:
+                parts.append(f"продавец {escape_markdown(orders[0]['seller_name']) if orders else seller_filter}")
+            if delivery_filter:
+                parts.append(dict(DELIVERY_FILTERS).get(delivery_filter, delivery_filter))
+            title += f"\nФильтр: {', '.join(parts)}"
+        if not orders:
+            title += "\nНет заказов по выбранному фильтру."
+    else:
+        title = "📋 *Ваши активные заказы:*"
+    title += "\nВыберите заказ для просмотра деталей и истории сообщений."
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for order in orders:
+        label = f"Заказ {order['order_number']}"
+        if sender.is_admin:
+            label += f" ({order['seller_name'] or 'Неизвестный'})"
+        markup.add(types.InlineKeyboardButton(label, callback_data=f"view_order_{order['order_number']}"))
+
+    nav = []
+    if has_prev:
+        nav.append(types.InlineKeyboardButton("◀️ Предыдущие", callback_data=orders_callback(
+            'prev', orders[0]['id'], seller_id if sender.is_admin else None, delivery_filter)))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("Следующие ▶️", callback_data=orders_callback(
+            'next', orders[-1]['id'], seller_id if sender.is_admin else None, delivery_filter)))
+    if nav:
+        markup.row(*nav)
+
+    if sender.is_admin:
+        markup.row(*[
+            types.InlineKeyboardButton(
+                f"{'• ' if delivery_filter == value else ''}{label}",
+                callback_data=orders_callback(seller_id=seller_filter, delivery_type=None if delivery_filter == value else value)
+            )
+            for value, label in DELIVERY_FILTERS
+        ])
+        markup.row(
+            types.InlineKeyboardButton("👤 Продавец", callback_data=f"orders_sellers:{delivery_filter or ''}"),
+            types.InlineKeyboardButton("✖️ Сбросить", callback_data=orders_callback())
+        )
+    return title, markup
+
+ORDER_STATUS_ICONS = {OrderStatus.ACTIVE: '🟢', OrderStatus.COMPLETED: '✅', OrderStatus.CANCELLED: '❌'}
+
+def search_callback(query: str, offset: int) -> str:
+    """callback_data страницы поиска: find:<offset>:<запрос>"""
+    return f"find:{offset}:{query}"
+
+def parse_search_callback(data: str):
+    _, offset, query = data.split(':', 2)
+    return query, min(max(int(offset), 0), SEARCH_MAX_OFFSET)
+
+def render_search_results(sender: SenderContext, query: str, page: tuple, offset: int = 0):
+    """Текст и клавиатура страницы результатов /find"""
+    orders, has_next = page
+    text = f"🔍 *Поиск:* {escape_markdown(query)}"
+    if not orders:
+        return text + "\nНичего не найдено." + ("" if sender.is_admin else " Ищутся только ваши заказы."), None
+    text += "\nВыберите заказ для просмотра деталей и истории сообщений."
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for order in orders:
+        label = f"{ORDER_STATUS_ICONS.get(order['status'], '')} {order['order_number']} · {order['buyer_name'] or 'Без имени'}"
+        if sender.is_admin:
+            label += f" ({order['seller_name'] or 'Неизвестный'})"
+        markup.add(types.InlineKeyboardButton(label, callback_data=f"view_order_{order['order_number']}"))
+
+    nav = []
+    if offset > 0:
+        nav.append(types.InlineKeyboardButton("◀️ Предыдущие", callback_data=search_callback(query, max(offset - SEARCH_PAGE_SIZE, 0))))
+    if has_next and offset + SEARCH_PAGE_SIZE <= SEARCH_MAX_OFFSET:
+        nav.append(types.InlineKeyboardButton("Следующие ▶️", callback_data=search_callback(query, offset + SEARCH_PAGE_SIZE)))
+    elif has_next:
+        text += "\nДальше не листается — уточните запрос."
+    if nav:
+        markup.row(*nav)
+    return text, markup
+
+def search_orders_view(sender: SenderContext, query: str, offset: int = 0):
+    """Текст и клавиатура страницы результатов /find"""
+    page = search_orders(query, search_scope(sender), offset)
+    return render_search_results(sender, query, page, offset)
+
+def search_query_from_command(text: str):
+    """Запрос из «/find <запрос>» или None, если он слишком короткий"""
+    parts = text.split(maxsplit=1)
+    query = normalize_search_query(parts[1]) if len(parts) > 1 else ''
+    return query if len(query) >= SEARCH_MIN_QUERY else None
+
+FIND_USAGE = "Использование: /find <номер заказа, телефон, имя или username покупателя>"
+SEARCH_UNAVAILABLE = "🔍 Поиск заказов пока недоступен: база ещё не подготовлена."
+
+def parse_search_args(args):
+    """Параметры /api/orders/search: ((запрос, offset, limit), None) или (None, (тело ошибки, HTTP-код))"""
+    query = normalize_search_query(args.get('q') or '', SEARCH_API_QUERY_BYTES)
+    try:
+        offset = max(int(args.get('offset') or 0), 0)
+        limit = min(max(int(args.get('limit') or SEARCH_PAGE_SIZE), 1), SEARCH_API_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return None, ({'error': 'Invalid offset or limit'}, 400)
+    if len(query) < SEARCH_MIN_QUERY:
+        return None, ({'error': f'Query must be at least {SEARCH_MIN_QUERY} characters'}, 400)
+    return (query, offset, limit), None
+
+def webapp_user_id(init_data: str, max_age: int = WEBAPP_AUTH_MAX_AGE):
+    """id пользователя из initData мини-аппа или None, если подпись Telegram неверна или устарела.
+
+    Проверка по документации WebApp: ключ — HMAC-SHA256 токена бота с ключом "WebAppData",
+    подписаны все поля, кроме hash, строками key=value по алфавиту через перевод строки.
+    """
+    if not init_data:
+        return None
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received = fields.pop('hash', '')
+    check_string = '\n'.join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    try:
+        if max_age and time.time() - int(fields['auth_date']) > max_age:
+            return None
+        return int(json.loads(fields['user'])['id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def search_response(orders: list, has_next: bool, offset: int, limit: int) -> dict:
+    return {
+        'orders': [{
+            'orderNumber': o['order_number'],
+            'status': o['status'],
+            'sellerId': o['seller_id'],
+            'sellerName': o['seller_name'],
+            'buyerName': o['buyer_name'],
+            'phone': o['phone'],
+            'username': o['username'],
+            # NUMERIC приходит Decimal, которого нет в JSON
+            'total': float(o['total']) if isinstance(o['total'], Decimal) else o['total'],
+            'rank': round(float(o['rank']), 3),
+        } for o in orders],
+        'nextOffset': offset + limit if has_next else None,
+    }
+
+def sellers_filter_markup(sellers, delivery_filter: str = None) -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*[
+        types.InlineKeyboardButton(s['name'], callback_data=orders_callback(seller_id=s['id'], delivery_type=delivery_filter))
+        for s in sellers
+    ])
+    markup.row(types.InlineKeyboardButton("Все продавцы", callback_data=orders_callback(delivery_type=delivery_filter)))
+    return markup
+
+def render_order_card(order: dict, messages: list, has_older: bool, history_before: tuple = None):
+    """Текст и клавиатура карточки заказа; возвращает (текст, клавиатура)"""
+    order_num = order['order_number']
+    contact = order['contact']
+    logger.info("Формируем текст заказа")
+    info = templates.ORDER_CARD.render(
+        order_number=order_num,
+        buyer_name=contact.get('name', 'Неизвестно'),
+        address=contact.get('address', 'Не указан'),
+        phone=contact.get('phone', 'Не указан'),
+        username=username_label(contact.get('username')),
+        payment=payment_label(contact.get('paymentMethod')),
+        delivery=delivery_label(order.get('delivery_type')),
+        items=render_items(order['items']),
+        total=order['total'],
+    )
+    logger.info("Текст заказа сформирован")
+
+    if messages:
+        title = "\n💬 *История переписки:*\n"
+        # Запас на разметку и подсчёт длины Telegram после разбора Markdown
+        budget = TELEGRAM_MESSAGE_LIMIT - len(info) - len(title) - 100
+        history, shown = render_history(messages, budget)
+        if shown < len(messages):
+            has_older = True
+            messages = messages[-shown:] if shown else []
+        if history:
+            info += title + history
+        else:
+            info += title + "Сообщения не помещаются в карточку заказа."
+    else:
+        info += "\n💬 *История переписки:*\nПока нет сообщений."
+    logger.info("История переписки добавлена")
+
+    markup = types.InlineKeyboardMarkup()
+    history_buttons = []
+    if has_older and messages:
+        history_buttons.append(types.InlineKeyboardButton(
+            "⏪ Ранние сообщения",
+            callback_data=f"view_order_{order_num}_{format_history_cursor(messages[0])}"
+        ))
+    if history_before:
+        history_buttons.append(types.InlineKeyboardButton("Последние ⏩", callback_data=f"view_order_{order_num}"))
+    if history_buttons:
+        markup.row(*history_buttons)
+    if order['status'] == OrderStatus.ACTIVE:
+        markup.row(
+            types.InlineKeyboardButton("✅ Завершить", callback_data=f"complete_{order_num}"),
+            types.InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_{order_num}")
+        )
+    else:
+        markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_orders"))
+    logger.info("Клавиатура сформирована")
+    return info, markup
+
+update_dedup = UpdateDeduplicator(
+    window=UPDATE_DEDUP_WINDOW,
+    get_connection=get_db_connection if UPDATE_DEDUP_DB else None
+)
+
+def json_body(content_type: str, body: bytes) -> tuple:
+    """JSON-тело запроса: (данные, None) или (None, (тело ошибки, HTTP-код)) — 415 или 400, а не 500"""
+    mimetype = (content_type or '').split(';')[0].strip().lower()
+    if mimetype != 'application/json' and not mimetype.endswith('+json'):
+        return None, ({'error': 'Content-Type must be application/json'}, 415)
+    try:
+        return (json.loads(body) if body else None), None
+    except ValueError:
+        return None, ({'error': 'Invalid JSON'}, 400)
+
+metrics.add_counter('bot_update_duplicates_total', 'Redelivered updates dropped', lambda: update_dedup.duplicates)
+
+order_requests = IdempotentRequests(maxsize=ORDER_REQUEST_CACHE_SIZE)
+
+def new_order_messages(order_number: str, seller: dict, data: dict, contact: dict) -> dict:
+    """Тексты уведомлений о новом заказе: продавцу, админу (и строка для сводки) и покупателю"""
+    fields = dict(
+        order_number=order_number,
+        buyer_name=data.get('name', 'Покупатель'),
+        phone=contact.get('phone', 'не указан'),
+        username=username_label(contact.get('username', 'не указан')),
+        address=data.get('address'),
+        # Состав отрисовывается один раз и переиспользуется во всех сообщениях
+        items=render_items(data.get('items')),
+        total=data.get('total'),
+        payment=payment_label(data.get('paymentMethod')),
+        delivery=delivery_label(data.get('deliveryType')),
+    )
+    return {
+        'seller': templates.NEW_ORDER_SELLER.render(**fields),
+        'admin': templates.NEW_ORDER_ADMIN.render(seller_name=seller['name'], **fields),
+        'buyer': templates.NEW_ORDER_BUYER.render(date=datetime.now().strftime('%d %B'), **fields),
+        # Строка сводки для администратора, простым текстом: состав есть в карточке заказа
+        'admin_summary': f"🆕 Новый заказ: продавец {seller['name']}, покупатель {fields['buyer_name']}, {fields['total']} руб.",
+    }
+
+def order_actions_markup(order_numbers) -> types.InlineKeyboardMarkup:
+    """Кнопки завершения и отмены; в сводке по нескольким заказам подписаны номерами"""
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    single = len(order_numbers) == 1
+    for order_number in order_numbers:
+        markup.add(
+            types.InlineKeyboardButton("✅ Завершить" if single else f"✅ {order_number}", callback_data=f"complete_{order_number}"),
+            types.InlineKeyboardButton("❌ Отменить" if single else f"❌ {order_number}", callback_data=f"cancel_{order_number}")
+        )
+    return markup
+
+# Сколько заказов помещать в одно сводное сообщение продавцу
+NEW_ORDERS_PER_MESSAGE = 10
+ORDER_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+def _group_messages(texts, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Склеивает тексты в сообщения не длиннее limit и не больше NEW_ORDERS_PER_MESSAGE штук"""
+    groups = []
+    for index, text in enumerate(texts):
+        if groups:
+            last = groups[-1]
+            length = sum(len(texts[i]) for i in last) + len(ORDER_SEPARATOR) * len(last) + len(text)
+            if len(last) < NEW_ORDERS_PER_MESSAGE and length <= limit:
+                last.append(index)
+                continue
+        groups.append([index])
+    return groups
+
+def orders_by_seller(placed) -> dict:
+    """Созданные заказы пачки по чатам продавцов, для сводных уведомлений"""
+    by_seller = {}
+    for entry in placed:
+        by_seller.setdefault(entry[2]['telegram_id'], []).append(entry)
+    return by_seller
+
+def validate_order(data):
+    """None, если заказ можно создавать, иначе (тело ошибки, HTTP-код)"""
+    if not isinstance(data, dict):
+        return {'error': 'Invalid order'}, 400
+    if not all([data.get('userId'), data.get('items'), data.get('total'), data.get('address')]):
+        return {'error': 'Missing required fields'}, 400
+    return None
+
+def resolve_order_route(delivery: str, address: str) -> tuple:
+    """Продавец, префикс номера и id точки самовывоза для заказа.
+
+    Возвращает ((продавец, префикс, address_id), None) или (None, (тело ошибки, HTTP-код)).
+    Справочники кэшированы, так что обычно запросов к БД нет вовсе.
+    """
+    if delivery == 'courier':
+        return order_route(delivery, address, admin_seller=get_admin_seller())
+    return order_route(delivery, address, pickup_info=get_pickup_location_info(address))
+
+def order_route(delivery: str, address: str, admin_seller: dict = None, pickup_info: dict = None) -> tuple:
+    """То же по уже полученным записям: админу для доставки или точке самовывоза"""
+    if delivery == 'courier':
+        # Для доставки используем администратора
+        seller = admin_seller
+        if not seller:
+            logger.error("Администратор не найден в таблице sellers")
+            return None, ({'error': 'Admin seller not found'}, 500)
+        
+        prefix = 'D'
+        logger.info(f"Заказ с доставкой, назначен админ: id={seller['id']}, name={seller['name']}, prefix={prefix}")
+        return (seller, prefix, None), None
+
+    # Для самовывоза точка уже содержит продавца
+    if not pickup_info:
+        logger.error(f"Не найден адрес самовывоза: {address}")
+        return None, ({'error': 'Invalid pickup address'}, 404)
+    
+    seller = {'id': pickup_info['seller_id'], 'name': pickup_info['name'], 'telegram_id': pickup_info['telegram_id']}
+    # Если префикс не задан в точке, используем первую букву имени продавца
+    prefix = pickup_info['prefix'] or seller['name'][0].upper()
+    
+    logger.info(f"Найден адрес самовывоза: продавец {seller['name']} (id {seller['id']}), префикс {prefix}")
+    return (seller, prefix, pickup_info['address_id']), None
+
+def new_order_record(data: dict, seller: dict, address_id: int = None) -> tuple:
+    """Данные строки orders и контакт для нового заказа"""
+    contact = data.get('contact')
+    if not contact:
+        contact = {
+            'name': data.get('name', 'Покупатель'),
+            'phone': '0000000000',
+            'address': data.get('address'),
+            'paymentMethod': data.get('paymentMethod'),
+            'deliveryType': data.get('deliveryType')
+        }
+
+    order_data = {
+        'user_id': data.get('userId'),
+        'seller_id': seller['id'],
+        'address_id': address_id,
+        'items': data.get('items'),
+        'total': data.get('total'),
+        'status': OrderStatus.ACTIVE,
+        'delivery_type': data.get('deliveryType')
+    }
+    return order_data, contact
+
+def parse_order_batch(data) -> tuple:
+    """Заказы из тела /api/new-orders: (список, None) или (None, (тело ошибки, HTTP-код))"""
+    orders = data.get('orders') if isinstance(data, dict) else data
+    if not orders or not isinstance(orders, list):
+        return None, ({'error': 'No orders'}, 400)
+    if len(orders) > BATCH_ORDERS_MAX:
+        return None, ({'error': f'Too many orders, max {BATCH_ORDERS_MAX}'}, 413)
+    return orders, None
+
+class OrderBatch:
+    """Общая часть /api/new-orders: проверка заказов, повторы requestId и ответ.
+
+    Поиск в БД, создание заказов и уведомления front-end делает сам — между
+    созданием пачки и finish(). fresh — индексы заказов, которые ещё нужно
+    найти в БД или создать.
+    """
+
+    def __init__(self, orders: list):
+        self.orders = orders
+        self.results = [None] * len(orders)
+        self.fresh = []
+        self.first_by_request = {}
+        self.repeats = {}
+        for index, data in enumerate(orders):
+            error = validate_order(data)
+            if error:
+                self.failed(index, error)
+                continue
+            request_id = data.get('requestId')
+            if request_id:
+                cached = order_requests.get(request_id)
+                if cached is not None:
+                    self.ok(index, cached[0]['orderNumber'])
+                    continue
+                if request_id in self.first_by_request:
+                    self.repeats[index] = self.first_by_request[request_id]
+                    continue
+                self.first_by_request[request_id] = index
+            self.fresh.append(index)
+
+    def ok(self, index, order_number):
+        self.results[index] = {'index': index, 'status': 'ok', 'orderNumber': order_number}
+
+    def failed(self, index, error):
+        body, code = error
+        self.results[index] = {'index': index, 'status': 'error', 'error': body['error'], 'code': code}
+
+    def finish(self) -> dict:
+        """Тело ответа: общий статус и результат по каждому заказу в исходном порядке"""
+        results = self.results
+        for index, first in self.repeats.items():
+            results[index] = dict(results[first], index=index)
+        for index, data in enumerate(self.orders):
+            if isinstance(data, dict) and data.get('requestId'):
+                results[index]['requestId'] = data['requestId']
+                if results[index]['status'] == 'ok':
+                    order_requests.remember(data['requestId'], ({'status': 'ok', 'orderNumber': results[index]['orderNumber']}, 200))
+        succeeded = sum(1 for r in results if r['status'] == 'ok')
+        if succeeded == len(results):
+            status = 'ok'
+        elif succeeded:
+            status = 'partial'
+        else:
+            status = 'error'
+        return {'status': status, 'results': results}
+
+def check_schema():
+    """Не даёт запуститься на схеме, которую миграции не довели до нужного вида"""
+    global search_ready
+    problems = schema.verify(DATABASE_URL, with_outbox=bool(outbox.routes), with_update_dedup=UPDATE_DEDUP_DB)
+    if problems:
+        raise RuntimeError(f"Схема БД не готова: {'; '.join(problems)}. Выполните python schema.py migrate")
+    search_ready = schema.search_ready(DATABASE_URL)
+    if not search_ready:
+        logger.warning("Поиск заказов выключен: выполните python schema.py migrate и перезапустите бота")
+
+def db_pool_size() -> int:
+    return _db_pool.size if _db_pool else 0
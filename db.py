@@ -0,0 +1,170 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений PostgreSQL.
+
+    Держит от minconn до maxconn открытых соединений, проверяет соединение
+    при выдаче (если оно долго простаивало) и закрывает лишние соединения,
+    простаивающие дольше max_idle секунд.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=10.0, max_idle=300.0,
+                 max_lifetime=3600.0, check_after=30.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Некорректные размеры пула: minconn=%s, maxconn=%s" % (minconn, maxconn))
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        # Свободные соединения: (conn, время возврата в пул)
+        self._idle = []
+        # Время создания каждого открытого соединения
+        self._created = {}
+        self._closed = False
+        # Соединения, которые устанавливаются прямо сейчас
+        self._opening = 0
+
+        for _ in range(minconn):
+            conn = self._connect()
+            self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+
+    @property
+    def size(self):
+        return len(self._created)
+
+    def _is_alive(self, conn, idle_for):
+        if conn.closed:
+            return False
+        age = time.monotonic() - self._created.get(id(conn), 0)
+        if self.max_lifetime and age > self.max_lifetime:
+            return False
+        if idle_for < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Соединение из пула не прошло проверку: {e}")
+            return False
+
+    def _recycle_idle(self, now):
+        """Закрывает соединения сверх minconn, простаивающие дольше max_idle"""
+        if not self.max_idle:
+            return
+        keep = []
+        for conn, returned_at in self._idle:
+            if self.size > self.minconn and now - returned_at > self.max_idle:
+                self._discard(conn)
+            else:
+                keep.append((conn, returned_at))
+        self._idle = keep
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolError("Пул соединений закрыт")
+                now = time.monotonic()
+                self._recycle_idle(now)
+                if self._idle:
+                    # Берём последнее возвращённое — оно «теплее» остальных
+                    conn, returned_at = self._idle.pop()
+                elif self.size + self._opening < self.maxconn:
+                    conn, returned_at = None, None
+                    self._opening += 1
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolTimeout(f"Нет свободных соединений (maxconn={self.maxconn})")
+                    self._cond.wait(remaining)
+                    continue
+
+            # Проверка и установка соединения выполняются вне блокировки
+            if conn is None:
+                try:
+                    return self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+            if self._is_alive(conn, now - returned_at):
+                return conn
+            with self._cond:
+                self._discard(conn)
+
+    def putconn(self, conn, discard=False):
+        with self._cond:
+            if id(conn) not in self._created:
+                return
+            if not discard and not conn.closed:
+                try:
+                    if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except Exception:
+                    discard = True
+            if discard or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Выдаёт соединение; при выходе фиксирует транзакцию и возвращает его в пул"""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken or conn.closed)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
@@ -0,0 +1,82 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """Отбрасывает повторные доставки апдейтов Telegram по update_id.
+
+    Сначала проверяется окно последних window id в памяти процесса. Если
+    передан get_connection, id дополнительно «застолбляется» в таблице
+    webhook_updates (INSERT ... ON CONFLICT DO NOTHING): так повтор
+    отсеивается и после перезапуска, и на другом инстансе. Telegram хранит
+    недоставленные апдейты не дольше суток, поэтому записи старше retention
+    периодически удаляются. Таблицу создаёт миграция в schema.py.
+    """
+
+    def __init__(self, window=10000, get_connection=None, retention_hours=48, prune_interval=3600.0):
+        self.window = window
+        self.get_connection = get_connection
+        self.retention_hours = retention_hours
+        self.prune_interval = prune_interval
+        # update_id в порядке поступления; порядок нужен для вытеснения старых
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self.duplicates = 0
+
+    def _remember(self, update_id) -> bool:
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = None
+            while len(self._seen) > self.window:
+                self._seen.popitem(last=False)
+            return True
+
+    def _claim(self, update_id) -> bool:
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO webhook_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING",
+                    (update_id,)
+                )
+                claimed = cur.rowcount == 1
+                now = time.monotonic()
+                if now - self._last_prune > self.prune_interval:
+                    self._last_prune = now
+                    cur.execute(
+                        "DELETE FROM webhook_updates WHERE received_at < now() - make_interval(hours => %s)",
+                        (self.retention_hours,)
+                    )
+        return claimed
+
+    def is_new(self, update_id) -> bool:
+        """True, если апдейт видим впервые (и запоминает его)"""
+        if not self._remember(update_id):
+            self.duplicates += 1
+            return False
+        if self.get_connection is not None:
+            try:
+                if not self._claim(update_id):
+                    self.duplicates += 1
+                    return False
+            except Exception as e:
+                # Без БД полагаемся только на окно в памяти
+                logger.error(f"Не удалось проверить update_id {update_id} в БД: {e}")
+        return True
+
+    def forget(self, update_id):
+        """Снимает отметку, если апдейт так и не был принят в обработку"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.get_connection is not None:
+            try:
+                with self.get_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("DELETE FROM webhook_updates WHERE update_id = %s", (update_id,))
+            except Exception as e:
+                logger.error(f"Не удалось снять отметку update_id {update_id}: {e}")
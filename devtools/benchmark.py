@@ -0,0 +1,473 @@
+"""Нагрузочный прогон bot.py: Flask-приложение на локальном Postgres,
+имитация Telegram Bot API (fake_telegram.py) и заглушка складского бота
+(stub_stock_bot.py).
+
+Сценарии шлют синтетические /api/new-order, /api/new-orders и апдейты
+вебхука с заданной частотой и печатают p50/p95/p99, пропускную способность,
+число запросов к БД и вызовов Telegram на операцию. Для апдейтов вебхука
+задержка меряется от начала до конца обработки апдейта хэндлером.
+
+Нужна отдельная одноразовая база: скрипт создаёт в ней таблицы бота,
+заполняет справочники, а с --reset очищает orders и messages.
+
+    python devtools/benchmark.py --database-url postgresql://localhost/bot_bench --reset
+    python devtools/benchmark.py --database-url ... --count 1000 --rate 100 --json after.json
+    python devtools/benchmark.py --database-url ... --baseline before.json --tolerance 0.2
+
+С --baseline скрипт завершается с кодом 1, если p95 или число запросов к
+БД на операцию выросли больше чем на tolerance.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import psycopg2
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from devtools.fake_telegram import FakeTelegramAPI
+from devtools.stub_stock_bot import StubStockBot
+
+logger = logging.getLogger('benchmark')
+
+BENCH_TOKEN = '123456:benchmark'
+ADMIN_TELEGRAM_ID = 900000
+SELLER_TELEGRAM_ID = 900001
+BUYER_TELEGRAM_ID = 700000
+
+# Таблицы в том виде, в каком их ждёт bot.py (миграции schema.py доведут их до текущей схемы)
+FIXTURE_SQL = """
+    CREATE TABLE IF NOT EXISTS sellers (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        name TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS pickup_locations (
+        id SERIAL PRIMARY KEY,
+        address TEXT NOT NULL,
+        seller_id INTEGER REFERENCES sellers(id),
+        prefix VARCHAR(3)
+    );
+    CREATE TABLE IF NOT EXISTS orders (
+        id SERIAL PRIMARY KEY,
+        order_number VARCHAR(20),
+        user_id BIGINT NOT NULL,
+        seller_id INTEGER REFERENCES sellers(id),
+        address_id INTEGER REFERENCES pickup_locations(id),
+        items TEXT,
+        total NUMERIC,
+        contact TEXT,
+        status TEXT DEFAULT 'active',
+        request_id TEXT,
+        notified_bool BOOLEAN DEFAULT FALSE,
+        delivery_type TEXT,
+        created_at TIMESTAMP DEFAULT now(),
+        completed_at TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL PRIMARY KEY,
+        order_id INTEGER REFERENCES orders(id),
+        sender_id BIGINT,
+        sender_role TEXT,
+        text TEXT,
+        created_at TIMESTAMP DEFAULT now()
+    );
+"""
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def prepare_database(dsn, sellers, reset):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(FIXTURE_SQL)
+        if reset:
+            cur.execute("TRUNCATE messages, orders RESTART IDENTITY CASCADE")
+        cur.execute("SELECT count(*) FROM sellers WHERE telegram_id = %s", (ADMIN_TELEGRAM_ID,))
+        if cur.fetchone()[0] == 0:
+            cur.execute("INSERT INTO sellers (telegram_id, name) VALUES (%s, 'Bench admin')", (ADMIN_TELEGRAM_ID,))
+        addresses = []
+        for i in range(sellers):
+            telegram_id = SELLER_TELEGRAM_ID + i
+            address = f"Bench address {i}"
+            cur.execute("SELECT id FROM sellers WHERE telegram_id = %s", (telegram_id,))
+            row = cur.fetchone()
+            seller_id = row[0] if row else None
+            if seller_id is None:
+                cur.execute("INSERT INTO sellers (telegram_id, name) VALUES (%s, %s) RETURNING id",
+                            (telegram_id, f"Bench seller {i}"))
+                seller_id = cur.fetchone()[0]
+            cur.execute("SELECT 1 FROM pickup_locations WHERE address = %s", (address,))
+            if cur.fetchone() is None:
+                cur.execute("INSERT INTO pickup_locations (address, seller_id, prefix) VALUES (%s, %s, %s)",
+                            (address, seller_id, f"B{i % 100}"))
+            addresses.append(address)
+    conn.close()
+    return addresses
+
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.operations = 0
+        self.elapsed = 0.0
+        self.db_queries = 0
+        self.telegram_calls = 0
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        ops = max(self.operations, 1)
+        return {
+            'scenario': self.name,
+            'operations': self.operations,
+            'errors': self.errors,
+            'throughput': self.operations / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'db_queries_per_op': self.db_queries / ops,
+            'telegram_calls_per_op': self.telegram_calls / ops,
+        }
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.run_id = f"{int(time.time())}-{random.randint(0, 9999)}"
+        self._update_id = int(time.time() * 1000)
+        self._lock = threading.Lock()
+        self.telegram = FakeTelegramAPI(delay=args.telegram_delay, flood_rate=args.flood_rate).start()
+        self.stock_bot = StubStockBot(delay=args.stock_delay).start()
+        self.addresses = prepare_database(args.database_url, args.sellers, args.reset)
+
+        os.environ.update({
+            'BOT_TOKEN': BENCH_TOKEN,
+            'DATABASE_URL': args.database_url,
+            'ADMIN_ID': str(ADMIN_TELEGRAM_ID),
+            'STOCK_BOT_URL': self.stock_bot.url,
+            'METRICS_ENABLED': '1',
+        })
+        import bot
+        import schema
+        from telebot import apihelper
+        apihelper.API_URL = self.telegram.api_url
+        schema.apply_migrations(args.database_url, rewrites=True)
+        schema.bootstrap(args.database_url, explain=False)
+        self.bot = bot
+        bot.outbox.start()
+
+        self.server = make_server('127.0.0.1', 0, bot.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=args.concurrency)
+        self.session.mount('http://', adapter)
+
+        self.created = []       # (номер заказа, id покупателя, telegram_id продавца)
+        self.request_ids = []
+
+    def close(self):
+        self.server.shutdown()
+        self.telegram.stop()
+        self.stock_bot.stop()
+
+    # ---------- нагрузка ----------
+
+    def _drain(self, timeout=60.0):
+        """Ждёт, пока обработаются апдейты и уйдут все сообщения из очереди отправки"""
+        deadline = time.monotonic() + timeout
+        self.bot.update_executor.join()
+        while self.bot.send_queue.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self, name, make_request, count):
+        """Отправляет count запросов с частотой --rate (0 — без ограничения) в --concurrency потоков"""
+        result = Result(name)
+        db_before = self.bot.metrics.db_query_seconds.totals()[0]
+        tg_before = self.telegram.total_calls()
+        rate = self.args.rate
+        started = time.perf_counter()
+
+        def one(i):
+            if rate:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            return make_request(i)
+
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for outcome in pool.map(one, range(count)):
+                if outcome is None:
+                    continue
+                latency, ok = outcome
+                result.operations += 1
+                if latency is not None:
+                    result.latencies.append(latency)
+                if not ok:
+                    result.errors += 1
+        self._drain()
+        result.elapsed = time.perf_counter() - started
+        result.db_queries = self.bot.metrics.db_query_seconds.totals()[0] - db_before
+        result.telegram_calls = self.telegram.total_calls() - tg_before
+        return result
+
+    def _post(self, path, payload):
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.base_url + path, json=payload, timeout=30)
+            return time.perf_counter() - started, response
+        except requests.RequestException as e:
+            logger.warning(f"{path}: {e}")
+            return time.perf_counter() - started, None
+
+    def _order_payload(self, i):
+        buyer = BUYER_TELEGRAM_ID + i % self.args.buyers
+        courier = i % 5 == 0
+        return {
+            'userId': buyer,
+            'name': f"Покупатель {i}",
+            'items': [
+                {'name': 'Товар', 'variantName': 'большой', 'quantity': 2, 'price': 150},
+                {'name': 'Другой_товар', 'quantity': 1, 'price': 90},
+            ],
+            'total': 390,
+            'address': 'ул. Курьерская, 1' if courier else self.addresses[i % len(self.addresses)],
+            'paymentMethod': 'cash' if i % 2 else 'transfer',
+            'deliveryType': 'courier' if courier else 'pickup',
+            'contact': {'phone': '+7 (900) 000-00-00', 'username': f'bench_{i}', 'name': f"Покупатель {i}"},
+            'requestId': f"bench-{self.run_id}-{i}",
+        }
+
+    def _remember(self, payload, order_number):
+        seller = ADMIN_TELEGRAM_ID if payload['deliveryType'] == 'courier' else \
+            SELLER_TELEGRAM_ID + self.addresses.index(payload['address'])
+        with self._lock:
+            self.created.append((order_number, payload['userId'], seller))
+            self.request_ids.append(payload['requestId'])
+
+    def new_order(self, count):
+        retry_rate = self.args.retry_rate
+
+        def request(i):
+            with self._lock:
+                retry = self.request_ids and random.random() < retry_rate
+                request_id = random.choice(self.request_ids) if retry else None
+            payload = self._order_payload(i)
+            if request_id:
+                payload['requestId'] = request_id
+            latency, response = self._post('/api/new-order', payload)
+            ok = response is not None and response.status_code == 200
+            if ok and not request_id:
+                self._remember(payload, response.json()['orderNumber'])
+            return latency, ok
+
+        return self._run('new_order', request, count)
+
+    def new_orders_batch(self, count):
+        size = self.args.batch_size
+
+        def request(i):
+            payloads = [self._order_payload(count + i * size + j) for j in range(size)]
+            latency, response = self._post('/api/new-orders', {'orders': payloads})
+            if response is None or response.status_code != 200:
+                return latency, False
+            results = response.json()['results']
+            for payload, result in zip(payloads, results):
+                if result['status'] == 'ok':
+                    self._remember(payload, result['orderNumber'])
+            return latency, all(r['status'] == 'ok' for r in results)
+
+        return self._run(f'new_orders_batch[{size}]', request, max(1, count // size))
+
+    # ---------- апдейты вебхука ----------
+
+    def _next_update_id(self):
+        with self._lock:
+            self._update_id += 1
+            return self._update_id
+
+    def _user(self, telegram_id):
+        return {'id': telegram_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def _message_update(self, telegram_id, text):
+        update_id = self._next_update_id()
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': telegram_id, 'type': 'private'},
+            'from': self._user(telegram_id), 'text': text,
+        }}
+
+    def _callback_update(self, telegram_id, data):
+        update_id = self._next_update_id()
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': 'bench', 'data': data,
+            'from': self._user(telegram_id),
+            'message': {'message_id': 1, 'date': int(time.time()),
+                        'chat': {'id': telegram_id, 'type': 'private'}, 'text': 'card'},
+        }}
+
+    def _webhook_run(self, name, make_update, count):
+        """Задержка апдейта — время его обработки хэндлером в потоке update_executor"""
+        executor = self.bot.update_executor
+        original = executor.handler
+        timings = []
+        errors_before = self.bot.metrics.requests_total.total(kind='handler', status='error')
+
+        def timed(update):
+            started = time.perf_counter()
+            try:
+                original(update)
+            finally:
+                timings.append(time.perf_counter() - started)
+
+        def request(i):
+            latency, response = self._post('/webhook', make_update(i))
+            return None, response is not None and response.status_code == 200
+
+        executor.handler = timed
+        try:
+            result = self._run(name, request, count)
+        finally:
+            executor.handler = original
+        result.latencies = timings
+        result.errors += int(self.bot.metrics.requests_total.total(kind='handler', status='error') - errors_before)
+        return result
+
+    def _orders(self):
+        if not self.created:
+            raise RuntimeError("Нет созданных заказов: сначала нужен сценарий new_order или new_orders_batch")
+        return self.created
+
+    def buyer_message(self, count):
+        orders = self._orders()
+        return self._webhook_run('buyer_message', lambda i: self._message_update(
+            orders[i % len(orders)][1], f"Вопрос по заказу №{i}"), count)
+
+    def seller_reply(self, count):
+        orders = self._orders()
+
+        def update(i):
+            order_number, buyer, seller = orders[i % len(orders)]
+            return self._message_update(seller, f"#{order_number} Ответ продавца {i}")
+
+        return self._webhook_run('seller_reply', update, count)
+
+    def view_order(self, count):
+        orders = self._orders()
+
+        def update(i):
+            order_number, buyer, seller = orders[i % len(orders)]
+            return self._callback_update(seller, f"view_order_{order_number}")
+
+        return self._webhook_run('view_order', update, count)
+
+    def orders_list(self, count):
+        sellers = sorted({seller for _, _, seller in self._orders()})
+        return self._webhook_run('orders_list', lambda i: self._message_update(
+            sellers[i % len(sellers)], "📋 Мои активные заказы"), count)
+
+
+SCENARIOS = ('new_order', 'new_orders_batch', 'buyer_message', 'seller_reply', 'view_order', 'orders_list')
+
+
+def print_report(summaries):
+    header = f"{'сценарий':<24}{'операций':>9}{'ошибок':>8}{'оп/с':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'БД/оп':>8}{'TG/оп':>8}"
+    print(header)
+    print('-' * len(header))
+    for s in summaries:
+        print(f"{s['scenario']:<24}{s['operations']:>9}{s['errors']:>8}{s['throughput']:>9.1f}"
+              f"{s['p50_ms']:>9.1f}{s['p95_ms']:>9.1f}{s['p99_ms']:>9.1f}"
+              f"{s['db_queries_per_op']:>8.2f}{s['telegram_calls_per_op']:>8.2f}")
+
+
+def compare(summaries, baseline, tolerance):
+    """Список регрессий относительно прошлого прогона"""
+    previous = {s['scenario']: s for s in baseline}
+    regressions = []
+    for s in summaries:
+        before = previous.get(s['scenario'])
+        if not before:
+            continue
+        for key in ('p95_ms', 'db_queries_per_op'):
+            limit = before[key] * (1 + tolerance)
+            # Небольшой абсолютный допуск, чтобы не ловить шум на почти нулевых значениях
+            if s[key] > limit and s[key] - before[key] > (1.0 if key == 'p95_ms' else 0.05):
+                regressions.append(f"{s['scenario']}: {key} {before[key]:.2f} -> {s[key]:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="DSN отдельной тестовой базы (или BENCH_DATABASE_URL)")
+    parser.add_argument('--reset', action='store_true', help="очистить orders и messages перед прогоном")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="сценарии через запятую")
+    parser.add_argument('--count', type=int, default=300, help="операций на сценарий")
+    parser.add_argument('--rate', type=float, default=0.0, help="запросов в секунду (0 — без ограничения)")
+    parser.add_argument('--concurrency', type=int, default=16, help="параллельных клиентов")
+    parser.add_argument('--batch-size', type=int, default=50, help="заказов в одном /api/new-orders")
+    parser.add_argument('--retry-rate', type=float, default=0.1, help="доля повторов requestId в new_order")
+    parser.add_argument('--sellers', type=int, default=10, help="продавцов и точек самовывоза")
+    parser.add_argument('--buyers', type=int, default=200, help="разных покупателей")
+    parser.add_argument('--telegram-delay', type=float, default=0.0, help="задержка ответа имитации Telegram, секунд")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="доля ответов 429 от имитации Telegram")
+    parser.add_argument('--stock-delay', type=float, default=0.0, help="задержка ответа складского бота, секунд")
+    parser.add_argument('--json', help="сохранить результаты в файл")
+    parser.add_argument('--baseline', help="файл с результатами прошлого прогона для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимый рост p95 и запросов к БД")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("нужен --database-url (отдельная тестовая база, не рабочая)")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    bench = Benchmark(args)
+    summaries = []
+    try:
+        for name in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+            if name not in SCENARIOS:
+                parser.error(f"неизвестный сценарий {name}")
+            print(f"▶ {name}...", flush=True)
+            summaries.append(getattr(bench, name)(args.count).summary())
+    finally:
+        bench.close()
+
+    print()
+    print_report(summaries)
+    transport = bench.bot.telegram_transport.stats()
+    print(f"\nСоединений с Telegram: {transport['connections']} на {transport['requests']} запросов "
+          f"(переиспользовано {transport['reuse_ratio']:.0%}, повторов {transport['retries']})")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summaries, json.load(f), args.tolerance)
+        if regressions:
+            print("\nРегрессии относительно", args.baseline)
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print(f"\nРегрессий относительно {args.baseline} нет")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Локальная имитация Telegram Bot API для нагрузочных прогонов.
+
+Отвечает на /bot<token>/<method> так, как отвечает Telegram (ровно
+настолько, насколько нужно telebot), считает вызовы по методам и умеет
+добавлять задержку и ответы 429 с retry_after.
+
+    python devtools/fake_telegram.py --port 8082 --delay 0.05
+    # в коде: apihelper.API_URL = "http://127.0.0.1:8082/bot{0}/{1}"
+"""
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from urllib.parse import parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Fake bot', 'username': 'fake_bot'}
+
+
+class FakeTelegramAPI:
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, flood_rate=0.0, retry_after=1):
+        self.delay = delay
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = {}         # метод -> число вызовов (включая 429)
+        self.flood_errors = 0
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self) -> str:
+        """Шаблон для telebot.apihelper.API_URL"""
+        return self.url + "/bot{0}/{1}"
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _message(self, params):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = params.get('chat_id', 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    def _result(self, method, params):
+        if method in ('sendMessage', 'sendPhoto', 'sendDocument', 'copyMessage'):
+            return self._message(params)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        # editMessage*, answerCallbackQuery, setWebhook, deleteWebhook, ...
+        return True
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt, *args)
+
+            def _reply(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _params(self):
+                path, _, query = self.path.partition('?')
+                params = dict(parse_qsl(query))
+                length = int(self.headers.get('Content-Length', 0))
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body or b'{}'))
+                    else:
+                        params.update(parse_qsl(body.decode()))
+                return path, params
+
+            def _dispatch(self):
+                path, params = self._params()
+                parts = path.strip('/').split('/')
+                if len(parts) != 2 or not parts[0].startswith('bot'):
+                    self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    return
+                method = parts[1]
+                with fake._lock:
+                    fake.calls[method] = fake.calls.get(method, 0) + 1
+                if fake.delay:
+                    time.sleep(fake.delay)
+                if fake.flood_rate and random.random() < fake.flood_rate:
+                    with fake._lock:
+                        fake.flood_errors += 1
+                    self._reply(429, {
+                        'ok': False, 'error_code': 429,
+                        'description': f'Too Many Requests: retry after {fake.retry_after}',
+                        'parameters': {'retry_after': fake.retry_after},
+                    })
+                    return
+                self._reply(200, {'ok': True, 'result': fake._result(method, params)})
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Имитация Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--delay', type=float, default=0.0, help="задержка ответа, секунд")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="доля ответов 429 Too Many Requests")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429, секунд")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    fake = FakeTelegramAPI(args.host, args.port, args.delay, args.flood_rate, args.retry_after)
+    print(f"Имитация Telegram Bot API слушает {fake.api_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
@@ -0,0 +1,107 @@
+"""Локальная заглушка складского бота для тестов и нагрузочных прогонов.
+
+Принимает POST /api/order-completed, запоминает события (повтор с тем же
+Idempotency-Key не считается новым) и умеет имитировать сбои и задержки.
+
+    python devtools/stub_stock_bot.py --port 8081 --fail-first 2 --delay 0.1
+    STOCK_BOT_URL=http://127.0.0.1:8081 python bot.py
+"""
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+class StubStockBot:
+    def __init__(self, host='127.0.0.1', port=0, fail_first=0, fail_rate=0.0, delay=0.0):
+        self.fail_first = fail_first
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.events = []        # принятые уникальные события
+        self.requests = 0       # все запросы, включая повторы и сбои
+        self._keys = set()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt, *args)
+
+            def _reply(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if self.path != '/api/order-completed':
+                    self._reply(404, {'error': 'not found'})
+                    return
+                if stub.delay:
+                    time.sleep(stub.delay)
+                with stub._lock:
+                    stub.requests += 1
+                    fail = stub.requests <= stub.fail_first or random.random() < stub.fail_rate
+                    if not fail:
+                        key = self.headers.get('Idempotency-Key') or json.dumps(payload, sort_keys=True)
+                        if key not in stub._keys:
+                            stub._keys.add(key)
+                            stub.events.append(payload)
+                if fail:
+                    self._reply(503, {'error': 'stub failure'})
+                else:
+                    self._reply(200, {'status': 'ok'})
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Заглушка складского бота")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fail-first', type=int, default=0, help="сколько первых запросов завершить ошибкой 503")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="доля случайных ответов 503")
+    parser.add_argument('--delay', type=float, default=0.0, help="задержка ответа, секунд")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    stub = StubStockBot(args.host, args.port, args.fail_first, args.fail_rate, args.delay)
+    print(f"Заглушка складского бота слушает {stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
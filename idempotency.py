@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class IdempotentRequests:
+    """Склеивает повторы запросов с одним ключом идемпотентности (requestId).
+
+    Завершённые результаты хранятся в LRU на maxsize ключей и отдаются без
+    повторной обработки. Если запрос с тем же ключом ещё выполняется,
+    повтор ждёт его результата вместо того, чтобы выполняться параллельно.
+    Между процессами дубликаты отсекает уникальный индекс в БД.
+    """
+
+    def __init__(self, maxsize=10000, wait_timeout=30.0):
+        self.maxsize = maxsize
+        self.wait_timeout = wait_timeout
+        self._done = OrderedDict()
+        self._in_flight = {}
+        self._in_flight_async = {}   # key -> asyncio.Future (асинхронный режим)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.merged = 0
+
+    def get(self, key):
+        with self._lock:
+            result = self._done.get(key)
+            if result is not None:
+                self._done.move_to_end(key)
+                self.hits += 1
+            return result
+
+    def remember(self, key, result):
+        with self._lock:
+            self._done[key] = result
+            self._done.move_to_end(key)
+            while len(self._done) > self.maxsize:
+                self._done.popitem(last=False)
+
+    def run(self, key, fn, cacheable=lambda result: True):
+        """Выполняет fn() один раз на ключ; повторы получают тот же результат"""
+        with self._lock:
+            if key in self._done:
+                self._done.move_to_end(key)
+                self.hits += 1
+                return self._done[key]
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+
+        if not leader:
+            self.merged += 1
+            logger.info(f"Запрос {key} уже обрабатывается, ждём его результата")
+            if not flight.event.wait(self.wait_timeout):
+                raise TimeoutError(f"Запрос {key} обрабатывается слишком долго")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            if cacheable(flight.result):
+                self.remember(key, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.event.set()
+
+    async def run_async(self, key, fn, cacheable=lambda result: True):
+        """То же для корутин: fn() возвращает awaitable, повторы ждут его в том же цикле событий"""
+        result = self.get(key)
+        if result is not None:
+            return result
+        flight = self._in_flight_async.get(key)
+        if flight is not None:
+            self.merged += 1
+            logger.info(f"Запрос {key} уже обрабатывается, ждём его результата")
+            try:
+                return await asyncio.wait_for(asyncio.shield(flight), self.wait_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Запрос {key} обрабатывается слишком долго")
+
+        flight = self._in_flight_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            if cacheable(result):
+                self.remember(key, result)
+            flight.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            # Если повторов не было, исключение никто не заберёт — не шумим в лог
+            flight.exception()
+            raise
+        finally:
+            self._in_flight_async.pop(key, None)
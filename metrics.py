@@ -0,0 +1,474 @@
+import time
+import bisect
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+# Секунды: от быстрых запросов к БД до долгих вызовов Telegram
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Штуки: запросы, соединения и вызовы API на один апдейт или HTTP-запрос
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def total(self, **match) -> float:
+        """Сумма по всем меткам, совпадающим с match (например, status='error')"""
+        with self._lock:
+            items = list(self._values.items())
+        return sum(value for label_values, value in items
+                   if all(dict(zip(self.labels, label_values)).get(k) == v for k, v in match.items()))
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label_values -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def totals(self) -> tuple:
+        """(число наблюдений, сумма) по всем меткам"""
+        with self._lock:
+            return (sum(sum(counts) for counts, _ in self._values.values()),
+                    sum(total for _, total in self._values.values()))
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for label_values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.labels, label_values, 'le="' + le + '"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+
+class _Scope:
+    __slots__ = ('kind', 'name', 'started', 'status', 'db_queries', 'db_connections', 'db_time',
+                 'tg_calls', 'tg_time')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.started = time.perf_counter()
+        self.status = 'ok'
+        self.db_queries = 0
+        self.db_connections = 0
+        self.db_time = 0.0
+        self.tg_calls = 0
+        self.tg_time = 0.0
+
+
+class Metrics:
+    """Метрики обработчиков бота и HTTP-маршрутов в текстовом формате Prometheus.
+
+    На каждый апдейт (kind='handler'), HTTP-запрос (kind='route') и отправку
+    из очереди сообщений (kind='queue') заводится
+    область в контексте потока или задачи asyncio: в неё считаются запросы к БД, выданные соединения и
+    вызовы Telegram API, а при выходе всё пишется в гистограммы с меткой
+    имени обработчика или маршрута. При enabled=False ничего не
+    оборачивается и накладных расходов нет.
+    """
+
+    def __init__(self, enabled=True, prefix='bot'):
+        self.enabled = enabled
+        # Стек областей — кортеж в contextvar: у каждого потока и каждой задачи asyncio свой
+        self._scopes = contextvars.ContextVar(f'{prefix}_metrics_scopes', default=())
+        self._callbacks = []   # (имя, описание, функция, тип: gauge или counter)
+        scope_labels = ('kind', 'name')
+        self.request_seconds = Histogram(f'{prefix}_request_duration_seconds',
+                                         'Wall time of a handler or HTTP route', scope_labels)
+        self.requests_total = Counter(f'{prefix}_requests_total',
+                                      'Handled updates and HTTP requests', scope_labels + ('status',))
+        self.request_db_queries = Histogram(f'{prefix}_request_db_queries',
+                                            'DB queries per handler or route call', scope_labels, COUNT_BUCKETS)
+        self.request_db_connections = Histogram(f'{prefix}_request_db_connections',
+                                                'Pool connections taken per handler or route call',
+                                                scope_labels, COUNT_BUCKETS)
+        self.request_db_seconds = Histogram(f'{prefix}_request_db_seconds',
+                                            'Time spent in DB queries per handler or route call', scope_labels)
+        self.request_telegram_calls = Histogram(f'{prefix}_request_telegram_calls',
+                                                'Telegram API calls per handler or route call',
+                                                scope_labels, COUNT_BUCKETS)
+        self.request_telegram_seconds = Histogram(f'{prefix}_request_telegram_seconds',
+                                                  'Time spent in Telegram API calls per handler or route call',
+                                                  scope_labels)
+        self.db_query_seconds = Histogram(f'{prefix}_db_query_duration_seconds', 'DB query latency')
+        self.telegram_seconds = Histogram(f'{prefix}_telegram_request_duration_seconds',
+                                          'Telegram API call latency', ('method',))
+        self.telegram_total = Counter(f'{prefix}_telegram_requests_total',
+                                      'Telegram API calls', ('method', 'status'))
+        self._collectors = [
+            self.request_seconds, self.requests_total, self.request_db_queries, self.request_db_connections,
+            self.request_db_seconds, self.request_telegram_calls, self.request_telegram_seconds,
+            self.db_query_seconds, self.telegram_seconds, self.telegram_total,
+        ]
+
+    # ---------- области ----------
+
+    def _stack(self) -> tuple:
+        return self._scopes.get()
+
+    def begin(self, kind, name, nested=True):
+        """Открывает область; nested=False — без внешних областей, унаследованных контекстом"""
+        stack = self._scopes.get() if nested else ()
+        self._scopes.set(stack + (_Scope(kind, name),))
+
+    def end(self, status=None):
+        stack = self._stack()
+        if not stack:
+            return
+        scope = stack[-1]
+        self._scopes.set(stack[:-1])
+        labels = (scope.kind, scope.name)
+        self.request_seconds.observe(labels, time.perf_counter() - scope.started)
+        self.requests_total.inc(labels + (status or scope.status,))
+        self.request_db_queries.observe(labels, scope.db_queries)
+        self.request_db_connections.observe(labels, scope.db_connections)
+        self.request_db_seconds.observe(labels, scope.db_time)
+        self.request_telegram_calls.observe(labels, scope.tg_calls)
+        self.request_telegram_seconds.observe(labels, scope.tg_time)
+
+    def set_status(self, status):
+        stack = self._stack()
+        if stack:
+            stack[-1].status = status
+
+    # ---------- наблюдения ----------
+
+    def observe_db_query(self, seconds):
+        self.db_query_seconds.observe((), seconds)
+        for scope in self._stack():
+            scope.db_queries += 1
+            scope.db_time += seconds
+
+    def observe_db_connection(self):
+        if not self.enabled:
+            return
+        for scope in self._stack():
+            scope.db_connections += 1
+
+    def observe_telegram(self, method, seconds, status):
+        self.telegram_seconds.observe((method,), seconds)
+        self.telegram_total.inc((method, status))
+        for scope in self._stack():
+            scope.tg_calls += 1
+            scope.tg_time += seconds
+
+    def add_gauge(self, name, help_text, fn):
+        """Значение, которое снимается в момент выдачи /metrics; повторная регистрация имени заменяет прежнюю"""
+        self._add_callback(name, help_text, fn, 'gauge')
+
+    def add_counter(self, name, help_text, fn):
+        """Как add_gauge, но для счётчика, который только растёт: по нему считают rate()"""
+        if not name.endswith('_total'):
+            raise ValueError(f"Имя счётчика должно оканчиваться на _total: {name}")
+        self._add_callback(name, help_text, fn, 'counter')
+
+    def _add_callback(self, name, help_text, fn, metric_type):
+        self._callbacks = [callback for callback in self._callbacks if callback[0] != name]
+        self._callbacks.append((name, help_text, fn, metric_type))
+
+    # ---------- подключение ----------
+
+    def cursor_factory(self, base=RealDictCursor):
+        """Класс курсора, который замеряет каждый запрос (или base, если метрики выключены)"""
+        if not self.enabled:
+            return base
+        metrics = self
+
+        if inspect.iscoroutinefunction(base.execute):
+            class AsyncInstrumentedCursor(base):
+                # Курсор psycopg 3 (асинхронный режим)
+                async def execute(self, query, params=None, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await super().execute(query, params, **kwargs)
+                    finally:
+                        metrics.observe_db_query(time.perf_counter() - started)
+
+                async def executemany(self, query, params_seq, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await super().executemany(query, params_seq, **kwargs)
+                    finally:
+                        metrics.observe_db_query(time.perf_counter() - started)
+
+            return AsyncInstrumentedCursor
+
+        class InstrumentedCursor(base):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    metrics.observe_db_query(time.perf_counter() - started)
+
+            def executemany(self, query, vars_list):
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    metrics.observe_db_query(time.perf_counter() - started)
+
+        return InstrumentedCursor
+
+    def instrument_telegram(self, apihelper, attr='_make_request'):
+        """Оборачивает apihelper._make_request: через него идут все вызовы Bot API.
+
+        Для AsyncTeleBot передаётся asyncio_helper и attr='_process_request'.
+        """
+        original = getattr(apihelper, attr)
+        if not self.enabled or getattr(original, '_instrumented', False):
+            return
+
+        if inspect.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def wrapper(token, method_name, *args, **kwargs):
+                started = time.perf_counter()
+                status = 'ok'
+                try:
+                    return await original(token, method_name, *args, **kwargs)
+                except Exception:
+                    status = 'error'
+                    raise
+                finally:
+                    self.observe_telegram(method_name, time.perf_counter() - started, status)
+        else:
+            @functools.wraps(original)
+            def wrapper(token, method_name, *args, **kwargs):
+                started = time.perf_counter()
+                status = 'ok'
+                try:
+                    return original(token, method_name, *args, **kwargs)
+                except Exception:
+                    status = 'error'
+                    raise
+                finally:
+                    self.observe_telegram(method_name, time.perf_counter() - started, status)
+
+        wrapper._instrumented = True
+        setattr(apihelper, attr, wrapper)
+
+    def instrument_send_queue(self, queue):
+        """Оборачивает доставку SendQueue/AsyncSendQueue: каждая отправка — своя область kind='queue'.
+
+        Поток очереди не видит области обработчика, поставившего сообщение, а задача
+        AsyncSendQueue наследует её копию, хотя обработчик к отправке уже завершён.
+        Поэтому вызовы Telegram из очереди считаются отдельно, по имени метода.
+        """
+        original = queue._deliver
+        if not self.enabled or getattr(original, '_instrumented', False):
+            return
+
+        def status(job, retry):
+            if job.sent:
+                return 'ok'
+            return 'retry' if retry is not None else 'error'
+
+        if inspect.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def wrapper(job):
+                self.begin('queue', job.method, nested=False)
+                retry = None
+                try:
+                    retry = await original(job)
+                    return retry
+                finally:
+                    self.end(status(job, retry))
+        else:
+            @functools.wraps(original)
+            def wrapper(job):
+                self.begin('queue', job.method, nested=False)
+                retry = None
+                try:
+                    retry = original(job)
+                    return retry
+                finally:
+                    self.end(status(job, retry))
+
+        wrapper._instrumented = True
+        queue._deliver = wrapper
+
+    def track_update(self, process):
+        """Оборачивает обработку апдейта целиком, вместе с middleware и фильтрами.
+
+        Имя области задаёт сработавший обработчик (см. instrument_handlers);
+        если ни один не подошёл, апдейт учитывается как 'unhandled'.
+        """
+        if not self.enabled:
+            return process
+
+        if inspect.iscoroutinefunction(process):
+            @functools.wraps(process)
+            async def async_wrapper(*args, **kwargs):
+                self.begin('handler', 'unhandled')
+                status = 'ok'
+                try:
+                    return await process(*args, **kwargs)
+                except Exception:
+                    status = 'error'
+                    raise
+                finally:
+                    self.end(status)
+            return async_wrapper
+
+        @functools.wraps(process)
+        def wrapper(*args, **kwargs):
+            self.begin('handler', 'unhandled')
+            status = 'ok'
+            try:
+                return process(*args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                self.end(status)
+        return wrapper
+
+    def _claim_scope(self, name) -> bool:
+        """Подписывает текущую область апдейта именем обработчика; False, если её нет"""
+        stack = self._stack()
+        if stack and stack[-1].kind == 'handler':
+            stack[-1].name = name
+            return True
+        return False
+
+    def wrap_handler(self, func):
+        if inspect.iscoroutinefunction(func):
+            # Задачи, в которых AsyncTeleBot запускает обработчики, наследуют
+            # контекст апдейта, а с ним и его область
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if self._claim_scope(func.__name__):
+                    return await func(*args, **kwargs)
+                self.begin('handler', func.__name__)
+                status = 'ok'
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    status = 'error'
+                    raise
+                finally:
+                    self.end(status)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self._claim_scope(func.__name__):
+                return func(*args, **kwargs)
+            # Вызов вне track_update — своя область
+            self.begin('handler', func.__name__)
+            status = 'ok'
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                self.end(status)
+        return wrapper
+
+    def instrument_handlers(self, bot):
+        """Оборачивает уже зарегистрированные обработчики telebot"""
+        if not self.enabled:
+            return
+        for name in ('message_handlers', 'edited_message_handlers', 'callback_query_handlers',
+                     'channel_post_handlers', 'inline_handlers'):
+            for handler in getattr(bot, name, []):
+                if not hasattr(handler['function'], '__wrapped__'):
+                    handler['function'] = self.wrap_handler(handler['function'])
+
+    def instrument_flask(self, app, skip=('metrics',)):
+        """Считает каждый HTTP-запрос Flask как область kind='route' с шаблоном URL в метке"""
+        if not self.enabled:
+            return
+        from flask import request
+
+        @app.before_request
+        def _metrics_begin():
+            if request.endpoint in skip:
+                return
+            request.environ['metrics.scope'] = True
+            self.begin('route', request.url_rule.rule if request.url_rule else 'unmatched')
+
+        @app.after_request
+        def _metrics_status(response):
+            if request.environ.get('metrics.scope'):
+                self.set_status(f"{response.status_code // 100}xx")
+            return response
+
+        @app.teardown_request
+        def _metrics_end(exc):
+            if request.environ.pop('metrics.scope', False):
+                self.end('5xx' if exc is not None else None)
+
+    # ---------- выдача ----------
+
+    def expose(self) -> str:
+        lines = []
+        for collector in self._collectors:
+            lines.extend(collector.expose())
+        for name, help_text, fn, metric_type in self._callbacks:
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"Не удалось снять метрику {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
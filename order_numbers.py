@@ -0,0 +1,99 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAX_PREFIX_LEN = 3
+
+# Сдвигает счётчик префикса на count и возвращает последний зарезервированный номер
+RESERVE_SQL = """
+    INSERT INTO order_number_counters (prefix, last_value)
+    VALUES (%s, %s)
+    ON CONFLICT (prefix) DO UPDATE
+        SET last_value = order_number_counters.last_value + EXCLUDED.last_value
+    RETURNING last_value
+"""
+
+
+class OrderNumberAllocator:
+    """Выдаёт номера заказов из счётчиков по префиксам (таблица order_number_counters).
+
+    Номер берётся одним UPDATE с блокировкой строки счётчика, поэтому
+    параллельные запросы с одним префиксом не получат одинаковый номер.
+    Для префиксов из block_sizes номера резервируются в БД пачками и
+    раздаются из памяти процесса (неиспользованный остаток пачки при
+    перезапуске теряется — в нумерации будут пропуски). Таблицу счётчиков
+    создаёт миграция в schema.py, сам аллокатор схему не трогает.
+    """
+
+    def __init__(self, get_connection, block_sizes=None):
+        self.get_connection = get_connection
+        self.block_sizes = {p: int(n) for p, n in (block_sizes or {}).items() if int(n) > 1}
+        self._lock = threading.Lock()
+        # prefix -> [следующий номер, последний номер зарезервированной пачки]
+        self._blocks = {}
+
+    @staticmethod
+    def normalize_prefix(prefix: str) -> str:
+        return prefix[:MAX_PREFIX_LEN]
+
+    @staticmethod
+    def _reserve(cur, prefix: str, count: int) -> int:
+        """Сдвигает счётчик на count и возвращает последний зарезервированный номер"""
+        cur.execute(RESERVE_SQL, (prefix, count))
+        return cur.fetchone()['last_value']
+
+    def _next_from_block(self, prefix: str, size: int) -> int:
+        with self._lock:
+            block = self._blocks.get(prefix)
+            if not block or block[0] > block[1]:
+                # Пачка резервируется в отдельной транзакции: откат заказа
+                # не должен возвращать в счётчик уже розданные номера
+                with self.get_connection() as conn:
+                    with conn.cursor() as cur:
+                        last = self._reserve(cur, prefix, size)
+                block = [last - size + 1, last]
+                self._blocks[prefix] = block
+                logger.info(f"Зарезервирована пачка номеров {prefix}{block[0]}–{prefix}{block[1]}")
+            number = block[0]
+            block[0] += 1
+            return number
+
+    def allocate(self, prefix: str, cur=None) -> str:
+        """Возвращает следующий номер заказа; cur — курсор текущей транзакции, если он есть"""
+        prefix = self.normalize_prefix(prefix)
+        size = self.block_sizes.get(prefix)
+        if size:
+            number = self._next_from_block(prefix, size)
+        elif cur is not None:
+            number = self._reserve(cur, prefix, 1)
+        else:
+            with self.get_connection() as conn:
+                with conn.cursor() as own_cur:
+                    number = self._reserve(own_cur, prefix, 1)
+        return f"{prefix}{number}"
+
+    def allocate_many(self, prefix: str, count: int, cur=None) -> list:
+        """Возвращает count номеров подряд, сдвигая счётчик одним запросом"""
+        if count <= 0:
+            return []
+        prefix = self.normalize_prefix(prefix)
+        if cur is not None:
+            last = self._reserve(cur, prefix, count)
+        else:
+            with self.get_connection() as conn:
+                with conn.cursor() as own_cur:
+                    last = self._reserve(own_cur, prefix, count)
+        return [f"{prefix}{number}" for number in range(last - count + 1, last + 1)]
+
+
+def parse_block_sizes(spec: str) -> dict:
+    """Разбирает настройку вида 'D:50,A:10' в словарь {префикс: размер пачки}"""
+    sizes = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        prefix, _, size = part.partition(':')
+        sizes[prefix.strip()] = int(size)
+    return sizes
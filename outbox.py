@@ -0,0 +1,184 @@
+import json
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+INSERT_SQL = """
+    INSERT INTO outbox (event_type, payload, idempotency_key)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (idempotency_key) DO NOTHING
+"""
+
+
+class Outbox:
+    """Транзакционный outbox: события пишутся в таблицу outbox в той же
+    транзакции, что и изменение заказа, а фоновый диспетчер доставляет их
+    во внешние сервисы.
+
+    routes сопоставляет тип события с URL, на который отправляется payload.
+    Каждое событие уходит с заголовком Idempotency-Key, поэтому повторная
+    доставка после сбоя безопасна для получателя.
+
+    Диспетчер забирает пачку событий в аренду (locked_until) короткой
+    транзакцией и доставляет их уже без открытой транзакции и без
+    соединения из пула; событие, чей инстанс упал, после lease секунд
+    подхватывает другой. Таблицу создаёт миграция schema.migrate_outbox_table.
+    """
+
+    def __init__(self, get_connection, routes, batch_size=50, poll_interval=5.0,
+                 timeout=3.0, base_backoff=2.0, max_backoff=600.0, max_attempts=20, lease=None):
+        self.get_connection = get_connection
+        self.routes = routes
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        # Аренда должна пережить доставку всей пачки, даже если каждый запрос упрётся в таймаут
+        self.lease = lease or batch_size * timeout + 30
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, cur, event_type: str, payload: dict, idempotency_key: str):
+        """Записывает событие курсором вызывающей транзакции; дубликат ключа игнорируется"""
+        params = self.event_params(event_type, payload, idempotency_key)
+        if params is None:
+            return
+        cur.execute(INSERT_SQL, params)
+
+    def event_params(self, event_type: str, payload: dict, idempotency_key: str):
+        """Параметры INSERT_SQL или None, если событие этого типа никуда не доставляется"""
+        if event_type not in self.routes:
+            return None
+        return event_type, json.dumps(payload), idempotency_key
+
+    def wakeup(self):
+        """Будит диспетчер сразу после фиксации транзакции с новым событием"""
+        self.start()
+        self._wakeup.set()
+
+    # ---------- Диспетчер ----------
+    def start(self):
+        if self._thread or not self.routes:
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delivered = self.dispatch_batch()
+            except Exception as e:
+                logger.exception(f"Ошибка диспетчера outbox: {e}")
+                delivered = 0
+            # Полная пачка — сразу берём следующую, иначе ждём события или таймаута
+            if delivered < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.max_backoff, self.base_backoff * (2 ** (attempts - 1)))
+
+    def dispatch_batch(self) -> int:
+        """Доставляет одну пачку готовых событий; возвращает размер пачки (0, если получатель недоступен)"""
+        events = self._claim()
+        for index, event in enumerate(events):
+            error, unreachable = self._deliver(event)
+            self._record(event, error)
+            if error is not None and unreachable:
+                # Получатель недоступен — остаток пачки ждёт следующего прохода
+                self._release([e['id'] for e in events[index + 1:]])
+                return 0
+        return len(events)
+
+    def _claim(self) -> list:
+        """Берёт в аренду пачку готовых событий и сразу фиксирует транзакцию"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                # SKIP LOCKED и аренда позволяют нескольким инстансам разбирать outbox параллельно
+                cur.execute("""
+                    UPDATE outbox SET locked_until = now() + make_interval(secs => %s)
+                    WHERE id IN (
+                        SELECT id FROM outbox
+                        WHERE status = 'pending' AND next_attempt_at <= now()
+                          AND (locked_until IS NULL OR locked_until < now())
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, event_type, payload, idempotency_key, attempts
+                """, (self.lease, self.batch_size))
+                return sorted(cur.fetchall(), key=lambda event: event['id'])
+
+    def _record(self, event, error):
+        """Записывает итог доставки события и снимает аренду"""
+        attempts = event['attempts'] + 1
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                if error is None:
+                    cur.execute("""
+                        UPDATE outbox
+                        SET status = 'delivered', delivered_at = now(), attempts = %s, locked_until = NULL
+                        WHERE id = %s
+                    """, (attempts, event['id']))
+                    return
+                status = 'failed' if attempts >= self.max_attempts else 'pending'
+                cur.execute("""
+                    UPDATE outbox
+                    SET attempts = %s, status = %s, last_error = %s, locked_until = NULL,
+                        next_attempt_at = now() + make_interval(secs => %s)
+                    WHERE id = %s
+                """, (attempts, status, error[:1000], self._backoff(attempts), event['id']))
+        if status == 'failed':
+            logger.error(f"Событие outbox {event['idempotency_key']} не доставлено за {attempts} попыток: {error}")
+        else:
+            logger.warning(f"Событие outbox {event['idempotency_key']} не доставлено (попытка {attempts}): {error}")
+
+    def _release(self, event_ids):
+        if not event_ids:
+            return
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE outbox SET locked_until = NULL WHERE id = ANY(%s)", (event_ids,))
+
+    def _deliver(self, event):
+        """Отправляет событие; возвращает (текст ошибки или None, получатель недоступен)"""
+        url = self.routes[event['event_type']]
+        payload = event['payload']
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        try:
+            response = self.session.post(
+                url,
+                json=payload,
+                headers={'Idempotency-Key': event['idempotency_key']},
+                timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            return str(e), True
+        if response.ok:
+            logger.info(f"Событие outbox {event['idempotency_key']} доставлено")
+            return None, False
+        return f"{response.status_code} - {response.text[:200]}", response.status_code >= 500
+
@@ -0,0 +1,604 @@
+"""Миграции схемы и индексы, на которые опираются горячие запросы бота.
+
+Запуск вручную:
+    python schema.py bootstrap   — применить лёгкие миграции и создать недостающие индексы
+                                   (то же делает бот при старте с SCHEMA_BOOTSTRAP=1)
+    python schema.py migrate     — применить все миграции, включая перезапись таблиц, и подготовить
+                                   поиск заказов (колонки, заполнение пачками, индексы); при старте
+                                   бота ни то, ни другое не выполняется
+    python schema.py check       — показать, чего не хватает схеме и каких индексов нет
+    python schema.py explain     — планы горячих запросов
+
+Дубли request_id. Уникальный индекс orders_request_id_key не строится, пока в orders
+есть несколько заказов с одним request_id (повторы, сохранённые до появления индекса),
+а без индекса бот не запускается. Найти их:
+    SELECT request_id, array_agg(id ORDER BY id) FROM orders
+    WHERE request_id IS NOT NULL GROUP BY request_id HAVING count(*) > 1;
+Лишние заказы удалите или, если их нужно сохранить, снимите с них request_id
+(здесь — со всех, кроме самого раннего) и снова выполните python schema.py migrate:
+    UPDATE orders o SET request_id = NULL
+    WHERE EXISTS (SELECT 1 FROM orders d WHERE d.request_id = o.request_id AND d.id < o.id);
+"""
+import os
+import sys
+import json
+import logging
+from enum import Enum
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+
+
+class OrderStatus(str, Enum):
+    """Статус заказа; в БД хранится в enum-типе order_status"""
+    ACTIVE = 'active'
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
+
+
+# Значения, которые встречаются в старых строках orders.status
+LEGACY_STATUSES = {
+    'active': OrderStatus.ACTIVE,
+    'Активный': OrderStatus.ACTIVE,
+    'completed': OrderStatus.COMPLETED,
+    'Завершен': OrderStatus.COMPLETED,
+    'Завершён': OrderStatus.COMPLETED,
+    'cancelled': OrderStatus.CANCELLED,
+    'canceled': OrderStatus.CANCELLED,
+    'Отменен': OrderStatus.CANCELLED,
+    'Отменён': OrderStatus.CANCELLED,
+}
+
+ACTIVE_STATUSES = f"status = '{OrderStatus.ACTIVE.value}'"
+
+# Справочники, которые бот кэширует: их изменения рассылаются NOTIFY в этот канал
+DIRECTORY_TABLES = ('sellers', 'pickup_locations')
+DIRECTORY_CHANNEL = 'directory_changed'
+
+# Идемпотентность /api/new-order обеспечивается самой БД: без этого индекса бот не запускается
+REQUEST_ID_INDEX = 'orders_request_id_key'
+
+# (имя индекса, таблица, определение после ON <таблица>, уникальный)
+INDEXES = [
+    ('orders_order_number_idx', 'orders', "(order_number)", False),
+    (REQUEST_ID_INDEX, 'orders', "(request_id) WHERE request_id IS NOT NULL", True),
+    ('orders_user_id_active_idx', 'orders', f"(user_id) WHERE {ACTIVE_STATUSES}", False),
+    ('orders_seller_id_active_idx', 'orders', f"(seller_id, id) WHERE {ACTIVE_STATUSES}", False),
+    ('orders_id_active_idx', 'orders', f"(id) WHERE {ACTIVE_STATUSES}", False),
+    ('messages_order_id_created_at_idx', 'messages', "(order_id, created_at)", False),
+    ('sellers_telegram_id_idx', 'sellers', "(telegram_id)", False),
+    ('pickup_locations_address_idx', 'pickup_locations', "(address)", False),
+    ('outbox_pending_idx', 'outbox', "(next_attempt_at, id) WHERE status = 'pending'", False),
+    # Поиск заказов по префиксу номера
+    ('orders_order_number_pattern_idx', 'orders', "(order_number text_pattern_ops)", False),
+]
+
+# Поисковые колонки orders и их выражения от contact строки {row}
+SEARCH_COLUMNS = {
+    'search_phone': r"regexp_replace(coalesce({row}.contact->>'phone', ''), '\D', '', 'g')",
+    'search_name': "lower(coalesce({row}.contact->>'name', ''))",
+    'search_username': "lower(ltrim(coalesce({row}.contact->>'username', ''), '@'))",
+}
+SEARCH_TRIGGER = 'orders_search_columns'
+
+# Индексы поисковых колонок: подстрока телефона и имени (pg_trgm), точный username
+SEARCH_INDEXES = [
+    ('orders_search_phone_trgm_idx', 'orders', "USING gin (search_phone gin_trgm_ops)", False),
+    ('orders_search_name_trgm_idx', 'orders', "USING gin (search_name gin_trgm_ops)", False),
+    ('orders_search_username_idx', 'orders', "(search_username)", False),
+]
+
+# Горячие запросы: (название, SQL, параметры, таблицы, которые нельзя читать Seq Scan)
+HOT_QUERIES = [
+    ('get_order_by_number', "SELECT * FROM orders WHERE order_number = %s", ('A1',), ('orders',)),
+    ('new_order: request_id', "SELECT id, order_number, notified_bool, contact FROM orders WHERE request_id = %s", ('x',), ('orders',)),
+    ('resolve_sender: active_order',
+     f"SELECT o.id FROM orders o WHERE o.user_id = %s AND o.{ACTIVE_STATUSES} LIMIT 1", (1,), ('orders',)),
+    ('get_active_orders_page: seller',
+     f"SELECT o.id FROM orders o WHERE o.{ACTIVE_STATUSES} AND o.seller_id = %s ORDER BY o.id DESC LIMIT 11", (1,), ('orders',)),
+    ('get_active_orders_page: admin',
+     f"SELECT o.id FROM orders o WHERE o.{ACTIVE_STATUSES} ORDER BY o.id DESC LIMIT 11", (), ('orders',)),
+    ('get_messages_for_order',
+     "SELECT id, sender_role, text, created_at FROM messages WHERE order_id = %s "
+     "ORDER BY created_at DESC, id DESC LIMIT 21", (1,), ('messages',)),
+    ('get_messages_for_order: older',
+     "SELECT id, sender_role, text, created_at FROM messages WHERE order_id = %s AND (created_at, id) < (now(), 1) "
+     "ORDER BY created_at DESC, id DESC LIMIT 21", (1,), ('messages',)),
+    ('get_seller_by_telegram_id', "SELECT * FROM sellers WHERE telegram_id = %s", (1,), ('sellers',)),
+    ('get_pickup_location_info', "SELECT * FROM pickup_locations WHERE address = %s", ('x',), ('pickup_locations',)),
+    ('search_orders: number', "SELECT o.id FROM orders o WHERE o.order_number LIKE %s", ('A1%',), ('orders',)),
+]
+
+# Проверяются, только если поиск уже подготовлен (python schema.py migrate)
+SEARCH_HOT_QUERIES = [
+    ('search_orders: phone', "SELECT o.id FROM orders o WHERE o.search_phone LIKE %s", ('%9161234%',), ('orders',)),
+    ('search_orders: name', "SELECT o.id FROM orders o WHERE %s <%% o.search_name", ('иван',), ('orders',)),
+    ('search_orders: username', "SELECT o.id FROM orders o WHERE o.search_username = %s", ('ivan',), ('orders',)),
+]
+
+
+def _connect(dsn, autocommit=True):
+    conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    if autocommit:
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+def _column_type(cur, table, column):
+    cur.execute("""
+        SELECT udt_name FROM information_schema.columns
+        WHERE table_name = %s AND column_name = %s
+    """, (table, column))
+    row = cur.fetchone()
+    return row['udt_name'] if row else None
+
+
+def migrate_order_status(cur):
+    """Переводит orders.status из свободного текста в enum order_status"""
+    if _column_type(cur, 'orders', 'status') == 'order_status':
+        return False
+    values = ", ".join(f"'{s.value}'" for s in OrderStatus)
+    cur.execute(f"""
+        DO $$ BEGIN
+            CREATE TYPE order_status AS ENUM ({values});
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$
+    """)
+    for legacy, status in LEGACY_STATUSES.items():
+        if legacy != status.value:
+            cur.execute("UPDATE orders SET status = %s WHERE status = %s", (status.value, legacy))
+    cur.execute(f"SELECT DISTINCT status FROM orders WHERE status IS NULL OR status NOT IN ({values})")
+    unknown = [row['status'] for row in cur.fetchall()]
+    if unknown:
+        raise RuntimeError(f"Неизвестные статусы заказов: {unknown}")
+    # Старые частичные индексы ссылаются на текстовые значения статуса
+    for name, table, definition, unique in INDEXES:
+        if table == 'orders' and 'status' in definition:
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+    cur.execute("ALTER TABLE orders ALTER COLUMN status DROP DEFAULT")
+    cur.execute("ALTER TABLE orders ALTER COLUMN status TYPE order_status USING status::order_status")
+    cur.execute(f"ALTER TABLE orders ALTER COLUMN status SET DEFAULT '{OrderStatus.ACTIVE.value}'")
+    cur.execute("ALTER TABLE orders ALTER COLUMN status SET NOT NULL")
+    return True
+
+
+def migrate_order_json_columns(cur):
+    """Переводит orders.items и orders.contact в JSONB, чтобы их разбирал драйвер"""
+    columns = [c for c in ('items', 'contact') if _column_type(cur, 'orders', c) not in (None, 'jsonb')]
+    if not columns:
+        return False
+    # Невалидный JSON сохраняется JSON-строкой, а не роняет миграцию;
+    # parse_contact/parse_items вернут для него пустое значение, как и раньше
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION pg_temp.to_jsonb_safe(value TEXT) RETURNS JSONB AS $$
+        BEGIN
+            RETURN value::JSONB;
+        EXCEPTION WHEN others THEN
+            RETURN to_jsonb(value);
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE
+    """)
+    for column in columns:
+        cur.execute(f"ALTER TABLE orders ALTER COLUMN {column} TYPE JSONB USING pg_temp.to_jsonb_safe({column}::TEXT)")
+    return True
+
+
+def migrate_directory_notify_triggers(cur):
+    """Создаёт триггеры, которые шлют NOTIFY при изменении справочников (для сброса кэша на всех инстансах)"""
+    cur.execute("""
+        SELECT c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid
+        WHERE t.tgname = c.relname || '_notify_changed' AND c.relname = ANY(%s)
+    """, (list(DIRECTORY_TABLES),))
+    installed = {row['relname'] for row in cur.fetchall()}
+    missing = [table for table in DIRECTORY_TABLES if table not in installed]
+    if not missing:
+        return False
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION notify_directory_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{DIRECTORY_CHANNEL}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table in missing:
+        cur.execute(f"""
+            CREATE TRIGGER {table}_notify_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_directory_changed()
+        """)
+    return True
+
+
+def migrate_outbox_table(cur):
+    """Создаёт таблицу outbox (события для внешних сервисов) и колонку аренды locked_until"""
+    if _column_type(cur, 'outbox', 'locked_until') is not None:
+        return False
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            delivered_at TIMESTAMPTZ
+        )
+    """)
+    # Колонка без значения по умолчанию добавляется без перезаписи таблицы
+    cur.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS locked_until TIMESTAMPTZ")
+    return True
+
+
+def migrate_order_number_counters(cur):
+    """Создаёт таблицу счётчиков номеров заказов и поднимает их до номеров, уже записанных в orders"""
+    if _column_type(cur, 'order_number_counters', 'last_value') is not None:
+        return False
+    cur.execute("""
+        CREATE TABLE order_number_counters (
+            prefix VARCHAR(3) PRIMARY KEY,
+            last_value BIGINT NOT NULL
+        )
+    """)
+    cur.execute("""
+        INSERT INTO order_number_counters (prefix, last_value)
+        SELECT m[1], MAX(m[2]::BIGINT)
+        FROM (
+            SELECT regexp_match(order_number, '^(\\D{1,3})(\\d+)$') AS m
+            FROM orders
+            WHERE order_number IS NOT NULL
+        ) parsed
+        WHERE m IS NOT NULL
+        GROUP BY m[1]
+    """)
+    logger.info(f"Счётчики номеров заказов заполнены из orders: {cur.rowcount} префиксов")
+    return True
+
+
+def migrate_webhook_updates_table(cur):
+    """Создаёт таблицу отметок update_id для отсева повторных доставок апдейтов (UPDATE_DEDUP_DB)"""
+    if _column_type(cur, 'webhook_updates', 'received_at') is not None:
+        return False
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_updates (
+            update_id BIGINT PRIMARY KEY,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    # По received_at удаляются старые отметки
+    cur.execute("CREATE INDEX IF NOT EXISTS webhook_updates_received_at_idx ON webhook_updates (received_at)")
+    return True
+
+
+# Миграции применяются по порядку; каждая сама проверяет, нужна ли она.
+# Третий элемент — миграция перезаписывает таблицу (и держит её блокировку всё это время):
+# такие выполняются только из python schema.py migrate, не при старте бота
+MIGRATIONS = [
+    ('order_status_enum', migrate_order_status, True),
+    ('order_json_columns', migrate_order_json_columns, True),
+    ('directory_notify_triggers', migrate_directory_notify_triggers, False),
+    ('outbox_table', migrate_outbox_table, False),
+    ('order_number_counters', migrate_order_number_counters, False),
+    ('webhook_updates_table', migrate_webhook_updates_table, False),
+]
+
+
+def apply_migrations(dsn, rewrites=False):
+    """Применяет миграции в одной транзакции под advisory-блокировкой; rewrites — и перезаписывающие таблицы"""
+    conn = _connect(dsn, autocommit=False)
+    applied = []
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                # Одновременно стартующие инстансы не должны мигрировать параллельно
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('dp_sbor_schema'))")
+                for name, migration, rewrites_table in MIGRATIONS:
+                    if rewrites_table and not rewrites:
+                        continue
+                    if migration(cur):
+                        applied.append(name)
+                        logger.info(f"Применена миграция {name}")
+    finally:
+        conn.close()
+    return applied
+
+
+def search_columns_ready(cur) -> bool:
+    """Подготовлен ли поиск: триггер создаётся вместе с поисковыми колонками"""
+    cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = 'orders'::regclass", (SEARCH_TRIGGER,))
+    return cur.fetchone() is not None
+
+
+def add_search_columns(cur, lock_timeout='5s'):
+    """Поисковые колонки orders и триггер, который заполняет их при вставке и смене contact.
+
+    Колонки без значения по умолчанию добавляются без перезаписи таблицы, а
+    блокировку orders ALTER ждёт не дольше lock_timeout — иначе миграция
+    падает, а не останавливает запись заказов.
+    """
+    cur.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+    cur.execute("ALTER TABLE orders " + ", ".join(f"ADD COLUMN IF NOT EXISTS {column} TEXT" for column in SEARCH_COLUMNS))
+    assignments = "\n".join(f"NEW.{column} := {expr.format(row='NEW')};" for column, expr in SEARCH_COLUMNS.items())
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION {SEARCH_TRIGGER}() RETURNS trigger AS $$
+        BEGIN
+            {assignments}
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute(f"DROP TRIGGER IF EXISTS {SEARCH_TRIGGER} ON orders")
+    cur.execute(f"""
+        CREATE TRIGGER {SEARCH_TRIGGER}
+        BEFORE INSERT OR UPDATE OF contact ON orders
+        FOR EACH ROW EXECUTE FUNCTION {SEARCH_TRIGGER}()
+    """)
+
+
+def backfill_search_columns(conn, batch_size=5000):
+    """Заполняет поисковые колонки старых заказов пачками по id, каждая пачка — своя короткая транзакция"""
+    assignments = ", ".join(f"{column} = {expr.format(row='o')}" for column, expr in SEARCH_COLUMNS.items())
+    last_id = 0
+    total = 0
+    while True:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    WITH batch AS (
+                        SELECT id FROM orders
+                        WHERE id > %s AND search_name IS NULL
+                        ORDER BY id
+                        LIMIT %s
+                    )
+                    UPDATE orders o SET {assignments}
+                    FROM batch WHERE o.id = batch.id
+                    RETURNING o.id
+                """, (last_id, batch_size))
+                ids = [row['id'] for row in cur.fetchall()]
+        if not ids:
+            return total
+        last_id = max(ids)
+        total += len(ids)
+        logger.info(f"Поисковые колонки заполнены у {total} заказов (до id {last_id})")
+
+
+def migrate_order_search(dsn, batch_size=5000):
+    """Готовит поиск заказов; только из python schema.py migrate, не при старте бота"""
+    conn = _connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            # Расширение создаётся отдельной командой, вне транзакций с блокировками orders
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    finally:
+        conn.close()
+
+    conn = _connect(dsn, autocommit=False)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                add_search_columns(cur)
+        filled = backfill_search_columns(conn, batch_size)
+    finally:
+        conn.close()
+
+    conn = _connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            created = create_indexes(cur, SEARCH_INDEXES)
+    finally:
+        conn.close()
+    return filled, created
+
+
+def _index_state(cur, name):
+    """None — индекса нет, иначе признак валидности (после сбоя CONCURRENTLY он бывает INVALID)"""
+    cur.execute("""
+        SELECT i.indisvalid
+        FROM pg_class c
+        JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s AND c.relkind = 'i'
+    """, (name,))
+    row = cur.fetchone()
+    return None if row is None else row['indisvalid']
+
+
+def duplicate_request_ids(cur, limit=5) -> list:
+    """request_id, под которыми в orders несколько заказов: из-за них не строится REQUEST_ID_INDEX"""
+    cur.execute("""
+        SELECT request_id FROM orders
+        WHERE request_id IS NOT NULL
+        GROUP BY request_id
+        HAVING count(*) > 1
+        LIMIT %s
+    """, (limit,))
+    return [row['request_id'] for row in cur.fetchall()]
+
+
+def expected_indexes(cur):
+    """Индексы, которые должны быть: индексы поиска — только когда он подготовлен"""
+    return INDEXES + (SEARCH_INDEXES if search_columns_ready(cur) else [])
+
+
+def missing_indexes(cur):
+    return [spec[0] for spec in expected_indexes(cur) if _index_state(cur, spec[0]) is not True]
+
+
+def create_indexes(cur, indexes=None):
+    """Создаёт недостающие индексы; возвращает {имя: 'exists' | 'created' | текст ошибки}"""
+    result = {}
+    for name, table, definition, unique in indexes if indexes is not None else expected_indexes(cur):
+        state = _index_state(cur, name)
+        if state is True:
+            result[name] = 'exists'
+            continue
+        if state is False:
+            logger.warning(f"Индекс {name} невалиден, пересоздаём")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        try:
+            cur.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} ON {table} {definition}")
+            result[name] = 'created'
+            logger.info(f"Создан индекс {name}")
+        except psycopg2.Error as e:
+            result[name] = str(e).strip()
+            logger.error(f"Не удалось создать индекс {name}: {result[name]}")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    return result
+
+
+def _walk_plan(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _walk_plan(child)
+
+
+def explain_hot_queries(cur):
+    """Строит планы горячих запросов с запретом Seq Scan.
+
+    Если Seq Scan остаётся даже при enable_seqscan = off, подходящего
+    индекса нет: на большой таблице запрос будет читать её целиком.
+    """
+    report = []
+    queries = HOT_QUERIES + (SEARCH_HOT_QUERIES if search_columns_ready(cur) else [])
+    for name, sql, params, guarded in queries:
+        cur.execute("BEGIN")
+        try:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params or None)
+            plan = cur.fetchone()['QUERY PLAN'][0]['Plan']
+        except psycopg2.Error as e:
+            report.append({'query': name, 'error': str(e).strip(), 'ok': False})
+            continue
+        finally:
+            cur.execute("ROLLBACK")
+        nodes = list(_walk_plan(plan))
+        indexes = sorted({n['Index Name'] for n in nodes if 'Index Name' in n})
+        seq_scans = sorted({n['Relation Name'] for n in nodes
+                            if n['Node Type'] == 'Seq Scan' and n.get('Relation Name') in guarded})
+        report.append({'query': name, 'indexes': indexes, 'seq_scans': seq_scans, 'ok': not seq_scans})
+    return report
+
+
+def schema_problems(cur, with_outbox=True, with_update_dedup=True) -> list:
+    """Что мешает боту работать на этой схеме: запросы рассчитаны на результат миграций"""
+    problems = []
+    status_type = _column_type(cur, 'orders', 'status')
+    if status_type != 'order_status':
+        # Запросы фильтруют по status = 'active' — строки со старыми значениями пропали бы из списков
+        problems.append(f"orders.status имеет тип {status_type}, а не order_status")
+    if with_outbox and _column_type(cur, 'outbox', 'locked_until') is None:
+        problems.append("нет таблицы outbox (или колонки outbox.locked_until)")
+    if with_update_dedup and _column_type(cur, 'webhook_updates', 'received_at') is None:
+        problems.append("нет таблицы webhook_updates")
+    if _column_type(cur, 'order_number_counters', 'last_value') is None:
+        problems.append("нет таблицы order_number_counters")
+    if _index_state(cur, REQUEST_ID_INDEX) is not True:
+        # Без него повтор /api/new-order с тем же requestId создал бы второй заказ
+        problem = f"нет уникального индекса {REQUEST_ID_INDEX}"
+        duplicates = duplicate_request_ids(cur)
+        if duplicates:
+            problem += f": в orders повторяются request_id ({', '.join(duplicates)}), см. «Дубли request_id» в schema.py"
+        problems.append(problem)
+    return problems
+
+
+def verify(dsn, with_outbox=True, with_update_dedup=True) -> list:
+    conn = _connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            return schema_problems(cur, with_outbox, with_update_dedup)
+    finally:
+        conn.close()
+
+
+def search_ready(dsn) -> bool:
+    conn = _connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            return search_columns_ready(cur)
+    finally:
+        conn.close()
+
+
+def bootstrap(dsn, explain=True):
+    """Применяет лёгкие миграции, создаёт недостающие индексы и проверяет планы горячих запросов"""
+    apply_migrations(dsn)
+    conn = _connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            created = create_indexes(cur)
+            report = explain_hot_queries(cur) if explain else []
+    finally:
+        conn.close()
+    for item in report:
+        if 'error' in item:
+            logger.warning(f"Не удалось построить план {item['query']}: {item['error']}")
+        elif not item['ok']:
+            logger.warning(f"Запрос {item['query']} читает {', '.join(item['seq_scans'])} последовательным сканированием")
+    return created, report
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    dsn = os.getenv('DATABASE_URL')
+    command = argv[1] if len(argv) > 1 else 'bootstrap'
+    if not dsn:
+        print("Не задан DATABASE_URL")
+        return 2
+
+    if command == 'bootstrap':
+        created, report = bootstrap(dsn)
+        print(json.dumps({'indexes': created, 'plans': report}, ensure_ascii=False, indent=2))
+        return 0 if all(item['ok'] for item in report) else 1
+
+    if command == 'migrate':
+        print("Применены миграции: " + (", ".join(apply_migrations(dsn, rewrites=True)) or "нет"))
+        conn = _connect(dsn)
+        try:
+            with conn.cursor() as cur:
+                created = create_indexes(cur, INDEXES)
+        finally:
+            conn.close()
+        print(f"Индексы: {json.dumps(created, ensure_ascii=False)}")
+        if created[REQUEST_ID_INDEX] not in ('exists', 'created'):
+            print(f"Не удалось построить {REQUEST_ID_INDEX}: устраните дубли request_id, как описано ниже")
+            print(__doc__)
+            return 1
+        filled, search_created = migrate_order_search(dsn)
+        created.update(search_created)
+        print(f"Поиск заказов: заполнено заказов {filled}, индексы: {json.dumps(search_created, ensure_ascii=False)}")
+        return 0 if all(state in ('exists', 'created') for state in created.values()) else 1
+
+    conn = _connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            if command == 'check':
+                problems = schema_problems(cur)
+                missing = missing_indexes(cur)
+                for problem in problems:
+                    print("Схема не готова: " + problem)
+                if not search_columns_ready(cur):
+                    print("Поиск заказов не подготовлен: выполните python schema.py migrate")
+                print("Все индексы на месте" if not missing else "Не хватает индексов: " + ", ".join(missing))
+                return 1 if missing or problems else 0
+            if command == 'explain':
+                report = explain_hot_queries(cur)
+                print(json.dumps(report, ensure_ascii=False, indent=2))
+                return 0 if all(item['ok'] for item in report) else 1
+    finally:
+        conn.close()
+    print(__doc__)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
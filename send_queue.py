@@ -0,0 +1,362 @@
+import time
+import heapq
+import asyncio
+import logging
+import threading
+from collections import deque
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None) -> float:
+        """Забирает токен; если его нет — возвращает, сколько секунд ждать"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('method', 'chat_id', 'args', 'kwargs', 'attempts', 'on_sent', 'sent')
+
+    def __init__(self, method, chat_id, args, kwargs, on_sent=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+        # Вызывается после того, как Telegram принял сообщение; при ошибке доставки — нет
+        self.on_sent = on_sent
+        # Telegram принял вызов
+        self.sent = False
+
+
+class SendQueue:
+    """Очередь исходящих сообщений Telegram с пулом отправляющих потоков.
+
+    Сообщения одного чата уходят строго по порядку (чат обрабатывает не
+    больше одного потока одновременно), общий поток ограничен глобальным
+    ведром токенов, каждый чат — своим. На 429 сообщение остаётся первым в
+    очереди чата и повторяется через retry_after.
+    """
+
+    def __init__(self, bot, workers=4, global_rate=30.0, chat_rate=1.0, chat_burst=3,
+                 group_rate=20 / 60, max_pending=10000, max_attempts=5):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._chats = {}      # chat_id -> deque[_Job]
+        self._buckets = {}    # chat_id -> TokenBucket
+        self._schedule = []   # куча (когда можно отправлять, seq, chat_id)
+        self._scheduled = set()
+        self._busy = set()
+        self._pending = 0
+        self._seq = 0
+        self._threads = []
+        self._stopping = False
+
+    # ---------- Публичный интерфейс ----------
+    def submit(self, method: str, chat_id, *args, on_sent=None, **kwargs):
+        """Ставит вызов bot.<method>(chat_id, *args, **kwargs) в очередь чата; on_sent() — после доставки"""
+        self._ensure_started()
+        job = _Job(method, chat_id, args, kwargs, on_sent)
+        with self._cond:
+            while self._pending >= self.max_pending and not self._stopping:
+                self._cond.wait()
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+            queue.append(job)
+            self._pending += 1
+            if chat_id not in self._busy and chat_id not in self._scheduled:
+                self._push(chat_id, time.monotonic())
+            self._cond.notify()
+
+    def send_message(self, chat_id, text, on_sent=None, **kwargs):
+        self.submit('send_message', chat_id, text, on_sent=on_sent, **kwargs)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def stop(self, timeout=10.0):
+        """Дожидается отправки накопленных сообщений и останавливает потоки"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    # ---------- Внутреннее ----------
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"send-queue-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _push(self, chat_id, ready_at):
+        self._seq += 1
+        heapq.heappush(self._schedule, (ready_at, self._seq, chat_id))
+        self._scheduled.add(chat_id)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы, у них лимит заметно строже
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._chats and b.is_full(now)]:
+            del self._buckets[chat_id]
+
+    def _next_job(self):
+        """Берёт чат, чья очередь готова к отправке, и его первое сообщение"""
+        with self._cond:
+            while True:
+                if self._stopping and not self._schedule:
+                    return None
+                now = time.monotonic()
+                if self._schedule and self._schedule[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._schedule)
+                    self._scheduled.discard(chat_id)
+                    wait = self._chat_bucket(chat_id).take(now)
+                    if wait:
+                        self._push(chat_id, now + wait)
+                        continue
+                    self._busy.add(chat_id)
+                    return self._chats[chat_id][0]
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._cond.wait(timeout)
+
+    def _finish(self, job, retry_at=None):
+        with self._cond:
+            chat_id = job.chat_id
+            queue = self._chats[chat_id]
+            self._busy.discard(chat_id)
+            if retry_at is None:
+                queue.popleft()
+                self._pending -= 1
+            if queue:
+                self._push(chat_id, retry_at or time.monotonic())
+            else:
+                del self._chats[chat_id]
+                if self._buckets[chat_id].is_full():
+                    del self._buckets[chat_id]
+                elif len(self._buckets) > self.max_pending:
+                    self._prune_buckets()
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            while True:
+                with self._global_lock:
+                    wait = self._global.take()
+                if not wait:
+                    break
+                time.sleep(wait)
+            self._finish(job, self._deliver(job))
+
+    def _deliver(self, job):
+        """Выполняет вызов; возвращает время повтора или None, если с сообщением покончено"""
+        job.attempts += 1
+        try:
+            getattr(self.bot, job.method)(job.chat_id, *job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts < self.max_attempts:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                logger.warning(f"429 от Telegram для чата {job.chat_id}, повтор через {retry_after} с")
+                return time.monotonic() + retry_after
+            logger.error(f"Ошибка {job.method} в чат {job.chat_id}: {e}")
+        except requests.exceptions.RequestException as e:
+            if job.attempts < self.max_attempts:
+                delay = min(30, 2 ** job.attempts)
+                logger.warning(f"Сетевая ошибка {job.method} в чат {job.chat_id}: {e}, повтор через {delay} с")
+                return time.monotonic() + delay
+            logger.error(f"Ошибка {job.method} в чат {job.chat_id}: {e}")
+        except Exception as e:
+            logger.exception(f"Ошибка {job.method} в чат {job.chat_id}: {e}")
+        else:
+            job.sent = True
+            if job.on_sent is not None:
+                try:
+                    job.on_sent()
+                except Exception as e:
+                    logger.exception(f"Ошибка обработчика доставки в чат {job.chat_id}: {e}")
+        return None
+
+
+class AsyncSendQueue:
+    """То же для асинхронного режима (AsyncTeleBot).
+
+    У чата с непустой очередью есть своя задача asyncio, которая отправляет
+    его сообщения по порядку; ограничения те же — общее ведро токенов и
+    ведро на чат, на 429 сообщение повторяется через retry_after. Потоков
+    нет: ожидание лимитов и ответов Telegram не занимает ничего, кроме задачи.
+    """
+
+    def __init__(self, bot, global_rate=30.0, chat_rate=1.0, chat_burst=3, group_rate=20 / 60,
+                 max_pending=10000, max_attempts=5, network_errors=()):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        # Ошибки сети асинхронного клиента (aiohttp), после которых имеет смысл повтор
+        self.network_errors = tuple(network_errors)
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}      # chat_id -> deque[_Job]
+        self._buckets = {}    # chat_id -> TokenBucket
+        self._tasks = {}      # chat_id -> задача, разбирающая очередь чата
+        self._pending = 0
+        self._space = None    # asyncio.Condition, создаётся в цикле событий
+
+    async def submit(self, method: str, chat_id, *args, on_sent=None, **kwargs):
+        """Ставит вызов bot.<method>(chat_id, *args, **kwargs) в очередь чата; on_sent() — после доставки"""
+        if self._space is None:
+            self._space = asyncio.Condition()
+        if self._pending >= self.max_pending:
+            async with self._space:
+                await self._space.wait_for(lambda: self._pending < self.max_pending)
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+        queue.append(_Job(method, chat_id, args, kwargs, on_sent))
+        self._pending += 1
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def send_message(self, chat_id, text, on_sent=None, **kwargs):
+        await self.submit('send_message', chat_id, text, on_sent=on_sent, **kwargs)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def stop(self, timeout=10.0):
+        """Дожидается отправки накопленных сообщений"""
+        tasks = list(self._tasks.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    @staticmethod
+    async def _take(bucket):
+        while True:
+            wait = bucket.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _drain(self, chat_id):
+        queue = self._chats[chat_id]
+        bucket = self._chat_bucket(chat_id)
+        try:
+            while queue:
+                job = queue[0]
+                await self._take(bucket)
+                await self._take(self._global)
+                retry_after = await self._deliver(job)
+                if retry_after is not None:
+                    await asyncio.sleep(retry_after)
+                    continue
+                queue.popleft()
+                self._pending -= 1
+                if self._space is not None:
+                    async with self._space:
+                        self._space.notify()
+        finally:
+            # При отмене задачи неотправленное остаётся в очереди чата — снимаем со счёта
+            self._pending -= len(queue)
+            del self._chats[chat_id]
+            del self._tasks[chat_id]
+            if bucket.is_full():
+                del self._buckets[chat_id]
+
+    async def _deliver(self, job):
+        """Выполняет вызов; возвращает задержку повтора или None, если с сообщением покончено"""
+        job.attempts += 1
+        try:
+            await getattr(self.bot, job.method)(job.chat_id, *job.args, **job.kwargs)
+        except self.network_errors as e:
+            if job.attempts < self.max_attempts:
+                delay = min(30, 2 ** job.attempts)
+                logger.warning(f"Сетевая ошибка {job.method} в чат {job.chat_id}: {e}, повтор через {delay} с")
+                return delay
+            logger.error(f"Ошибка {job.method} в чат {job.chat_id}: {e}")
+        except Exception as e:
+            # У asyncio_helper свой класс ApiTelegramException, поэтому ошибки API узнаём по error_code
+            error_code = getattr(e, 'error_code', None)
+            if error_code == 429 and job.attempts < self.max_attempts:
+                retry_after = (getattr(e, 'result_json', None) or {}).get('parameters', {}).get('retry_after', 1)
+                logger.warning(f"429 от Telegram для чата {job.chat_id}, повтор через {retry_after} с")
+                return retry_after
+            if error_code is None:
+                logger.exception(f"Ошибка {job.method} в чат {job.chat_id}: {e}")
+            else:
+                logger.error(f"Ошибка {job.method} в чат {job.chat_id}: {e}")
+        else:
+            job.sent = True
+            if job.on_sent is not None:
+                try:
+                    # Обработчик может быть и обычной функцией, и корутинной
+                    result = job.on_sent()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    logger.exception(f"Ошибка обработчика доставки в чат {job.chat_id}: {e}")
+        return None
@@ -0,0 +1,120 @@
+import time
+import logging
+import threading
+from http.client import RemoteDisconnected
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ProtocolError
+
+logger = logging.getLogger(__name__)
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter, который сообщает о каждом новом соединении (а значит, и TLS-рукопожатии)"""
+
+    def __init__(self, on_connect, **kwargs):
+        self._on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        on_connect = self._on_connect
+
+        def counting(base):
+            class CountingPool(base):
+                def _new_conn(self):
+                    on_connect()
+                    return super()._new_conn()
+            return CountingPool
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting(cls) for scheme, cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+class TelegramTransport:
+    """HTTP-транспорт для вызовов Bot API через telebot.apihelper.
+
+    Одна сессия requests и один keep-alive пул на весь процесс: потоки
+    обработчиков, очередь отправки и запросы Flask берут соединения из него,
+    а не держат каждый свою сессию, которую telebot к тому же пересоздаёт
+    раз в SESSION_TIME_TO_LIVE. Повторяются (до retries раз, с паузой backoff,
+    удваивающейся с каждой попыткой) только сбои, при которых запрос точно не
+    дошёл до Telegram: не удалось подключиться или Telegram уже закрыл
+    простаивавшее keep-alive соединение. Остальные обрывы и таймаут чтения не
+    повторяются — запрос мог уже выполниться, и сообщение ушло бы дважды.
+    """
+
+    def __init__(self, pool_size=16, connect_timeout=5.0, read_timeout=15.0, retries=2, backoff=0.5):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = _CountingAdapter(self._on_connect, pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        # Открыл ли текущий поток новое соединение за последнюю попытку
+        self._local = threading.local()
+        self.requests = 0
+        self.connections = 0
+        self.retried = 0
+
+    def _on_connect(self):
+        self._local.connected = True
+        with self._lock:
+            self.connections += 1
+
+    @staticmethod
+    def _not_sent(error, reused: bool) -> bool:
+        """Сбой, после которого запрос точно не дошёл до Telegram и его можно повторить"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        cause = error.args[0] if error.args else None
+        if isinstance(getattr(cause, 'reason', None), NewConnectionError):
+            return True
+        # Протухшее keep-alive соединение: Telegram закрыл его, пока оно простаивало в пуле,
+        # и ответа не будет. На свежем соединении тот же обрыв мог случиться уже после обработки
+        return (reused and isinstance(cause, ProtocolError)
+                and isinstance(cause.args[-1], (RemoteDisconnected, ConnectionResetError, BrokenPipeError)))
+
+    def install(self, apihelper):
+        """Направляет все вызовы apihelper._make_request через этот транспорт"""
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """Сигнатура apihelper.CUSTOM_REQUEST_SENDER; timeout — (connect, read) этого вызова"""
+        timeout = timeout or (self.connect_timeout, self.read_timeout)
+        attempt = 0
+        while True:
+            with self._lock:
+                self.requests += 1
+            self._local.connected = False
+            try:
+                return self.session.request(method, url, params=params, files=files,
+                                            timeout=timeout, proxies=proxies)
+            except requests.exceptions.ConnectionError as e:
+                # Файлы уже прочитаны первой попыткой — такой запрос не повторить
+                if attempt >= self.retries or files or not self._not_sent(e, reused=not self._local.connected):
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                logger.warning(f"Сбой соединения с Telegram ({e.__class__.__name__}), повтор {attempt} через {delay} с")
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests_count, connections, retried = self.requests, self.connections, self.retried
+        return {
+            'requests': requests_count,
+            'connections': connections,
+            'retries': retried,
+            # Доля запросов, ушедших по уже открытому соединению (без нового TLS-рукопожатия)
+            'reuse_ratio': round(1 - connections / requests_count, 4) if requests_count else 0.0,
+        }
@@ -0,0 +1,108 @@
+from string import Formatter
+
+# Все сообщения бота уходят с parse_mode='Markdown' (legacy): там экранируются
+# только эти символы, а обратный слэш перед любым другим выводится как есть
+MARKDOWN_SPECIAL_CHARS = '_*`['
+_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in MARKDOWN_SPECIAL_CHARS})
+
+
+def escape_markdown(text):
+    """Экранирует специальные символы Markdown за один проход"""
+    if not text:
+        return text
+    return str(text).translate(_ESCAPE_TABLE)
+
+
+class Template:
+    """Шаблон сообщения, разобранный один раз при импорте.
+
+    Разметка задаётся как для str.format. Значения полей при отрисовке
+    экранируются, кроме полей из raw — туда передаются уже готовые
+    фрагменты Markdown (например, отрисованный состав заказа).
+    """
+
+    def __init__(self, layout: str, raw=()):
+        self.raw = frozenset(raw)
+        self.parts = [(literal, field) for literal, field, _, _ in Formatter().parse(layout)]
+
+    def render(self, **values) -> str:
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = values[field]
+                out.append(str(value) if field in self.raw else escape_markdown(str(value)))
+        return ''.join(out)
+
+
+def render_items(items) -> str:
+    """Состав заказа в Markdown; отрисовывается один раз на заказ для всех получателей"""
+    lines = []
+    for item in items:
+        name = f"{item['name']} ({item['variantName']})" if item.get('variantName') else item['name']
+        lines.append(f"• {escape_markdown(name)} x{item['quantity']} = {item['price'] * item['quantity']} руб.")
+    return "\n".join(lines)
+
+
+def payment_label(method) -> str:
+    return 'Наличные' if method == 'cash' else 'Перевод'
+
+
+def delivery_label(delivery_type) -> str:
+    return "Самовывоз" if delivery_type == 'pickup' else "Доставка"
+
+
+def username_label(username) -> str:
+    return f"@{escape_markdown(username)}" if username else "@не указан"
+
+
+NEW_ORDER_SELLER = Template(
+    "📦 *НОВЫЙ ЗАКАЗ {order_number}*\n\n"
+    "👤 Покупатель: {buyer_name}\n"
+    "📞 Телефон: {phone}\n"
+    "📱 Username: {username}\n"
+    "📍 {address}\n"
+    "📝 {items}\n\n"
+    "Сумма: {total} руб.\n"
+    "Оплата: {payment}\n"
+    "Доставка: {delivery}\n\n"
+    "💬 Чтобы ответить покупателю, используйте `#{order_number} текст`",
+    raw=('items', 'username')
+)
+
+NEW_ORDER_ADMIN = Template(
+    "🆕 *Новый заказ {order_number}*\n"
+    "Продавец: {seller_name}\n"
+    "Покупатель: {buyer_name}\n"
+    "📞 Телефон: {phone}\n"
+    "📱 Username: {username}\n"
+    "📍 Адрес: {address}\n\n"
+    "📦 *Состав заказа:*\n{items}\n\n"
+    "💰 *Сумма: {total} руб.*",
+    raw=('items', 'username')
+)
+
+NEW_ORDER_BUYER = Template(
+    "✅ *Ваш заказ {order_number} принят!*\n\n"
+    "📝 *Состав заказа:*\n{items}\n\n"
+    "💳 Оплата: {payment}\n"
+    "🚚 Доставка: {delivery}\n"
+    "📍 Адрес: {address}\n\n"
+    "📅 Дата: {date}\n"
+    "👤 Username: {username}\n\n"
+    "💬 Вы можете общаться с продавцом в этом чате.",
+    raw=('items', 'username')
+)
+
+ORDER_CARD = Template(
+    "📦 *Заказ {order_number}*\n\n"
+    "👤 Покупатель: {buyer_name}\n"
+    "📍 Адрес: {address}\n"
+    "📞 Телефон: {phone}\n"
+    "📱 Username: {username}\n"
+    "💳 Оплата: {payment}\n"
+    "🚚 Доставка: {delivery}\n\n"
+    "📝 *Состав заказа:*\n{items}\n\n"
+    "💰 *Итого: {total} руб.*\n",
+    raw=('items', 'username')
+)
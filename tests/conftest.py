@@ -0,0 +1,9 @@
+import os
+import sys
+
+# core читает настройки при импорте и без них не загружается; к БД тесты не подключаются
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/test')
+os.environ.setdefault('DIRECTORY_CACHE_LISTEN', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+
+from dedup import UpdateDeduplicator
+
+
+def test_repeat_within_window_is_dropped():
+    dedup = UpdateDeduplicator(window=10)
+    assert dedup.is_new(1)
+    assert not dedup.is_new(1)
+    assert dedup.duplicates == 1
+
+
+def test_window_evicts_oldest_ids():
+    dedup = UpdateDeduplicator(window=2)
+    for update_id in (1, 2, 3):
+        assert dedup.is_new(update_id)
+    assert dedup.is_new(1)
+    assert not dedup.is_new(3)
+
+
+def test_forget_allows_redelivery():
+    dedup = UpdateDeduplicator()
+    assert dedup.is_new(5)
+    dedup.forget(5)
+    assert dedup.is_new(5)
+
+
+class FakeCursor:
+    def __init__(self, claimed):
+        self.claimed = claimed
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params):
+        if sql.startswith("INSERT"):
+            update_id = params[0]
+            self.rowcount = 0 if update_id in self.claimed else 1
+            self.claimed.add(update_id)
+        elif sql.startswith("DELETE FROM webhook_updates WHERE update_id"):
+            self.claimed.discard(params[0])
+
+
+def fake_connection(claimed):
+    @contextmanager
+    def get_connection():
+        conn = type('Conn', (), {'cursor': lambda self: FakeCursor(claimed)})()
+        yield conn
+    return get_connection
+
+
+def test_claim_in_db_drops_repeat_from_other_instance():
+    claimed = set()
+    first = UpdateDeduplicator(get_connection=fake_connection(claimed))
+    second = UpdateDeduplicator(get_connection=fake_connection(claimed))
+    assert first.is_new(7)
+    assert not second.is_new(7)
+    assert second.duplicates == 1
+    first.forget(7)
+    assert UpdateDeduplicator(get_connection=fake_connection(claimed)).is_new(7)
+
+
+def test_db_failure_falls_back_to_memory_window():
+    @contextmanager
+    def broken():
+        raise ConnectionError('db down')
+        yield
+
+    dedup = UpdateDeduplicator(get_connection=broken)
+    assert dedup.is_new(1)
+    assert not dedup.is_new(1)
@@ -0,0 +1,108 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from idempotency import IdempotentRequests
+
+
+def test_repeat_returns_cached_result():
+    requests = IdempotentRequests()
+    calls = []
+    assert requests.run('r1', lambda: calls.append(1) or 'ok') == 'ok'
+    assert requests.run('r1', lambda: calls.append(1) or 'other') == 'ok'
+    assert calls == [1]
+    assert requests.hits == 1
+
+
+def test_concurrent_repeats_wait_for_first_request():
+    requests = IdempotentRequests()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'order'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(requests.run('r1', slow)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(requests.run('r1', slow))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while requests.merged < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == ['order'] * 4
+    assert calls == [1]
+
+
+def test_uncacheable_result_is_recomputed():
+    requests = IdempotentRequests()
+    results = iter([('error', 503), ('ok', 200)])
+    cacheable = lambda result: result[1] < 500
+    assert requests.run('r1', lambda: next(results), cacheable) == ('error', 503)
+    assert requests.run('r1', lambda: next(results), cacheable) == ('ok', 200)
+    assert requests.get('r1') == ('ok', 200)
+
+
+def test_error_is_not_cached():
+    requests = IdempotentRequests()
+
+    def fail():
+        raise RuntimeError('db down')
+
+    with pytest.raises(RuntimeError):
+        requests.run('r1', fail)
+    assert requests.run('r1', lambda: 'ok') == 'ok'
+
+
+def test_lru_evicts_oldest_key():
+    requests = IdempotentRequests(maxsize=2)
+    requests.remember('a', 1)
+    requests.remember('b', 2)
+    requests.get('a')
+    requests.remember('c', 3)
+    assert requests.get('b') is None
+    assert requests.get('a') == 1
+    assert requests.get('c') == 3
+
+
+def test_run_async_merges_concurrent_repeats():
+    requests = IdempotentRequests()
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'order'
+
+    async def main():
+        return await asyncio.gather(*(requests.run_async('r1', create) for _ in range(3)))
+
+    assert asyncio.run(main()) == ['order'] * 3
+    assert calls == [1]
+    assert requests.merged == 2
+
+
+def test_run_async_passes_error_to_repeats():
+    requests = IdempotentRequests()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('db down')
+
+    async def main():
+        return await asyncio.gather(*(requests.run_async('r1', fail) for _ in range(2)), return_exceptions=True)
+
+    errors = asyncio.run(main())
+    assert all(isinstance(error, RuntimeError) for error in errors)
+    assert requests.get('r1') is None
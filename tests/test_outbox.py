@@ -0,0 +1,119 @@
+import json
+from contextlib import contextmanager
+
+from outbox import Outbox
+from devtools.stub_stock_bot import StubStockBot
+
+
+class FakeOutboxTable:
+    """Таблица outbox в памяти: понимает ровно те запросы, что шлёт Outbox"""
+
+    def __init__(self, count):
+        self.now = 0.0
+        self.rows = {
+            i: {'id': i, 'event_type': 'order_completed', 'payload': json.dumps({'orderNumber': f'A{i}'}),
+                'idempotency_key': f'order_completed:A{i}', 'attempts': 0, 'status': 'pending',
+                'next_attempt_at': 0.0, 'locked_until': None}
+            for i in range(1, count + 1)
+        }
+        self.claims = []
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, table):
+        self.table = table
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def fetchall(self):
+        return self.result
+
+    def execute(self, sql, params):
+        table, rows = self.table, self.table.rows
+        if 'RETURNING' in sql:
+            lease, limit = params
+            ready = [row for row in sorted(rows.values(), key=lambda row: row['id'])
+                     if row['status'] == 'pending' and row['next_attempt_at'] <= table.now
+                     and (row['locked_until'] is None or row['locked_until'] < table.now)][:limit]
+            for row in ready:
+                row['locked_until'] = table.now + lease
+            table.claims.append([row['id'] for row in ready])
+            self.result = [dict(row) for row in ready]
+        elif 'ANY(%s)' in sql:
+            for event_id in params[0]:
+                rows[event_id]['locked_until'] = None
+        elif "status = 'delivered'" in sql:
+            attempts, event_id = params
+            rows[event_id].update(status='delivered', attempts=attempts, locked_until=None)
+        else:
+            attempts, status, error, backoff, event_id = params
+            rows[event_id].update(attempts=attempts, status=status, last_error=error, locked_until=None,
+                                  next_attempt_at=table.now + backoff)
+
+
+def make_outbox(table, url, **kwargs):
+    return Outbox(table.connection, {'order_completed': url + '/api/order-completed'}, timeout=2.0, **kwargs)
+
+
+def test_claimed_events_are_leased_until_lease_expires():
+    table = FakeOutboxTable(3)
+    first = make_outbox(table, 'http://127.0.0.1:9', batch_size=2)
+    assert first.lease == 2 * 2.0 + 30
+    events = first._claim()
+    assert [event['id'] for event in events] == [1, 2]
+    # Пока аренда действует, второй инстанс берёт только свободные события
+    second = make_outbox(table, 'http://127.0.0.1:9', batch_size=2)
+    assert [event['id'] for event in second._claim()] == [3]
+    assert second._claim() == []
+    # Инстанс упал, не записав итог: после аренды события снова доступны
+    table.now += first.lease + 1
+    assert [event['id'] for event in second._claim()] == [1, 2]
+
+
+def test_batch_is_delivered_and_marked():
+    table = FakeOutboxTable(3)
+    with StubStockBot() as stub:
+        outbox = make_outbox(table, stub.url, batch_size=10)
+        assert outbox.dispatch_batch() == 3
+        assert [event['orderNumber'] for event in stub.events] == ['A1', 'A2', 'A3']
+    assert all(row['status'] == 'delivered' and row['locked_until'] is None for row in table.rows.values())
+
+
+def test_unreachable_receiver_releases_rest_of_batch():
+    table = FakeOutboxTable(3)
+    with StubStockBot(fail_first=1) as stub:
+        outbox = make_outbox(table, stub.url, batch_size=10, base_backoff=5.0)
+        assert outbox.dispatch_batch() == 0
+        assert stub.requests == 1
+        first, *rest = table.rows.values()
+        assert (first['status'], first['attempts'], first['next_attempt_at']) == ('pending', 1, 5.0)
+        # Остаток пачки не ждёт истечения аренды и не тратит попытки
+        assert all(row['locked_until'] is None and row['attempts'] == 0 for row in rest)
+        assert outbox.dispatch_batch() == 2
+        table.now = 5.0
+        assert outbox.dispatch_batch() == 1
+        assert sorted(event['orderNumber'] for event in stub.events) == ['A1', 'A2', 'A3']
+
+
+def test_event_fails_after_max_attempts():
+    table = FakeOutboxTable(1)
+    with StubStockBot(fail_rate=1.0) as stub:
+        outbox = make_outbox(table, stub.url, max_attempts=2, base_backoff=1.0)
+        outbox.dispatch_batch()
+        table.now += 10
+        outbox.dispatch_batch()
+        assert stub.requests == 2
+    assert table.rows[1]['status'] == 'failed'
+    assert outbox._claim() == []
@@ -0,0 +1,47 @@
+import pytest
+
+import core
+
+
+def test_normalize_collapses_whitespace():
+    assert core.normalize_search_query("  Иван \t Петров\n") == "Иван Петров"
+
+
+def test_normalize_cuts_on_utf8_character_boundary():
+    query = core.normalize_search_query("я" * 100, max_bytes=7)
+    # Кириллица — 2 байта на букву: половинка буквы отбрасывается, а не ломает строку
+    assert query == "яяя"
+    assert len(query.encode()) <= 7
+
+
+@pytest.mark.parametrize('text', ["я" * 100, "a" * 100, "🙂" * 40, "x " * 60])
+def test_callback_data_fits_telegram_limit_at_max_offset(text):
+    query = core.normalize_search_query(text)
+    data = core.search_callback(query, core.SEARCH_MAX_OFFSET)
+    assert len(data.encode()) <= 64
+
+
+def test_callback_round_trip_keeps_colons_in_query():
+    assert core.parse_search_callback(core.search_callback("a:b", 20)) == ("a:b", 20)
+
+
+def test_parse_callback_clamps_offset():
+    assert core.parse_search_callback("find:-5:abc") == ("abc", 0)
+    assert core.parse_search_callback("find:99999999:abc") == ("abc", core.SEARCH_MAX_OFFSET)
+
+
+def test_query_from_command_requires_min_length():
+    assert core.search_query_from_command("/find") is None
+    assert core.search_query_from_command("/find " + "a" * (core.SEARCH_MIN_QUERY - 1)) is None
+    assert core.search_query_from_command("/find  +7 916  ") == "+7 916"
+
+
+def test_parse_search_args_bounds_limit_and_offset():
+    (query, offset, limit), error = core.parse_search_args({'q': ' ab ', 'offset': '-3', 'limit': '1000'})
+    assert error is None
+    assert (query, offset, limit) == ('ab', 0, core.SEARCH_API_MAX_LIMIT)
+
+
+def test_parse_search_args_rejects_bad_input():
+    assert core.parse_search_args({'q': 'ab', 'limit': 'x'})[1][1] == 400
+    assert core.parse_search_args({'q': 'a'})[1][1] == 400
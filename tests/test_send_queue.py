@@ -0,0 +1,25 @@
+from send_queue import TokenBucket
+
+
+def test_bucket_allows_burst_up_to_capacity():
+    bucket = TokenBucket(rate=1.0, capacity=3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(now) == 1.0
+
+
+def test_bucket_wait_shrinks_as_tokens_refill():
+    bucket = TokenBucket(rate=2.0, capacity=1)
+    now = bucket.updated
+    assert bucket.take(now) == 0.0
+    assert bucket.take(now + 0.25) == 0.25
+    assert bucket.take(now + 0.5) == 0.0
+
+
+def test_bucket_refill_is_capped_by_capacity():
+    bucket = TokenBucket(rate=10.0, capacity=2)
+    now = bucket.updated
+    bucket.take(now)
+    assert bucket.is_full(now + 60)
+    assert bucket.tokens == 2
+    assert [bucket.take(now + 60) for _ in range(3)][-1] > 0
@@ -0,0 +1,29 @@
+import requests
+
+from devtools.stub_stock_bot import StubStockBot
+
+
+def post(stub, key, path='/api/order-completed'):
+    return requests.post(stub.url + path, json={'orderNumber': key}, headers={'Idempotency-Key': key}, timeout=5)
+
+
+def test_fail_first_returns_503_then_accepts():
+    with StubStockBot(fail_first=2) as stub:
+        assert [post(stub, 'A1').status_code for _ in range(3)] == [503, 503, 200]
+        assert stub.requests == 3
+        assert stub.events == [{'orderNumber': 'A1'}]
+
+
+def test_repeat_with_same_key_is_not_a_new_event():
+    with StubStockBot() as stub:
+        post(stub, 'A1')
+        post(stub, 'A1')
+        post(stub, 'A2')
+        assert stub.requests == 3
+        assert stub.events == [{'orderNumber': 'A1'}, {'orderNumber': 'A2'}]
+
+
+def test_unknown_path_is_404():
+    with StubStockBot() as stub:
+        assert post(stub, 'A1', path='/api/unknown').status_code == 404
+        assert stub.requests == 0
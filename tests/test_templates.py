@@ -0,0 +1,29 @@
+from templates import Template, escape_markdown, render_items, username_label
+
+
+def test_escape_markdown_escapes_only_legacy_markdown_chars():
+    assert escape_markdown("a_b*c`d[e]f\\g") == "a\\_b\\*c\\`d\\[e]f\\g"
+
+
+def test_escape_markdown_keeps_empty_values():
+    assert escape_markdown('') == ''
+    assert escape_markdown(None) is None
+
+
+def test_template_escapes_fields_but_not_raw():
+    template = Template("*{title}*\n{items}", raw=('items',))
+    assert template.render(title="Заказ_1", items="*готово*") == "*Заказ\\_1*\n*готово*"
+
+
+def test_template_escapes_non_string_values():
+    assert Template("{total}").render(total=10) == "10"
+
+
+def test_render_items_escapes_names():
+    text = render_items([{'name': 'Сыр_*', 'quantity': 2, 'price': 100}])
+    assert text == "• Сыр\\_\\* x2 = 200 руб."
+
+
+def test_username_label_escapes_underscores():
+    assert username_label('ivan_petrov') == "@ivan\\_petrov"
+    assert username_label(None) == "@не указан"
@@ -0,0 +1,100 @@
+import time
+import asyncio
+import threading
+
+from update_executor import OrderedExecutor, AsyncOrderedExecutor
+
+
+def test_items_of_one_key_run_in_order():
+    done = []
+    executor = OrderedExecutor(done.append, workers=4)
+    for i in range(50):
+        assert executor.submit('chat', i)
+    executor.join()
+    assert done == list(range(50))
+
+
+def test_slow_key_does_not_block_other_workers():
+    release = threading.Event()
+    done = []
+
+    def handler(item):
+        if item == 'slow':
+            release.wait(5)
+        done.append(item)
+
+    executor = OrderedExecutor(handler, workers=2)
+    # Ключи 0 и 1 попадают в разные потоки
+    executor.submit(0, 'slow')
+    executor.submit(1, 'fast')
+    deadline = time.monotonic() + 5
+    while 'fast' not in done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert done == ['fast']
+    release.set()
+    executor.join()
+    assert done == ['fast', 'slow']
+
+
+def test_submit_reports_full_queue():
+    release = threading.Event()
+    executor = OrderedExecutor(lambda item: release.wait(5), workers=1, queue_size=1)
+    executor.submit('chat', 1)
+    deadline = time.monotonic() + 5
+    while executor.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert executor.submit('chat', 2)
+    assert not executor.submit('chat', 3, timeout=0.01)
+    release.set()
+    executor.join()
+
+
+def test_handler_error_does_not_stop_worker():
+    done = []
+
+    def handler(item):
+        if item == 'bad':
+            raise RuntimeError(item)
+        done.append(item)
+
+    executor = OrderedExecutor(handler, workers=1)
+    executor.submit('chat', 'bad')
+    executor.submit('chat', 'good')
+    executor.join()
+    assert done == ['good']
+
+
+def test_async_executor_keeps_order_per_key():
+    done = []
+
+    async def handler(item):
+        key, index = item
+        # Первые задачи ключа ждут дольше: без упорядочивания они бы отстали
+        await asyncio.sleep(0.01 * (5 - index))
+        done.append(item)
+
+    async def main():
+        executor = AsyncOrderedExecutor(handler)
+        for index in range(5):
+            for key in ('a', 'b'):
+                executor.submit(key, (key, index))
+        await executor.join()
+        return executor
+
+    executor = asyncio.run(main())
+    assert [index for key, index in done if key == 'a'] == list(range(5))
+    assert [index for key, index in done if key == 'b'] == list(range(5))
+    assert executor.pending == 0
+
+
+def test_async_executor_rejects_over_max_pending():
+    async def handler(item):
+        await asyncio.sleep(0)
+
+    async def main():
+        executor = AsyncOrderedExecutor(handler, max_pending=2)
+        results = [executor.submit('chat', i) for i in range(3)]
+        await executor.join()
+        return results
+
+    assert asyncio.run(main()) == [True, True, False]
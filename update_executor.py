@@ -0,0 +1,131 @@
+import queue
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    """Чат, к которому относится апдейт Telegram (ключ упорядочивания)"""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, field, None)
+        if message is not None:
+            return message.chat.id
+    call = getattr(update, 'callback_query', None)
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    for field in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                  'my_chat_member', 'chat_member', 'chat_join_request'):
+        event = getattr(update, field, None)
+        if event is not None:
+            chat = getattr(event, 'chat', None)
+            return chat.id if chat is not None else event.from_user.id
+    return update.update_id
+
+
+class OrderedExecutor:
+    """Выполняет задачи параллельно по разным ключам и строго по порядку внутри ключа.
+
+    Ключ (id чата) закрепляется за одним потоком по хешу, у каждого потока
+    своя ограниченная очередь: медленный обработчик задерживает только чаты
+    своего потока, а сообщения одного чата не обгоняют друг друга.
+    """
+
+    def __init__(self, handler, workers=8, queue_size=100, name='updates'):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.name = name
+        self._queues = []
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                q = queue.Queue(maxsize=self.queue_size)
+                t = threading.Thread(target=self._worker, args=(q,), name=f"{self.name}-{i}", daemon=True)
+                self._queues.append(q)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, key, item, timeout=1.0) -> bool:
+        """Ставит задачу в очередь потока ключа; False — очередь переполнена"""
+        self._ensure_started()
+        q = self._queues[hash(key) % self.workers]
+        try:
+            q.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            logger.warning(f"Очередь {self.name} для ключа {key} переполнена")
+            return False
+
+    @property
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _worker(self, q):
+        while True:
+            item = q.get()
+            try:
+                self.handler(item)
+            except Exception as e:
+                logger.exception(f"Ошибка обработки задачи {self.name}: {e}")
+            finally:
+                q.task_done()
+
+    def join(self):
+        """Ждёт, пока все поставленные задачи будут выполнены"""
+        for q in self._queues:
+            q.join()
+
+
+class AsyncOrderedExecutor:
+    """То же для асинхронного режима: задача asyncio на каждый апдейт.
+
+    Задача ждёт предыдущую задачу своего ключа, поэтому апдейты одного чата
+    по-прежнему идут по порядку, а разные чаты ждут I/O одновременно. Сверх
+    max_pending незавершённых задач submit возвращает False.
+    """
+
+    def __init__(self, handler, max_pending=1000, name='updates'):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.name = name
+        self._tails = {}      # key -> последняя поставленная задача ключа
+        self._pending = 0
+
+    def submit(self, key, item) -> bool:
+        if self._pending >= self.max_pending:
+            logger.warning(f"Очередь {self.name} переполнена ({self._pending} задач)")
+            return False
+        self._pending += 1
+        task = asyncio.create_task(self._run(key, self._tails.get(key), item))
+        self._tails[key] = task
+        return True
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def _run(self, key, previous, item):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.handler(item)
+        except Exception as e:
+            logger.exception(f"Ошибка обработки задачи {self.name}: {e}")
+        finally:
+            self._pending -= 1
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+    async def join(self):
+        """Ждёт, пока все поставленные задачи будут выполнены"""
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))